@@ -0,0 +1,252 @@
+import signal
+import asyncio
+import logging
+import interfaces
+import bootstate
+import network
+import ssdp
+import metrics
+import sockfilter
+
+logger = logging.getLogger()
+
+class MulticastProtocol(asyncio.DatagramProtocol):
+    '''
+    Passes datagrams received on the SSDP multicast socket to a handler.
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.transport = None
+
+    def connection_made(self, transport):
+        logger.info('Listening for UDP multicast search requests')
+
+        self.transport = transport
+
+    def datagram_received(self, data, source_address):
+        try:
+            self.handler.handle(data, source_address)
+        except Exception:
+            logger.exception('Failed to handle datagram from %s', network.pretty_sockaddr(source_address))
+
+    def error_received(self, exc):
+        logger.warning('Error on UDP multicast socket: %s', exc)
+
+    def connection_lost(self, exc):
+        logger.info('Stop listening for UDP multicast search requests')
+
+class AsyncDelayedResponseQueue:
+    '''
+    Runs delayed SSDP callbacks on an event loop.
+
+    Has the call_later() interface of scheduler.Scheduler, and keeps the
+    handles so halt() can cancel what is still pending.
+    '''
+    def __init__(self, loop):
+        self.loop = loop
+        self.handles = set()
+
+    def call_later(self, delay, callback, *args):
+        def run():
+            self.handles.discard(handle)
+            callback(*args)
+
+        handle = self.loop.call_later(delay, run)
+        self.handles.add(handle)
+
+        return handle
+
+    def __len__(self):
+        return len(self.handles)
+
+    def halt(self):
+        for handle in self.handles:
+            handle.cancel()
+
+        self.handles.clear()
+
+class AsyncSSDPTroll(ssdp.SSDPDeviceManager):
+    '''
+    Advertises any number of remote SSDP devices and answers searches for them,
+    with receiving, advertising and delayed responses all running on one event loop.
+    '''
+    def __init__(self, ssdp_devices, notification_interval=1800, max_response_delay=5, revalidate_interval=300, discovery=None, rate_limiter_factory=None, metrics_port=None, multicast_interfaces=None, description_proxy=None, notify_listener_factory=None, bridge_peer=None, alive_repeat=2, alive_spread=10, reloader=None, socket_filter=False, boot_state=None, health_checker=None):
+        if description_proxy is not None:
+            for device in ssdp_devices:
+                description_proxy.add(device)
+
+        self.target_index = ssdp.SSDPTargetIndex(ssdp_devices)
+        self.description_proxy = description_proxy
+        self.notify_listener = None if notify_listener_factory is None else notify_listener_factory(self.target_index)
+        self.bridge_peer = bridge_peer
+        self.multicast_interfaces = multicast_interfaces
+        self.discovery = discovery
+        self.reloader = reloader
+        self.health_checker = health_checker
+        # the kernel only passes on the M-SEARCHs, and the NOTIFYs if something listens to them
+        self.socket_filter = sockfilter.ssdp_filter(accept_notify=self.notify_listener is not None) if socket_filter else None
+        self.rate_limiter = None if rate_limiter_factory is None else rate_limiter_factory()
+        self.metrics_server = None if metrics_port is None else metrics.MetricsServer(metrics_port, notify_registry=self.notify_listener)
+        self.notification_interval = notification_interval
+        self.max_response_delay = max_response_delay
+        self.revalidate_interval = revalidate_interval
+        self.alive_repeat = alive_repeat
+        self.alive_spread = alive_spread
+        self.boot_state = bootstate.SSDPBootState() if boot_state is None else boot_state
+
+    async def revalidate(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(self.revalidate_interval)
+            # the blocking HTTP requests run in the default executor
+            await loop.run_in_executor(None, ssdp.revalidate_devices, self.target_index, lambda device: loop.call_soon_threadsafe(self.device_changed, device))
+
+            if self.description_proxy is not None:
+                await loop.run_in_executor(None, self.description_proxy.revalidate)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stop_troll = asyncio.Event()
+
+        self.response_queue = AsyncDelayedResponseQueue(loop)
+        self.search_handler = ssdp.SSDPSearchRequestHandler(self.target_index, self.notification_interval, self.response_queue, self.max_response_delay, self.rate_limiter, self.notify_listener, self.boot_state)
+        self.advertiser = ssdp.SSDPAdvertiser(loop, self.target_index, self.notification_interval, self.alive_repeat, self.alive_spread, self.boot_state)
+
+        if self.notify_listener is not None:
+            self.notify_listener.start(loop)
+
+        metrics.devices.callback = lambda: len(self.target_index)
+        metrics.response_queue_depth.callback = self.search_handler.pending
+
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.description_proxy is not None:
+            self.description_proxy.start()
+
+        interface_monitor = None
+
+        if self.multicast_interfaces is None:
+            sockets = network.multicast_sockets(socket_filter=self.socket_filter)
+        else:
+            self.multicast_interfaces.update(interfaces.multicast_addresses(self.multicast_interfaces.ipv6_groups))
+
+            sockets = network.multicast_sockets(interface_addresses=(), ipv6=self.multicast_interfaces.ipv6, socket_filter=self.socket_filter)
+
+            for sock in sockets:
+                self.multicast_interfaces.add_listening_socket(sock)
+
+            if interfaces.have_netlink():
+                interface_monitor = interfaces.InterfaceMonitor()
+                loop.add_reader(interface_monitor.fileno(), self.interfaces_changed, interface_monitor)
+
+        metrics.socket_dropped.callback = lambda: sum(sockfilter.dropped(sock) or 0 for sock in sockets)
+
+        transports = []
+
+        for sock in sockets:
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: MulticastProtocol(self.search_handler),
+                sock=sock)
+
+            transports.append(transport)
+
+        loop.add_signal_handler(signal.SIGINT, stop_troll.set)
+        loop.add_signal_handler(signal.SIGTERM, stop_troll.set)
+
+        if self.reloader is not None:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload()))
+
+        revalidator = asyncio.ensure_future(self.revalidate())
+
+        try:
+            self.advertiser.start()
+
+            if self.health_checker is not None:
+                self.health_checker.on_unhealthy = lambda device: loop.call_soon_threadsafe(self.device_unhealthy, device)
+                self.health_checker.on_healthy = lambda device: loop.call_soon_threadsafe(self.device_healthy, device)
+
+                for device in self.target_index:
+                    self.health_checker.add(device)
+
+                self.health_checker.start()
+
+            if self.discovery is not None:
+                self.discovery.on_device = lambda device: loop.call_soon_threadsafe(self.add_device, device)
+                self.discovery.on_device_changed = lambda device: loop.call_soon_threadsafe(self.device_changed, device)
+                self.discovery.start()
+
+            if self.bridge_peer is not None:
+                self.bridge_peer.on_device = lambda device: loop.call_soon_threadsafe(self.add_device, device)
+                self.bridge_peer.on_device_removed = lambda device: loop.call_soon_threadsafe(self.remove_device, device)
+                self.bridge_peer.start()
+
+            await stop_troll.wait()
+        finally:
+            revalidator.cancel()
+
+            if self.bridge_peer is not None and self.bridge_peer.is_alive():
+                self.bridge_peer.join()
+            if self.health_checker is not None:
+                self.health_checker.join()
+
+            loop.remove_signal_handler(signal.SIGINT)
+            loop.remove_signal_handler(signal.SIGTERM)
+            if self.reloader is not None:
+                loop.remove_signal_handler(signal.SIGHUP)
+
+            if interface_monitor is not None:
+                loop.remove_reader(interface_monitor.fileno())
+                interface_monitor.close()
+
+            self.response_queue.halt()
+            self.advertiser.stop()
+
+            for sock, transport in zip(sockets, transports):
+                if self.multicast_interfaces is not None:
+                    self.multicast_interfaces.remove_listening_socket(sock)
+
+                transport.close()
+
+            if self.description_proxy is not None:
+                self.description_proxy.join()
+            if self.metrics_server is not None:
+                self.metrics_server.join()
+
+    def device_unhealthy(self, device):
+        # queued by the health checker thread, the device may have been removed since
+        if device in self.health_checker and device in self.target_index:
+            self.take_offline(device)
+
+    def device_healthy(self, device):
+        if device in self.health_checker and device not in self.target_index:
+            self.bring_online(device)
+
+    async def reload(self):
+        '''Reads the device list again and brings only the devices that changed offline or online'''
+        if self.discovery is not None and self.discovery.is_alive():
+            logger.warning('Not reloading the device list while the device discovery is running')
+            return
+
+        logger.info('Reloading the device list')
+
+        try:
+            # fetching the new descriptions blocks
+            plan = await asyncio.get_running_loop().run_in_executor(None, self.reloader.plan, self.known_devices())
+        except Exception:
+            logger.exception('Failed to reload the device list')
+            return
+
+        self.apply_reload(plan)
+
+    def interfaces_changed(self, interface_monitor):
+        if not interface_monitor.drain():
+            return
+
+        try:
+            ssdp.update_interfaces(self.multicast_interfaces, self.advertiser)
+        except Exception:
+            logger.exception('Failed to handle interface change')
+
+    def run(self):
+        asyncio.run(self.serve())
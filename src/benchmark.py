@@ -0,0 +1,959 @@
+import sys
+import gc
+import json
+import base64
+import ctypes
+import ctypes.util
+import argparse
+import os
+import platform
+import random
+import socket
+import struct
+import threading
+import time
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as ET
+import discovery
+import loadtest
+import network
+import ssdp
+import ratelimit
+import scheduler
+from ctypes import (
+    Structure, POINTER,
+    c_void_p, c_size_t, c_uint, c_uint32, c_int,
+    addressof, cast, create_string_buffer, get_errno
+)
+from http2 import HTTPRequest
+
+NOTIFY_ALIVE = (
+    b'NOTIFY * HTTP/1.1\r\n'
+    b'HOST: 239.255.255.250:1900\r\n'
+    b'CACHE-CONTROL: max-age=1800\r\n'
+    b'LOCATION: http://192.168.1.23:49152/description.xml\r\n'
+    b'NT: urn:schemas-upnp-org:service:RenderingControl:1\r\n'
+    b'NTS: ssdp:alive\r\n'
+    b'SERVER: Linux/3.14 UPnP/1.0 Renderer/1.0\r\n'
+    b'USN: uuid:4d696e69-444c-164e-9d41-b827eb0f1234::urn:schemas-upnp-org:service:RenderingControl:1\r\n'
+    b'\r\n'
+)
+
+NOTIFY_BYEBYE = (
+    b'NOTIFY * HTTP/1.1\r\n'
+    b'HOST: 239.255.255.250:1900\r\n'
+    b'NT: upnp:rootdevice\r\n'
+    b'NTS: ssdp:byebye\r\n'
+    b'USN: uuid:4d696e69-444c-164e-9d41-b827eb0f1234::upnp:rootdevice\r\n'
+    b'\r\n'
+)
+
+MSEARCH = (
+    b'M-SEARCH * HTTP/1.1\r\n'
+    b'HOST: 239.255.255.250:1900\r\n'
+    b'MAN: "ssdp:discover"\r\n'
+    b'MX: 3\r\n'
+    b'ST: urn:schemas-upnp-org:device:MediaServer:1\r\n'
+    b'USER-AGENT: Android/9 UPnP/1.0 Player/2.1\r\n'
+    b'\r\n'
+)
+
+MALFORMED = [
+    b'',
+    b'\x00\x01\x02\x03' * 64,
+    b'M-SEARCH * HTTP/1.1\r\n',
+    b'M-SEARCH * HTTP/1.1\r\nMAN: "ssdp:discover"\r\nMX: 3\r\n\r\n',
+    b'M-SEARCH * HTTP/1.1\r\nST: ssdp:all\r\nMX: 3\r\n\r\n',
+    b'M-SEARCH * HTTP/1.1\r\nMAN: "ssdp:discover"\r\nMX: banana\r\nST: upnp:rootdevice\r\n\r\n',
+    b'M-SEARCH * HTTP/1.1\r\nMAN: "ssdp:discover"\r\nMX: 3\r\nST: \xff\xfe\xfd\r\n\r\n',
+    b'M-SEARCH * HTTP/1.1\r\nMAN: "ssdp:discover"\r\nMX: 3\r\nST: ' + b'x' * 2000 + b'\r\n\r\n',
+    b'NOTIFY * HTTP/1.1',
+    b'GET / HTTP/1.1\r\nHost: 239.255.255.250\r\n\r\n',
+]
+
+DESCRIPTION_TEMPLATE = '''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType>urn:schemas-upnp-org:device:MediaServer:1</deviceType>
+    <friendlyName>Benchmark server {index:d}</friendlyName>
+    <UDN>uuid:00000000-0000-0000-0000-{index:012d}</UDN>
+    <serviceList>
+      <service>
+        <serviceType>urn:schemas-upnp-org:service:ContentDirectory:1</serviceType>
+        <serviceId>urn:upnp-org:serviceId:ContentDirectory</serviceId>
+        <SCPDURL>/ContentDirectory.xml</SCPDURL>
+        <controlURL>/ctl/ContentDirectory</controlURL>
+        <eventSubURL>/evt/ContentDirectory</eventSubURL>
+      </service>
+      <service>
+        <serviceType>urn:schemas-upnp-org:service:ConnectionManager:1</serviceType>
+        <serviceId>urn:upnp-org:serviceId:ConnectionManager</serviceId>
+        <SCPDURL>/ConnectionManager.xml</SCPDURL>
+        <controlURL>/ctl/ConnectionManager</controlURL>
+        <eventSubURL>/evt/ConnectionManager</eventSubURL>
+      </service>
+    </serviceList>
+  </device>
+</root>
+'''
+
+def msearch(search_target, mx=3):
+    return (
+        b'M-SEARCH * HTTP/1.1\r\n'
+        b'HOST: 239.255.255.250:1900\r\n'
+        b'MAN: "ssdp:discover"\r\n'
+        b'MX: ' + str(mx).encode('ascii') + b'\r\n'
+        b'ST: ' + search_target.encode('utf-8') + b'\r\n'
+        b'\r\n'
+    )
+
+def synthetic_devices(count):
+    return [
+        ssdp.SSDPRemoteDevice(
+            'http://10.1.{:d}.{:d}:8200/rootDesc.xml'.format(index // 250, index % 250 + 1),
+            description_data=DESCRIPTION_TEMPLATE.format(index=index).encode('utf-8'))
+        for index in range(count)
+    ]
+
+def notify_heavy_corpus(size=10000, search_ratio=0.05, seed=0):
+    '''Returns a list of datagrams where most traffic is NOTIFYs from other devices'''
+    rng = random.Random(seed)
+    corpus = []
+
+    for i in range(size):
+        if rng.random() < search_ratio:
+            corpus.append(MSEARCH)
+        else:
+            corpus.append(rng.choice((NOTIFY_ALIVE, NOTIFY_ALIVE, NOTIFY_ALIVE, NOTIFY_BYEBYE)))
+
+    return corpus
+
+def ssdp_all_storm_corpus(size=10000, seed=0):
+    '''Returns M-SEARCHes for ssdp:all'''
+    rng = random.Random(seed)
+    return [msearch('ssdp:all', rng.randint(1, 5)) for i in range(size)]
+
+def targeted_corpus(size=10000, devices=1, seed=0):
+    '''Returns M-SEARCHes for specific targets, some of which nobody answers'''
+    rng = random.Random(seed)
+    targets = [
+        'upnp:rootdevice',
+        'urn:schemas-upnp-org:device:MediaServer:1',
+        'urn:schemas-upnp-org:service:ContentDirectory:1',
+        'urn:schemas-upnp-org:device:MediaRenderer:1',
+        'urn:dial-multiscreen-org:service:dial:1',
+    ] + ['uuid:00000000-0000-0000-0000-{:012d}'.format(index) for index in range(devices)]
+
+    return [msearch(rng.choice(targets)) for i in range(size)]
+
+def malformed_corpus(size=10000, seed=0):
+    rng = random.Random(seed)
+    return [rng.choice(MALFORMED) for i in range(size)]
+
+CORPORA = {
+    'notify-heavy': lambda args: notify_heavy_corpus(args.size, args.search_ratio),
+    'ssdp-all-storm': lambda args: ssdp_all_storm_corpus(args.size),
+    'targeted': lambda args: targeted_corpus(args.size, args.devices),
+    'malformed': lambda args: malformed_corpus(args.size),
+}
+
+def load_corpus(path):
+    '''Loads a recorded corpus: one JSON object per line with a base64 encoded "data" datagram'''
+    with open(path, 'r') as f:
+        return [base64.b64decode(json.loads(line)['data']) for line in f if line.strip()]
+
+class StubSender:
+    '''
+    Stands in for network.SSDPSender and only counts the datagrams.
+    '''
+    def __init__(self):
+        self.datagrams = 0
+
+    def send_multicast(self, data, interfaces=None):
+        self.datagrams += 1
+
+    def send_unicast(self, address, data):
+        self.datagrams += 1
+
+    def send_multicast_batch(self, datagrams, interfaces=None):
+        self.datagrams += len(datagrams)
+
+    def send_unicast_batch(self, messages):
+        self.datagrams += len(messages)
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def replay(handler, corpus, sources, interval):
+    '''Feeds the corpus through the handler like the receive loop does and returns the per message latencies in ns
+
+    A datagram arrives every interval seconds of the simulated clock of the
+    response queue, which runs the replies that are due after each one. The
+    replies still pending at the end are sent before returning.'''
+    timers = handler.response_queue
+    clock = timers.clock
+    latencies = []
+    perf_counter_ns = time.perf_counter_ns
+
+    for i, data in enumerate(corpus):
+        source_address = sources[i % len(sources)]
+        clock.now += interval
+        started = perf_counter_ns()
+        handler.handle(data, source_address)
+        timers.run_due()
+        latencies.append(perf_counter_ns() - started)
+
+    flush_replies(timers)
+
+    return latencies
+
+def flush_replies(timers):
+    while len(timers):
+        timers.clock.now = max(timers.clock.now, timers.next_time())
+        timers.run_due()
+
+def measure_allocations(handler, corpus, sources, interval):
+    '''Returns the mean peak of traced memory and the mean number of blocks retained per message'''
+    timers = handler.response_queue
+    tracemalloc.start()
+    peak_total = 0
+    blocks_before = sys.getallocatedblocks()
+
+    try:
+        for i, data in enumerate(corpus):
+            timers.clock.now += interval
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            handler.handle(data, sources[i % len(sources)])
+            timers.run_due()
+            peak_total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+    # pending replies are not retained for good
+    flush_replies(timers)
+
+    return peak_total / len(corpus), (sys.getallocatedblocks() - blocks_before) / len(corpus)
+
+def benchmark_corpus(name, corpus, devices, args):
+    sender = StubSender()
+    network.set_default_sender(sender)
+
+    sources = [('192.168.{:d}.{:d}'.format(i // 250, i % 250 + 1), 50000 + i) for i in range(args.sources)]
+    rate_limiter = ratelimit.SSDPRateLimiter() if args.rate_limit else None
+    # delayed replies on a response queue, as SSDPTroll sets it up, on a clock driven by the replay
+    response_queue = scheduler.Scheduler(clock=SimulatedClock())
+    handler = ssdp.SSDPSearchRequestHandler(ssdp.SSDPTargetIndex(devices), response_queue=response_queue, rate_limiter=rate_limiter)
+    interval = 1 / args.message_rate
+
+    try:
+        # warm up the datagram cache before measuring
+        replay(handler, corpus[:100], sources, interval)
+
+        best = None
+
+        for i in range(args.repeat):
+            sender.datagrams = 0
+            started = time.perf_counter()
+            latencies = replay(handler, corpus, sources, interval)
+            elapsed = time.perf_counter() - started
+
+            if best is None or elapsed < best[0]:
+                best = (elapsed, sorted(latencies), sender.datagrams)
+
+        elapsed, latencies, datagrams = best
+        peak_bytes, retained_blocks = measure_allocations(handler, corpus[:args.allocation_size], sources, interval)
+    finally:
+        response_queue.close()
+
+    return {
+        'messages_per_second': len(corpus) / elapsed,
+        'p50_us': percentile(latencies, 0.5) / 1000,
+        'p90_us': percentile(latencies, 0.9) / 1000,
+        'p99_us': percentile(latencies, 0.99) / 1000,
+        'max_us': latencies[-1] / 1000,
+        'replies_per_message': datagrams / len(corpus),
+        'peak_bytes_per_message': peak_bytes,
+        'retained_blocks_per_message': retained_blocks,
+    }
+
+def benchmark_replay(args):
+    devices = synthetic_devices(args.devices)
+
+    if args.corpus_file:
+        corpora = [(args.corpus_file, load_corpus(args.corpus_file))]
+    else:
+        corpora = [(name, CORPORA[name](args)) for name in (args.corpus or sorted(CORPORA))]
+
+    results = {}
+
+    print('{:<16} {:>10} {:>8} {:>8} {:>8} {:>9} {:>8} {:>10} {:>8}'.format(
+        'corpus', 'msg/s', 'p50 us', 'p90 us', 'p99 us', 'max us', 'replies', 'peak B', 'blocks'))
+
+    for name, corpus in corpora:
+        result = results[name] = benchmark_corpus(name, corpus, devices, args)
+
+        print('{:<16} {messages_per_second:>10.0f} {p50_us:>8.2f} {p90_us:>8.2f} {p99_us:>8.2f} {max_us:>9.2f} '
+            '{replies_per_message:>8.2f} {peak_bytes_per_message:>10.0f} {retained_blocks_per_message:>8.3f}'.format(name, **result))
+
+    parameters = replay_parameters(args)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'machine': machine_description(), 'parameters': parameters, 'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        if baseline['parameters'] != parameters:
+            sys.exit('Baseline {} was recorded with different parameters: {}'.format(args.baseline, json.dumps(baseline['parameters'], sort_keys=True)))
+
+        if baseline['machine'] != machine_description():
+            print('Baseline was recorded on a different machine, expect differences: {}'.format(json.dumps(baseline['machine'], sort_keys=True)))
+
+        if not compare_with_baseline(results, baseline['results'], args.tolerance):
+            sys.exit(1)
+
+def machine_description():
+    '''Returns what the replay results depend on besides the code'''
+    return {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'python': '{} {}'.format(platform.python_implementation(), platform.python_version()),
+    }
+
+def replay_parameters(args):
+    return {
+        'corpora': args.corpus_file or sorted(args.corpus or CORPORA),
+        'size': args.size,
+        'search_ratio': args.search_ratio,
+        'devices': args.devices,
+        'sources': args.sources,
+        'rate_limit': args.rate_limit,
+        'message_rate': args.message_rate,
+        'repeat': args.repeat,
+        'allocation_size': args.allocation_size,
+    }
+
+def compare_with_baseline(results, baseline, tolerance):
+    '''Prints the change against the baseline, returns False on a regression beyond tolerance'''
+    ok = True
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        old = baseline[name]
+        throughput = result['messages_per_second'] / old['messages_per_second'] - 1
+        latency = result['p99_us'] / old['p99_us'] - 1 if old['p99_us'] else 0.0
+        regressed = throughput < -tolerance or latency > tolerance
+
+        print('{:<16} throughput {:+.1%}, p99 latency {:+.1%}{}'.format(name, throughput, latency, ' REGRESSION' if regressed else ''))
+
+        ok = ok and not regressed
+
+    return ok
+
+def parse_http_request(corpus):
+    for data in corpus:
+        request = HTTPRequest.from_bytes(data)
+
+        if request.method == 'M-SEARCH':
+            request['st'], request.get('mx'), request.get('man')
+
+def parse_ssdp_search_request(corpus):
+    for data in corpus:
+        request = ssdp.SSDPSearchRequest.from_bytes(data)
+
+        if request is not None:
+            request.st, request.mx, request.man
+
+EMBEDDED_DEVICE_TEMPLATE = '''      <device>
+        <deviceType>urn:schemas-upnp-org:device:MediaRenderer:1</deviceType>
+        <friendlyName>Benchmark renderer {index:d}</friendlyName>
+        <manufacturer>Benchmark</manufacturer>
+        <modelName>Renderer</modelName>
+        <UDN>uuid:00000000-0000-0000-0001-{index:012d}</UDN>
+        <iconList>
+          <icon><mimetype>image/png</mimetype><width>120</width><height>120</height><depth>24</depth><url>/icons/{index:d}.png</url></icon>
+        </iconList>
+        <serviceList>
+{services}        </serviceList>
+      </device>
+'''
+
+EMBEDDED_SERVICE_TEMPLATE = '''          <service>
+            <serviceType>urn:schemas-upnp-org:service:{name}:1</serviceType>
+            <serviceId>urn:upnp-org:serviceId:{name}</serviceId>
+            <SCPDURL>/{index:d}/{name}.xml</SCPDURL>
+            <controlURL>/{index:d}/ctl/{name}</controlURL>
+            <eventSubURL>/{index:d}/evt/{name}</eventSubURL>
+          </service>
+'''
+
+def large_description(embedded_devices):
+    '''Returns the description of a root device with embedded_devices embedded renderers of three services each'''
+    devices = ''.join(
+        EMBEDDED_DEVICE_TEMPLATE.format(index=index, services=''.join(
+            EMBEDDED_SERVICE_TEMPLATE.format(index=index, name=name) for name in ('AVTransport', 'RenderingControl', 'ConnectionManager')))
+        for index in range(embedded_devices))
+
+    root = DESCRIPTION_TEMPLATE.format(index=0)
+
+    return root.replace('    </serviceList>\n', '    </serviceList>\n    <deviceList>\n' + devices + '    </deviceList>\n', 1).encode('utf-8')
+
+def traced_peak(function, data):
+    '''Returns the peak of traced memory in bytes while function(data) runs'''
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = function(data)
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+    del result
+
+    return peak
+
+def benchmark_description(args):
+    data = large_description(args.embedded_devices)
+
+    print('{:d} embedded devices, {:.0f} kB description'.format(args.embedded_devices, len(data) / 1000))
+    print('{:<28} {:>10} {:>10}'.format('parser', 'peak MB', 'ms'))
+
+    # the tree ET.fromstring builds is what the parser kept in memory before it streamed
+    for name, function in [('ET.fromstring', ET.fromstring), ('parse_device_description', ssdp.parse_device_description)]:
+        peak = traced_peak(function, data)
+        # timed without tracing, which slows down every allocation
+        best = min(timeit.repeat(lambda: function(data), number=1, repeat=args.repeat))
+
+        print('{:<28} {:>10.2f} {:>10.1f}'.format(name, peak / 1e6, best * 1000))
+
+def benchmark_parser(args):
+    corpus = notify_heavy_corpus(args.size, args.search_ratio)
+
+    for name, function in [('HTTPRequest.from_bytes', parse_http_request), ('SSDPSearchRequest.from_bytes', parse_ssdp_search_request)]:
+        best = min(timeit.repeat(lambda: function(corpus), number=1, repeat=args.repeat))
+        print('{:<30} {:>10.0f} msg/s {:>8.2f} us/msg'.format(name, len(corpus) / best, best / len(corpus) * 1e6))
+
+class SimulatedClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def alive_send_times(devices, repeat, spread, interval, rounds):
+    '''Drives an SSDPAliveSchedule on a simulated clock, returns (time, datagrams) for every send'''
+    clock = SimulatedClock()
+    timers = scheduler.Scheduler(clock=clock)
+    sends = []
+
+    schedule = ssdp.SSDPAliveSchedule(timers, lambda devices: sends.append((clock.now, sum(len(device.target_usns) for device in devices))), interval, repeat, spread)
+
+    # the spread path of add(), which startup, discovery and the bridge peer take
+    for device in devices:
+        schedule.add(device)
+
+    while timers.next_time() < interval * rounds:
+        clock.now = timers.next_time()
+        timers.run_due()
+
+    timers.close()
+
+    return sends
+
+def benchmark_advertise(args):
+    random.seed(0)
+    devices = synthetic_devices(args.devices)
+
+    print('{:<24} {:>10} {:>14} {:>20}'.format('schedule', 'datagrams', 'peak/{:g}ms'.format(args.window * 1000), 'delivered (computed)'))
+
+    for name, repeat, spread in [('back to back', 1, 0), ('staggered', args.alive_repeat, args.alive_spread)]:
+        sends = alive_send_times(devices, repeat, spread, args.interval, args.rounds)
+        windows = {}
+
+        for now, datagrams in sends:
+            windows[int(now // args.window)] = windows.get(int(now // args.window), 0) + datagrams
+
+        # computed, not measured: a round gets through unless every one of
+        # its copies is lost, taking the losses of the copies as independent
+        delivered = 1 - args.loss ** repeat
+
+        print('{:<24} {:>10d} {:>14d} {:>19.4%}'.format(name, sum(datagrams for now, datagrams in sends), max(windows.values()), delivered))
+
+def benchmark_scheduler(args):
+    random.seed(0)
+    clock = SimulatedClock()
+    timers = scheduler.Scheduler(clock=clock)
+    delays = [random.uniform(0, args.horizon) for _ in range(args.timers)]
+
+    started = time.perf_counter()
+    handles = [timers.call_later(delay, int) for delay in delays]
+    inserted = time.perf_counter()
+
+    for handle in handles[::2]:
+        handle.cancel()
+
+    cancelled = time.perf_counter()
+    fired = 0
+
+    while timers.next_time() is not None:
+        clock.now = timers.next_time()
+        fired += timers.run_due()
+
+    finished = time.perf_counter()
+    timers.close()
+
+    print('{:<10} {:>10.2f} us/timer'.format('insert', (inserted - started) / len(handles) * 1e6))
+    print('{:<10} {:>10.2f} us/timer'.format('cancel', (cancelled - inserted) / len(handles[::2]) * 1e6))
+    print('{:<10} {:>10.2f} us/timer ({:d} fired)'.format('fire', (finished - cancelled) / max(fired, 1) * 1e6, fired))
+
+class GatedHandler:
+    '''
+    Counts the datagrams of a burst. The first one holds up the receive loop
+    until the rest of the burst is queued, so draining it is timed alone.
+    '''
+    def __init__(self, burst):
+        self.burst = burst
+        self.handled = 0
+        self.holding = threading.Event()
+        self.gate = threading.Event()
+        self.drained = threading.Event()
+        self.started = self.finished = None
+
+    def handle(self, data, source_address):
+        if not self.gate.is_set():
+            self.holding.set()
+            self.gate.wait()
+            return
+
+        self.handled += 1
+
+        if self.handled == 1:
+            # timed from here, without the wakeup of the loop
+            self.started = time.perf_counter()
+        elif self.handled == self.burst:
+            self.finished = time.perf_counter()
+            self.drained.set()
+
+def far_timers(timers, count, horizon):
+    '''Schedules count timers due in the second half of horizon, like the alive rounds of count devices'''
+    rng = random.Random(0)
+
+    return [timers.call_later(rng.uniform(horizon / 2, horizon), int) for _ in range(count)]
+
+def wait_cost(timers, repeat):
+    '''Returns the seconds one Scheduler.wait() takes while a socket is readable'''
+    reader, writer = socket.socketpair()
+    writer.send(b'x')
+
+    try:
+        return min(timeit.repeat(lambda: timers.wait([reader]), number=100, repeat=repeat)) / 100
+    finally:
+        reader.close()
+        writer.close()
+
+def drain_rate(timers, args):
+    '''Returns the median rate in datagrams per second a MulticastServer handles bursts queued on its socket at'''
+    handler = None
+    mcast_server = network.MulticastServer(0x1000, handler, scheduler=timers)
+    mcast_server.start()
+
+    while not mcast_server.sockets:
+        time.sleep(0.01)
+
+    mcast_server.sockets[0].setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = ('127.0.0.1', args.port)
+    rates = []
+
+    try:
+        for i in range(args.repeat):
+            handler = mcast_server.handler = GatedHandler(args.burst)
+
+            sender.sendto(NOTIFY_ALIVE, address)
+            handler.holding.wait()
+
+            for j in range(args.burst):
+                sender.sendto(NOTIFY_ALIVE, address)
+
+            handler.gate.set()
+
+            if not handler.drained.wait(5):
+                sys.exit('Only {:d} of {:d} datagrams arrived, the receive buffer is too small for --burst'.format(handler.handled, args.burst))
+
+            rates.append((handler.handled - 1) / (handler.finished - handler.started))
+    finally:
+        mcast_server.join()
+        sender.close()
+
+    return sorted(rates)[len(rates) // 2]
+
+def benchmark_receive(args):
+    network.SSDP_PORT = args.port
+
+    print('{:<24} {:>9} {:>12}'.format('receive loop', 'wait us', 'handled/s'))
+
+    for name, timer_count in [('select', None), ('scheduler', 0), ('scheduler, {:d} timers'.format(args.timers), args.timers)]:
+        if timer_count is None:
+            timers = None
+            wait_us = float('nan')
+        else:
+            timers = scheduler.Scheduler()
+            far_timers(timers, timer_count, args.horizon)
+            wait_us = wait_cost(timers, 5) * 1e6
+
+        rate = drain_rate(timers, args)
+
+        if timers is not None:
+            timers.close()
+
+        print('{:<24} {:>9.2f} {:>12.0f}'.format(name, wait_us, rate))
+
+def fetch_devices(server, count, concurrency):
+    '''Fetches the descriptions of count synthetic devices like the troll does at startup'''
+    devices = []
+    device_discovery = discovery.SSDPDeviceDiscovery([server.url(index) for index in range(count)], max_workers=concurrency, on_device=devices.append)
+    device_discovery.run()
+
+    return devices
+
+def device_memory(count):
+    '''Returns the bytes retained per device by its description, the index and the rendered datagrams'''
+    network.set_default_sender(StubSender())
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+
+        devices = [ssdp.SSDPRemoteDevice('http://127.0.0.1/devices/{:d}/description.xml'.format(index), description_data=loadtest.description_document(index)) for index in range(count)]
+        target_index = ssdp.SSDPTargetIndex(devices)
+        notifier = ssdp.SSDPNotifier(target_index)
+        notifier.send_alive_datagrams(devices)
+        handler = ssdp.SSDPSearchRequestHandler(target_index)
+        handler.handle(msearch('ssdp:all'), ('127.0.0.1', 1))
+
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    return retained / count
+
+def search_targets(devices, kind):
+    if kind == 'device':
+        return [device.udn for device in devices]
+    if kind == 'type':
+        return sorted({profile[0] for profile in loadtest.DEVICE_PROFILES})
+
+    return [kind]
+
+def benchmark_scale_step(server, count, args):
+    started = time.perf_counter()
+    devices = fetch_devices(server, count, args.fetch_concurrency)
+    fetch_seconds = time.perf_counter() - started
+
+    # devices come online one by one, like from the discovery
+    started = time.perf_counter()
+    target_index = ssdp.SSDPTargetIndex()
+
+    for device in devices:
+        target_index.add(device)
+
+    index_seconds = time.perf_counter() - started
+
+    network.set_default_sender(network.SSDPSender('127.0.0.1'))
+    notifier = ssdp.SSDPNotifier(target_index)
+    alive_rounds = []
+
+    # the first round renders the datagrams, the later ones send them from the cache
+    for i in range(1 + args.rounds):
+        started = time.process_time()
+        notifier.send_alive_datagrams(target_index)
+        alive_rounds.append(time.process_time() - started)
+
+    timers = scheduler.Scheduler()
+    handler = ssdp.SSDPSearchRequestHandler(target_index, response_queue=timers, max_response_delay=args.mx)
+    mcast_server = network.MulticastServer(0x1000, handler, scheduler=timers)
+    mcast_server.start()
+
+    while not mcast_server.sockets:
+        time.sleep(0.01)
+
+    control_point = loadtest.ControlPoint(('127.0.0.1', network.SSDP_PORT), mx=args.mx)
+    control_point.search(search_targets(devices, args.search_target), args.rate, args.duration, args.mx + 1)
+
+    mcast_server.join()
+    timers.close()
+    control_point.close()
+    network.default_sender().close()
+
+    latencies = sorted(control_point.latencies) or [float('nan')]
+
+    return {
+        'devices': len(devices),
+        'fetch_per_second': len(devices) / fetch_seconds,
+        'index_seconds': index_seconds,
+        'bytes_per_device': device_memory(count),
+        'alive_datagrams': sum(len(device.target_usns) for device in devices),
+        'alive_cold_ms': alive_rounds[0] * 1000,
+        'alive_warm_ms': min(alive_rounds[1:] or alive_rounds) * 1000,
+        'searches': control_point.sent,
+        'answered': len(control_point.latencies) / max(control_point.sent, 1),
+        'replies_per_second': control_point.replies / args.duration,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+def benchmark_scale(args):
+    network.SSDP_PORT = args.port
+    server = loadtest.DescriptionServer()
+    server.start()
+
+    print('{:>7} {:>9} {:>8} {:>9} {:>9} {:>9} {:>9} {:>8} {:>9} {:>8} {:>8}'.format(
+        'devices', 'fetch/s', 'index s', 'KiB/dev', 'alive dg', 'cold ms', 'warm ms', 'answered', 'replies/s', 'p50 ms', 'p99 ms'))
+
+    try:
+        for count in args.devices:
+            result = benchmark_scale_step(server, count, args)
+
+            print('{devices:>7d} {fetch_per_second:>9.0f} {index_seconds:>8.2f} {kib_per_device:>9.1f} {alive_datagrams:>9d} {alive_cold_ms:>9.1f} '
+                '{alive_warm_ms:>9.1f} {answered:>8.1%} {replies_per_second:>9.0f} {p50_ms:>8.2f} {p99_ms:>8.2f}'.format(kib_per_device=result['bytes_per_device'] / 1024, **result))
+            sys.stdout.flush()
+    finally:
+        server.join()
+
+# sendmmsg(2) through ctypes, only used by "benchmark.py send" to show that
+# network.send_datagrams() is right to use a sendto() loop instead
+
+# the kernel refuses batches larger than UIO_MAXIOV
+SENDMMSG_MAX_BATCH = 1024
+
+# sys/uio.h
+class struct_iovec(Structure):
+    _fields_ = [
+        ('iov_base', c_void_p),
+        ('iov_len', c_size_t),]
+
+# sys/socket.h
+class struct_msghdr(Structure):
+    _fields_ = [
+        ('msg_name', c_void_p),
+        ('msg_namelen', c_uint32),
+        ('msg_iov', POINTER(struct_iovec)),
+        ('msg_iovlen', c_size_t),
+        ('msg_control', c_void_p),
+        ('msg_controllen', c_size_t),
+        ('msg_flags', c_int),]
+
+class struct_mmsghdr(Structure):
+    _fields_ = [
+        ('msg_hdr', struct_msghdr),
+        ('msg_len', c_uint),]
+
+_sendmmsg = None
+
+if os.name == 'posix':
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        _sendmmsg = None
+    else:
+        _sendmmsg.restype = c_int
+        _sendmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint, c_int]
+
+def have_sendmmsg():
+    return _sendmmsg is not None
+
+def pack_sockaddr(family, address):
+    '''Converts a Python sockaddr tuple into the C struct sockaddr bytes'''
+    if family == socket.AF_INET:
+        return (struct.pack('=H', family) + struct.pack('!H', address[1]) +
+            socket.inet_pton(family, address[0]) + b'\0' * 8)
+    elif family == socket.AF_INET6:
+        flowinfo = address[2] if len(address) > 2 else 0
+        scope_id = address[3] if len(address) > 3 else 0
+        return (struct.pack('=H', family) + struct.pack('!HI', address[1], flowinfo) +
+            socket.inet_pton(family, address[0]) + struct.pack('=I', scope_id))
+    else:
+        raise ValueError('Unsupported address family: {!r}'.format(family))
+
+def _sendmmsg_chunk(sock, messages):
+    count = len(messages)
+    headers = (struct_mmsghdr * count)()
+    iovecs = (struct_iovec * count)()
+    # the buffers must stay referenced until the call returns
+    buffers = []
+
+    for i, (address, data) in enumerate(messages):
+        name = create_string_buffer(pack_sockaddr(sock.family, address))
+        payload = create_string_buffer(data, len(data))
+        buffers.append((name, payload))
+
+        iovecs[i].iov_base = addressof(payload)
+        iovecs[i].iov_len = len(data)
+
+        hdr = headers[i].msg_hdr
+        hdr.msg_name = addressof(name)
+        hdr.msg_namelen = len(name) - 1
+        hdr.msg_iov = cast(addressof(iovecs[i]), POINTER(struct_iovec))
+        hdr.msg_iovlen = 1
+
+    sent = 0
+
+    while sent < count:
+        result = _sendmmsg(sock.fileno(), cast(addressof(headers[sent]), POINTER(struct_mmsghdr)), count - sent, 0)
+
+        if result == -1:
+            errno = get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        sent += result
+
+    return sent
+
+def sendmmsg(sock, messages):
+    '''Sends a list of (address, bytes) pairs on an unconnected datagram socket.
+
+    Uses as few sendmmsg() calls as possible, or one sendto() per datagram
+    when sendmmsg() is not available. Returns the number of datagrams sent.'''
+    messages = list(messages)
+
+    if _sendmmsg is None:
+        for address, data in messages:
+            sock.sendto(data, address)
+
+        return len(messages)
+
+    sent = 0
+
+    for start in range(0, len(messages), SENDMMSG_MAX_BATCH):
+        sent += _sendmmsg_chunk(sock, messages[start:start + SENDMMSG_MAX_BATCH])
+
+    return sent
+
+def benchmark_send(args):
+    '''Compares a sendto() loop with sendmmsg() sending batches over loopback'''
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    receiver.bind(('127.0.0.1', 0))
+    address = receiver.getsockname()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    data = ssdp.SSDPMessage().alive_datagram(synthetic_devices(1)[0], 'upnp:rootdevice', 'uuid:benchmark::upnp:rootdevice', 1800)
+
+    print('{:>6} {:>12} {:>12}{}'.format('batch', 'sendto us', 'sendmmsg us', '' if have_sendmmsg() else '  (no sendmmsg, both use sendto)'))
+
+    for batch in args.batch:
+        messages = [(address, data)] * batch
+        results = []
+
+        for function in (network.send_datagrams, sendmmsg):
+            best = None
+
+            for i in range(args.repeat):
+                started = time.perf_counter()
+                function(sender, messages)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+
+                # keep the receive buffer from filling up
+                receiver.setblocking(False)
+                try:
+                    while True:
+                        receiver.recv(0x1000)
+                except BlockingIOError:
+                    pass
+
+            results.append(best * 1e6)
+
+        print('{:>6d} {:>12.1f} {:>12.1f}'.format(batch, *results))
+
+    sender.close()
+    receiver.close()
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmarks for the SSDP request path')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_parser = subparsers.add_parser('parser', help='Compare the generic HTTP parser with the SSDP fast path')
+    parser_parser.add_argument('--size', type=int, default=10000, help='Number of datagrams in the corpus')
+    parser_parser.add_argument('--search-ratio', type=float, default=0.05, help='Share of M-SEARCH datagrams in the corpus')
+    parser_parser.add_argument('--repeat', type=int, default=5)
+    parser_parser.set_defaults(function=benchmark_parser)
+
+    description_parser = subparsers.add_parser('description', help='Compare the traced peak memory of the streaming description parser with ET.fromstring')
+    description_parser.add_argument('--embedded-devices', type=int, default=400, help='Number of embedded devices in the generated description')
+    description_parser.add_argument('--repeat', type=int, default=5)
+    description_parser.set_defaults(function=benchmark_description)
+
+    replay_parser = subparsers.add_parser('replay', help='Replay datagram corpora through SSDPSearchRequestHandler.handle with delayed replies on a simulated clock')
+    replay_parser.add_argument('--corpus', action='append', choices=sorted(CORPORA), help='Synthetic corpus to replay, may be repeated (default: all)')
+    replay_parser.add_argument('--corpus-file', help='Recorded corpus, one JSON object with base64 "data" per line')
+    replay_parser.add_argument('--size', type=int, default=10000, help='Number of datagrams in each synthetic corpus')
+    replay_parser.add_argument('--search-ratio', type=float, default=0.05, help='Share of M-SEARCH datagrams in the notify-heavy corpus')
+    replay_parser.add_argument('--devices', type=int, default=4, help='Number of synthetic remote devices answering searches')
+    replay_parser.add_argument('--sources', type=int, default=64, help='Number of distinct source addresses')
+    replay_parser.add_argument('--rate-limit', action='store_true', help='Enable the default M-SEARCH rate limiter')
+    replay_parser.add_argument('--message-rate', type=float, default=1000, help='Datagrams per second of simulated time, sets how many replies are pending and coalesced')
+    replay_parser.add_argument('--repeat', type=int, default=3)
+    replay_parser.add_argument('--allocation-size', type=int, default=1000, help='Number of datagrams traced for allocation statistics')
+    replay_parser.add_argument('--baseline', help='Compare with the results stored in this file and fail on regressions, e.g. replay-baseline.json')
+    replay_parser.add_argument('--save-baseline', help='Store the results in this file, with the machine and the parameters they were measured with')
+    replay_parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative regression against the baseline')
+    replay_parser.set_defaults(function=benchmark_replay)
+
+    advertise_parser = subparsers.add_parser('advertise', help='Compare the peak packet rate of back to back and staggered alive rounds')
+    advertise_parser.add_argument('--devices', type=int, default=200, help='Number of synthetic remote devices')
+    advertise_parser.add_argument('--interval', type=float, default=1800, help='Notification interval in seconds')
+    advertise_parser.add_argument('--rounds', type=int, default=3, help='Number of notification intervals simulated')
+    advertise_parser.add_argument('--alive-repeat', type=int, default=2)
+    advertise_parser.add_argument('--alive-spread', type=float, default=10)
+    advertise_parser.add_argument('--window', type=float, default=0.1, help='Window in seconds the peak packet rate is measured over')
+    advertise_parser.add_argument('--loss', type=float, default=0.05, help='Assumed probability that a single datagram is lost, the delivery rate is computed from it')
+    advertise_parser.set_defaults(function=benchmark_advertise)
+
+    scheduler_parser = subparsers.add_parser('scheduler', help='Measure inserting, cancelling and firing timers on the timing wheel')
+    scheduler_parser.add_argument('--timers', type=int, default=100000)
+    scheduler_parser.add_argument('--horizon', type=float, default=3600, help='Timers are due within this many seconds')
+    scheduler_parser.set_defaults(function=benchmark_scheduler)
+
+    receive_parser = subparsers.add_parser('receive', help='Compare how fast the receive loop drains queued datagrams on plain select() and driving the scheduler')
+    receive_parser.add_argument('--timers', type=int, default=200, help='Number of far timers, like the alive rounds of as many devices')
+    receive_parser.add_argument('--horizon', type=float, default=1800, help='The timers are due within this many seconds')
+    receive_parser.add_argument('--burst', type=int, default=2000, help='Datagrams queued before the loop drains them, must fit into the receive buffer')
+    receive_parser.add_argument('--repeat', type=int, default=21, help='Number of bursts, the median rate is reported')
+    receive_parser.add_argument('--port', type=int, default=19000, help='UDP port the receive loop listens on instead of 1900')
+    receive_parser.set_defaults(function=benchmark_receive)
+
+    scale_parser = subparsers.add_parser('scale', help='Fetch, index, advertise and answer searches for growing numbers of synthetic devices over loopback')
+    scale_parser.add_argument('--devices', type=lambda value: [int(count) for count in value.split(',')], default=[100, 1000, 5000], help='Comma separated device counts to measure')
+    scale_parser.add_argument('--fetch-concurrency', type=int, default=16, help='Number of descriptions fetched in parallel')
+    scale_parser.add_argument('--rounds', type=int, default=3, help='Alive rounds sent after the first one')
+    scale_parser.add_argument('--search-target', default='device', help='What the control point searches for: "device" for the UDN of a random device, "type" for a random device type, or a literal search target like ssdp:all')
+    scale_parser.add_argument('--rate', type=float, default=200, help='M-SEARCH requests per second sent by the control point')
+    scale_parser.add_argument('--duration', type=float, default=5, help='Seconds the control point searches for')
+    scale_parser.add_argument('--mx', type=int, default=0, help='MX of the searches, 0 measures the response path without the random delay')
+    scale_parser.add_argument('--port', type=int, default=19000, help='UDP port the troll listens on instead of 1900')
+    scale_parser.set_defaults(function=benchmark_scale)
+
+    send_parser = subparsers.add_parser('send', help='Compare a sendto() loop with sendmmsg() through ctypes over loopback')
+    send_parser.add_argument('--batch', type=lambda value: [int(size) for size in value.split(',')], default=[1, 6, 22, 200], help='Comma separated numbers of datagrams sent at once')
+    send_parser.add_argument('--repeat', type=int, default=200)
+    send_parser.set_defaults(function=benchmark_send)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    args.function(args)
@@ -0,0 +1,82 @@
+'''
+The UPnP 1.1 BOOTID.UPNP.ORG and CONFIGID.UPNP.ORG values.
+
+Control points that remember a device only fetch its description again when
+the BOOTID or CONFIGID in its announcements changes, so both have to stay the
+same for as long as the troll and the device description do.
+'''
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+
+logger = logging.getLogger()
+
+# UPnP Device Architecture 1.1, 1.2: BOOTID is a non-negative 31 bit integer,
+# CONFIGID values above 2 ** 24 - 1 are reserved
+MAX_BOOT_ID = 0x7fffffff
+MAX_CONFIG_ID = 0xffffff
+
+def config_id(description_data):
+    '''Derives the CONFIGID of a device from its description document'''
+    return int.from_bytes(hashlib.sha1(description_data).digest()[:3], 'big') & MAX_CONFIG_ID
+
+class SSDPBootState:
+    '''
+    The BOOTID of the troll, increased on every start and on every change of
+    the multicast interfaces.
+
+    With a path the last boot id is kept in that file, otherwise the first
+    one is taken from the clock so it still increases from one run to the
+    next. The value lives in shared memory, so worker processes see an
+    increase made by the parent.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.value = multiprocessing.RawValue('l', (self.load() + 1) & MAX_BOOT_ID)
+
+        self.save()
+
+    @property
+    def boot_id(self):
+        return self.value.value
+
+    @property
+    def next_boot_id(self):
+        return (self.boot_id + 1) & MAX_BOOT_ID
+
+    def load(self):
+        '''Returns the boot id the last run used'''
+        if self.path is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    return int(f.read().strip())
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                logger.warning('Ignoring unusable boot id file %s: %s', self.path, e)
+
+        return int(time.time())
+
+    def save(self):
+        if self.path is None:
+            return
+
+        try:
+            # replace atomically so a crash never leaves a truncated boot id behind
+            with open(self.path + '.tmp', 'w') as f:
+                f.write('{:d}\n'.format(self.boot_id))
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            logger.warning('Failed to store boot id in %s: %s', self.path, e)
+
+    def advance(self):
+        '''Moves on to the next boot id and returns it'''
+        self.value.value = self.next_boot_id
+        self.save()
+
+        logger.info('Boot id is now %d', self.boot_id)
+
+        return self.boot_id
@@ -0,0 +1,243 @@
+'''
+Bridges SSDP announcements between two segments.
+
+On one segment a relay follows the NOTIFY traffic recorded by the notify
+registry and forwards alive and byebye notifications to a peer over unicast
+UDP, but only when the state of a USN changes or the peer would otherwise let
+it expire. On the other segment the peer brings the announced devices online
+the same way devices given on the command line are, so it re-advertises them
+and answers searches for them.
+'''
+
+import concurrent.futures
+import logging
+import select
+import socket
+import threading
+import time
+import metrics
+import network
+import registry
+import ssdp
+
+logger = logging.getLogger()
+
+def parse_peer_address(peer_address):
+    '''Resolves host:port (or [v6 address]:port) into a sockaddr tuple'''
+    host, _, port = peer_address.rpartition(':')
+
+    if not host:
+        raise ValueError('Bridge peer {!r} has no port'.format(peer_address))
+
+    return socket.getaddrinfo(host.strip('[]'), int(port), type=socket.SOCK_DGRAM)[0][4]
+
+class SSDPBridgeRelay:
+    '''
+    Forwards the alive and byebye notifications recorded by a notify
+    registry to the bridge peer, deduplicated by USN.
+
+    An alive is relayed when its USN is new or its NT, LOCATION or SERVER
+    changed, and otherwise only once refresh_fraction of its max-age passed
+    since it was last relayed, so the peer does not let it expire. A byebye
+    is relayed if its USN was known.
+
+    Notifications of the devices this troll advertises itself, the USNs in
+    target_index, are not relayed, so two bridges pointing at each other do
+    not loop. Their byebyes carry no SERVER header and may come after the
+    device left the index, so the USNs of the alives skipped that way are
+    remembered until their byebye. Alives with the SERVER of a troll are
+    not relayed either.
+
+    notified() is meant to be the on_notify callback of the registry.
+    '''
+    def __init__(self, peer_address, refresh_fraction=0.5, target_index=None):
+        self.peer_address = peer_address
+        self.refresh_fraction = refresh_fraction
+        self.target_index = target_index
+        # USNs of alives skipped as our own
+        self.own_usns = set()
+
+        self.sock = socket.socket(socket.AF_INET6 if len(peer_address) == 4 else socket.AF_INET, socket.SOCK_DGRAM)
+
+    def is_own(self, notify):
+        '''Returns whether a NOTIFY was sent by this troll'''
+        if notify.is_byebye():
+            if notify.usn in self.own_usns:
+                self.own_usns.discard(notify.usn)
+                return True
+
+            return self.target_index is not None and self.target_index.announces(notify.usn)
+
+        if self.target_index is not None and self.target_index.announces(notify.usn):
+            self.own_usns.add(notify.usn)
+            return True
+
+        return False
+
+    def notified(self, data, notify, entry, state):
+        if notify.server == ssdp.SSDPMessage.SERVER_INFORMATION or self.is_own(notify):
+            return
+
+        now = time.monotonic()
+
+        if state is None:
+            metrics.bridge_deduplicated.inc()
+            return
+
+        if state == registry.SSDPNotifyRegistry.REFRESHED and entry.relayed is not None and now - entry.relayed < entry.max_age * self.refresh_fraction:
+            metrics.bridge_deduplicated.inc()
+            return
+
+        entry.relayed = now
+
+        try:
+            self.sock.sendto(data, self.peer_address)
+        except OSError as e:
+            metrics.send_errors.inc()
+            logger.warning('Failed to relay NOTIFY to bridge peer %s: %s', network.pretty_sockaddr(self.peer_address), e)
+            return
+
+        metrics.bridge_relayed.inc(label_value=notify.nts)
+
+        logger.debug('Relayed %s for %s to bridge peer', notify.nts, notify.usn)
+
+def create_notify_registry(bridge_to=None, target_index=None):
+    '''Returns a notify registry, relaying to the bridge peer at the bridge_to sockaddr if given
+
+    Meant as notify listener factory of a troll, which passes its target
+    index so the notifications of its own devices are not relayed.'''
+    if bridge_to is None:
+        return registry.SSDPNotifyRegistry()
+
+    return registry.SSDPNotifyRegistry(on_notify=SSDPBridgeRelay(bridge_to, target_index=target_index).notified)
+
+class SSDPBridgePeer(threading.Thread):
+    '''
+    Receives the notifications relayed by a bridge peer and brings their
+    devices online on this segment.
+
+    A device is identified by its LOCATION. Its description is fetched on
+    the first alive for it, and it goes offline on a byebye for any of its
+    USNs or once the max-age of all of them ran out. The receive loop wakes
+    up for the next expiry time of the registry, not periodically.
+    '''
+    def __init__(self, port, peer_host=None, address='', description_cache=None, timeout=10, max_workers=4, on_device=None, on_device_removed=None):
+        super(SSDPBridgePeer, self).__init__(daemon=True)
+
+        self.peer_hosts = None if peer_host is None else {info[4][0] for info in socket.getaddrinfo(peer_host, None, type=socket.SOCK_DGRAM)}
+        self.description_cache = description_cache
+        self.timeout = timeout
+        self.on_device = on_device
+        self.on_device_removed = on_device_removed
+        self.registry = registry.SSDPNotifyRegistry()
+
+        self.lock = threading.Lock()
+        # location -> device, or None while its description is being fetched
+        self.devices = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.stop_reader, self.stop_writer = socket.socketpair()
+
+    def run(self):
+        logger.info('Listening for relayed NOTIFYs on %s', network.pretty_sockaddr(self.sock.getsockname()))
+
+        while True:
+            next_expiry = self.registry.next_expiry()
+            timeout = None if next_expiry is None else max(next_expiry - time.monotonic(), 0)
+
+            readset = select.select([self.sock, self.stop_reader], [], [], timeout)[0]
+
+            if self.stop_reader in readset:
+                break
+
+            if self.sock in readset:
+                data, source_address = self.sock.recvfrom(0x1000)
+
+                if self.peer_hosts is not None and source_address[0] not in self.peer_hosts:
+                    logger.debug('Ignoring relayed datagram from unknown peer %s', network.pretty_sockaddr(source_address))
+                else:
+                    try:
+                        self.handle(data)
+                    except Exception:
+                        logger.exception('Failed to handle relayed datagram')
+
+            self.expire()
+
+        self.executor.shutdown(wait=False)
+        self.sock.close()
+
+    def handle(self, data):
+        notify = ssdp.SSDPNotify.from_bytes(data)
+
+        if notify is None or notify.usn is None or notify.location is None and notify.is_alive():
+            return
+
+        if notify.is_alive():
+            self.registry.alive(notify)
+
+            with self.lock:
+                if notify.location in self.devices:
+                    return
+
+                self.devices[notify.location] = None
+
+            self.executor.submit(self.bring_online, notify.location)
+        elif notify.is_byebye():
+            entry = self.registry.byebye(notify.usn)
+
+            if entry is not None:
+                self.take_offline(entry.location)
+
+    def expire(self):
+        expired = self.registry.expire()
+
+        if not expired:
+            return
+
+        locations = self.registry.locations()
+
+        for location in {entry.location for entry in expired} - locations:
+            logger.info('Relayed device at %s expired', location)
+
+            self.take_offline(location)
+
+    def bring_online(self, location):
+        try:
+            device = ssdp.SSDPRemoteDevice(location, self.description_cache, self.timeout)
+        except Exception as e:
+            logger.warning('Failed to bring relayed device at %s online: %s', location, e)
+
+            with self.lock:
+                self.devices.pop(location, None)
+            return
+
+        with self.lock:
+            if location not in self.devices:
+                # it said byebye while its description was being fetched
+                return
+
+            self.devices[location] = device
+
+        logger.info('Relayed device %s online', device)
+
+        if self.on_device is not None:
+            self.on_device(device)
+
+    def take_offline(self, location):
+        with self.lock:
+            device = self.devices.pop(location, None)
+
+        if device is None:
+            return
+
+        logger.info('Relayed device %s offline', device)
+
+        if self.on_device_removed is not None:
+            self.on_device_removed(device)
+
+    def join(self, timeout=None):
+        self.stop_writer.send(b'\0')
+
+        super(SSDPBridgePeer, self).join(timeout)
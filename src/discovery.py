@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+import concurrent.futures
+import ssdp
+
+logger = logging.getLogger()
+
+class SSDPDeviceDiscovery(threading.Thread):
+    '''
+    Fetches and parses the descriptions of remote SSDP devices concurrently
+    with a bounded pool.
+
+    on_device is called with each device as soon as its description is
+    available, so devices come online in the order their fetches complete
+    and a slow or dead host never holds back the healthy ones. Devices set
+    up from the description cache are revalidated right after they come
+    online, and on_device_changed is called if their description changed.
+    '''
+    def __init__(self, description_urls, description_cache=None, timeout=10, max_workers=8, on_device=None, on_device_changed=None):
+        super(SSDPDeviceDiscovery, self).__init__(daemon=True)
+
+        self.description_urls = list(description_urls)
+        self.description_cache = description_cache
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.on_device = on_device
+        self.on_device_changed = on_device_changed
+
+        # (url, fetch latency, parse latency, error) per description URL, in completion order
+        self.report = []
+
+    def create_device(self, description_url):
+        return ssdp.SSDPRemoteDevice(description_url, self.description_cache, self.timeout)
+
+    def run(self):
+        started = time.monotonic()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.create_device, url): url for url in self.description_urls}
+
+            for future in concurrent.futures.as_completed(futures):
+                url = futures[future]
+
+                try:
+                    device = future.result()
+                except Exception as e:
+                    logger.warning('Failed to discover device at %s: %s', url, e)
+
+                    self.report.append((url, None, None, e))
+                    continue
+
+                logger.info('Discovered %s', device)
+
+                self.report.append((url, device.fetch_latency, device.parse_latency, None))
+
+                if self.on_device is not None:
+                    try:
+                        self.on_device(device)
+                    except Exception:
+                        logger.exception('Failed to bring %s online', device)
+
+                if device.fetch_latency is None:
+                    executor.submit(self.refresh_device, device)
+
+        self.log_report(time.monotonic() - started)
+
+    def refresh_device(self, device):
+        try:
+            changed = device.revalidate()
+        except Exception as e:
+            logger.warning('Failed to revalidate cached description of %s: %s', device, e)
+            return
+
+        if changed and self.on_device_changed is not None:
+            self.on_device_changed(device)
+
+    def log_report(self, elapsed):
+        def milliseconds(latency):
+            # devices loaded from the description cache have no fetch latency
+            return '-' if latency is None else '{:.1f} ms'.format(latency * 1000)
+
+        logger.info('Device discovery finished in %.3f s: %d of %d devices online',
+            elapsed, sum(1 for entry in self.report if entry[3] is None), len(self.description_urls))
+
+        for url, fetch_latency, parse_latency, error in self.report:
+            if error is None:
+                logger.info('  %s fetch %s, parse %s', url, milliseconds(fetch_latency), milliseconds(parse_latency))
+            else:
+                logger.info('  %s failed: %s', url, error)
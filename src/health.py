@@ -0,0 +1,188 @@
+'''
+Probes the description URLs of the remote devices, so the troll stops
+advertising devices whose server went away and brings them back once it
+answers again.
+'''
+
+import concurrent.futures
+import http.client
+import logging
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import metrics
+import scheduler
+
+logger = logging.getLogger()
+
+def probe(url, timeout=5):
+    '''Raises OSError or HTTPException unless the server answers a request for the URL with a success status
+
+    Asks with HEAD, and with a GET that is closed after the headers if the
+    server does not implement HEAD.'''
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method='HEAD'), timeout=timeout):
+            return
+    except urllib.error.HTTPError as e:
+        if e.code not in (405, 501):
+            raise
+
+    with urllib.request.urlopen(url, timeout=timeout):
+        pass
+
+class SSDPDeviceHealth:
+    '''
+    The probe state of one device.
+    '''
+
+    __slots__ = 'device', 'healthy', 'failures', 'handle'
+
+    def __init__(self, device):
+        self.device = device
+        self.healthy = True
+        # failed probes in a row
+        self.failures = 0
+        # timer of the next probe
+        self.handle = None
+
+class SSDPHealthChecker:
+    '''
+    Probes the description URL of every device every interval seconds.
+
+    Once failures probes in a row failed, on_unhealthy is called with the
+    device, and the first probe that succeeds after that calls on_healthy.
+    Failed probes are retried after retry_interval seconds, doubled with
+    every failure up to max_backoff, so a dead server costs little.
+
+    The timers run on a scheduler.Scheduler thread and the probes on a
+    thread pool, so a server that hangs delays nothing but its own probe.
+    The callbacks are called from the pool. Devices are keyed by their
+    description URL: adding a device fetched again for a URL replaces the
+    one probed before.
+    '''
+    def __init__(self, interval=60, timeout=5, failures=3, retry_interval=5, max_backoff=600, max_workers=4, on_unhealthy=None, on_healthy=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.failures = max(failures, 1)
+        self.retry_interval = retry_interval
+        self.max_backoff = max_backoff
+        self.on_unhealthy = on_unhealthy
+        self.on_healthy = on_healthy
+
+        self.lock = threading.Lock()
+        # description url -> SSDPDeviceHealth
+        self.states = {}
+        self.scheduler = scheduler.Scheduler()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.running = True
+
+    def start(self):
+        logger.info('Probing device descriptions every %r seconds', self.interval)
+
+        metrics.unhealthy_devices.callback = lambda: len(self.unhealthy())
+
+        self.scheduler.start()
+
+    def add(self, device):
+        '''Starts probing a device, within the next interval'''
+        state = SSDPDeviceHealth(device)
+
+        with self.lock:
+            previous = self.states.get(device.description_url)
+
+            if previous is not None:
+                previous.handle.cancel()
+
+            self.states[device.description_url] = state
+            self.schedule(state, random.uniform(0, self.interval))
+
+    def remove(self, device):
+        with self.lock:
+            state = self.states.get(device.description_url)
+
+            if state is None or state.device is not device:
+                return
+
+            del self.states[device.description_url]
+            state.handle.cancel()
+
+    def unhealthy(self):
+        '''Returns the devices currently considered unhealthy'''
+        with self.lock:
+            return [state.device for state in self.states.values() if not state.healthy]
+
+    def __contains__(self, device):
+        with self.lock:
+            state = self.states.get(device.description_url)
+
+        return state is not None and state.device is device
+
+    def schedule(self, state, delay):
+        # jittered so the probes of devices added together drift apart
+        state.handle = self.scheduler.call_later(delay * random.uniform(1, 1.1), self.submit, state)
+
+    def submit(self, state):
+        with self.lock:
+            if not self.running or self.states.get(state.device.description_url) is not state:
+                return
+
+            self.executor.submit(self.check, state)
+
+    def check(self, state):
+        device = state.device
+        started = time.monotonic()
+
+        try:
+            probe(device.description_url, self.timeout)
+        except (OSError, http.client.HTTPException) as e:
+            error = e
+        else:
+            error = None
+
+        metrics.probe_seconds.observe(time.monotonic() - started)
+        metrics.probes.inc(label_value='failed' if error else 'ok')
+
+        with self.lock:
+            if not self.running or self.states.get(device.description_url) is not state:
+                # removed or replaced while the probe ran
+                return
+
+            if error is None:
+                changed = not state.healthy
+                state.healthy = True
+                state.failures = 0
+
+                self.schedule(state, self.interval)
+            else:
+                state.failures += 1
+                changed = state.healthy and state.failures >= self.failures
+                state.healthy = state.healthy and not changed
+
+                logger.debug('Probe %d of %s failed: %s', state.failures, device, error)
+
+                self.schedule(state, min(self.retry_interval * 2 ** min(state.failures - 1, 32), self.max_backoff))
+
+            if not changed:
+                return
+
+            # still under the lock, so a device removed meanwhile does not come back
+            if state.healthy:
+                logger.info('Device %s answers again', device)
+
+                if self.on_healthy is not None:
+                    self.on_healthy(device)
+            else:
+                logger.warning('Device %s failed %d probes in a row, last: %s', device, state.failures, error)
+
+                if self.on_unhealthy is not None:
+                    self.on_unhealthy(device)
+
+    def join(self, timeout=None):
+        with self.lock:
+            self.running = False
+
+        self.scheduler.join(timeout)
+        self.scheduler.close()
+        self.executor.shutdown(wait=False)
@@ -1,5 +1,9 @@
 import urllib.parse
 import itertools
+import logging
+import time
+
+logger = logging.getLogger()
 
 class HTTPMessage:
     def __init__(self, first_line, headers, body):
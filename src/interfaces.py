@@ -0,0 +1,241 @@
+'''
+Enumerates the local network interfaces through the C getifaddrs call and
+follows changes to them through an rtnetlink subscription.
+
+The ctypes bindings are taken from original/getifaddrs.py.
+'''
+
+from ctypes import (
+    Structure, Union, POINTER,
+    pointer, get_errno, cast,
+    c_ushort, c_byte, c_void_p, c_char_p, c_uint, c_int, c_uint16, c_uint32
+)
+import collections
+import ctypes.util
+import ctypes
+import logging
+import os
+import select
+import socket
+import threading
+
+logger = logging.getLogger()
+
+# net/if.h
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_MULTICAST = 0x1000
+
+# linux/rtnetlink.h
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+MONITORED_GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR
+
+# sys/socket.h
+sa_family_t = c_ushort
+
+class struct_sockaddr(Structure):
+    _fields_ = [
+        ('sa_family', c_ushort),
+        ('sa_data', c_byte * 14),]
+
+# netinet/in.h
+struct_in_addr = c_byte * 4
+
+class struct_sockaddr_in(Structure):
+    _fields_ = [
+        ('sin_family', sa_family_t),
+        ('sin_port', c_uint16),
+        ('sin_addr', struct_in_addr)]
+
+struct_in6_addr = c_byte * 16
+
+class struct_sockaddr_in6(Structure):
+    _fields_ = [
+        ('sin6_family', c_ushort),
+        ('sin6_port', c_uint16),
+        ('sin6_flowinfo', c_uint32),
+        ('sin6_addr', struct_in6_addr),
+        ('sin6_scope_id', c_uint32)]
+
+# ifaddrs.h
+class union_ifa_ifu(Union):
+    _fields_ = [
+        ('ifu_broadaddr', POINTER(struct_sockaddr)),
+        ('ifu_dstaddr', POINTER(struct_sockaddr)),]
+
+class struct_ifaddrs(Structure):
+    pass
+struct_ifaddrs._fields_ = [
+    ('ifa_next', POINTER(struct_ifaddrs)),
+    ('ifa_name', c_char_p),
+    ('ifa_flags', c_uint),
+    ('ifa_addr', POINTER(struct_sockaddr)),
+    ('ifa_netmask', POINTER(struct_sockaddr)),
+    ('ifa_ifu', union_ifa_ifu),
+    ('ifa_data', c_void_p),]
+
+_getifaddrs = None
+
+if os.name == 'posix':
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _getifaddrs = libc.getifaddrs
+    _getifaddrs.restype = c_int
+    _getifaddrs.argtypes = [POINTER(POINTER(struct_ifaddrs))]
+    _freeifaddrs = libc.freeifaddrs
+    _freeifaddrs.restype = None
+    _freeifaddrs.argtypes = [POINTER(struct_ifaddrs)]
+
+Interface = collections.namedtuple('Interface', 'name index family address flags')
+
+def ifap_iter(ifap):
+    '''Iterate over linked list of ifaddrs'''
+    ifa = ifap.contents
+    while True:
+        yield ifa
+        if not ifa.ifa_next:
+            break
+        ifa = ifa.ifa_next.contents
+
+def pythonize_sockaddr(sa):
+    '''Convert ctypes Structure of sockaddr into the Python tuple used in the socket module'''
+    family = sa.sa_family
+    if family == socket.AF_INET:
+        sa = cast(pointer(sa), POINTER(struct_sockaddr_in)).contents
+        addr = (
+            socket.inet_ntop(family, bytes(sa.sin_addr)),
+            socket.ntohs(sa.sin_port))
+    elif family == socket.AF_INET6:
+        sa = cast(pointer(sa), POINTER(struct_sockaddr_in6)).contents
+        addr = (
+            socket.inet_ntop(family, bytes(sa.sin6_addr)),
+            socket.ntohs(sa.sin6_port),
+            socket.ntohl(sa.sin6_flowinfo),
+            sa.sin6_scope_id)
+    else:
+        addr = None
+    return family, addr
+
+def getifaddrs():
+    '''Wraps the C getifaddrs call, returns a list of Interface tuples with an address'''
+    if _getifaddrs is None:
+        raise OSError('getifaddrs is not available on this platform')
+
+    ifap = POINTER(struct_ifaddrs)()
+    result = _getifaddrs(pointer(ifap))
+    if result == -1:
+        errno = get_errno()
+        raise OSError(errno, os.strerror(errno))
+    try:
+        retval = []
+        if not ifap:
+            return retval
+        for ifa in ifap_iter(ifap):
+            if not ifa.ifa_addr:
+                continue
+            family, addr = pythonize_sockaddr(ifa.ifa_addr.contents)
+            if addr is None:
+                continue
+            name = ifa.ifa_name.decode('utf-8', 'replace')
+            try:
+                index = socket.if_nametoindex(name)
+            except OSError:
+                # the interface went away while we were looking at it
+                continue
+            retval.append(Interface(name, index, family, addr, ifa.ifa_flags))
+        return retval
+    finally:
+        _freeifaddrs(ifap)
+
+def multicast_interfaces(family=socket.AF_INET):
+    '''Returns the interfaces that are up, multicast capable and not loopback'''
+    wanted = IFF_UP | IFF_MULTICAST
+
+    return [
+        interface for interface in getifaddrs()
+        if interface.family == family and interface.flags & wanted == wanted and not interface.flags & IFF_LOOPBACK
+    ]
+
+def multicast_addresses(ipv6_groups=()):
+    '''Returns the IPv4 addresses of the multicast capable interfaces
+
+    They are followed by each of the given IPv6 groups scoped to every
+    multicast capable interface with IPv6, like ff02::c%eth0.'''
+    addresses = sorted({interface.address[0] for interface in multicast_interfaces(socket.AF_INET)})
+
+    if ipv6_groups:
+        names = sorted({interface.name for interface in multicast_interfaces(socket.AF_INET6)})
+        addresses.extend('{}%{}'.format(group, name) for group in ipv6_groups for name in names)
+
+    return addresses
+
+def have_getifaddrs():
+    return _getifaddrs is not None
+
+def have_netlink():
+    return hasattr(socket, 'AF_NETLINK')
+
+class InterfaceMonitor:
+    '''
+    Subscribes to rtnetlink link and address notifications.
+
+    The messages themselves are not decoded; any notification means the
+    interfaces are enumerated again and compared with what was there before.
+    '''
+    def __init__(self, groups=MONITORED_GROUPS):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.sock.bind((0, groups))
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def drain(self):
+        '''Reads all pending notifications, returns True if there were any'''
+        changed = False
+
+        while True:
+            try:
+                self.sock.recv(0x10000)
+            except (BlockingIOError, InterruptedError):
+                return changed
+            except OSError as e:
+                # ENOBUFS: notifications were lost, which still means something changed
+                logger.debug('Lost rtnetlink notifications: %s', e)
+
+            changed = True
+
+    def close(self):
+        self.sock.close()
+
+class InterfaceMonitorThread(threading.Thread):
+    '''
+    Calls on_change whenever rtnetlink reports an interface or address change.
+    '''
+    def __init__(self, on_change, groups=MONITORED_GROUPS):
+        super(InterfaceMonitorThread, self).__init__(daemon=True)
+
+        self.on_change = on_change
+        self.monitor = InterfaceMonitor(groups)
+        self.stop_reader, self.stop_writer = socket.socketpair()
+
+    def run(self):
+        while True:
+            readset = select.select([self.monitor, self.stop_reader], [], [])[0]
+
+            if self.stop_reader in readset:
+                break
+
+            if self.monitor.drain():
+                try:
+                    self.on_change()
+                except Exception:
+                    logger.exception('Failed to handle interface change')
+
+        self.monitor.close()
+
+    def join(self, timeout=None):
+        self.stop_writer.send(b'\0')
+
+        super(InterfaceMonitorThread, self).join(timeout)
@@ -0,0 +1,273 @@
+'''
+Synthetic devices and a simulated control point for scale testing the troll.
+
+The descriptions are generated on request from the device index, in the
+shapes real media servers, renderers, gateways and DIAL receivers use, and
+served by an in-process HTTP server standing in for the remote devices.
+'''
+
+import http.server
+import logging
+import random
+import re
+import select
+import socket
+import threading
+import time
+import xml.sax.saxutils
+
+logger = logging.getLogger()
+
+# (device type, service types, embedded devices as (device type, service types, embedded devices))
+DEVICE_PROFILES = [
+    ('urn:schemas-upnp-org:device:MediaServer:1', [
+        'urn:schemas-upnp-org:service:ContentDirectory:1',
+        'urn:schemas-upnp-org:service:ConnectionManager:1',
+        'urn:microsoft.com:service:X_MS_MediaReceiverRegistrar:1',
+    ], []),
+    ('urn:schemas-upnp-org:device:MediaRenderer:1', [
+        'urn:schemas-upnp-org:service:AVTransport:1',
+        'urn:schemas-upnp-org:service:RenderingControl:1',
+        'urn:schemas-upnp-org:service:ConnectionManager:1',
+    ], []),
+    ('urn:schemas-upnp-org:device:InternetGatewayDevice:1', [
+        'urn:schemas-upnp-org:service:Layer3Forwarding:1',
+    ], [
+        ('urn:schemas-upnp-org:device:WANDevice:1', [
+            'urn:schemas-upnp-org:service:WANCommonInterfaceConfig:1',
+        ], [
+            ('urn:schemas-upnp-org:device:WANConnectionDevice:1', [
+                'urn:schemas-upnp-org:service:WANIPConnection:1',
+            ], []),
+        ]),
+    ]),
+    ('urn:dial-multiscreen-org:device:dial:1', [
+        'urn:dial-multiscreen-org:service:dial:1',
+    ], []),
+]
+
+MANUFACTURERS = ['Acme', 'Initech', 'Globex', 'Umbrella', 'Hooli', 'Vandelay']
+
+def device_udn(index, embedded=0):
+    return 'uuid:5ca1ab1e-{:04x}-4000-8000-{:012x}'.format(embedded, index)
+
+def device_profile(index):
+    return DEVICE_PROFILES[index % len(DEVICE_PROFILES)]
+
+def device_element(index, profile, rng, embedded=0, indent='  '):
+    device_type, service_types, embedded_profiles = profile
+    name = device_type.split(':')[-2]
+    lines = [
+        indent + '<device>',
+        indent + '  <deviceType>{}</deviceType>'.format(device_type),
+        indent + '  <friendlyName>{} {:d}</friendlyName>'.format(xml.sax.saxutils.escape(name), index),
+        indent + '  <manufacturer>{}</manufacturer>'.format(rng.choice(MANUFACTURERS)),
+        indent + '  <manufacturerURL>http://www.example.com/</manufacturerURL>',
+        indent + '  <modelName>{} {:d}</modelName>'.format(name, rng.randint(100, 999)),
+        indent + '  <modelNumber>{:d}.{:d}</modelNumber>'.format(rng.randint(1, 9), rng.randint(0, 99)),
+        indent + '  <serialNumber>{:016x}</serialNumber>'.format(rng.getrandbits(64)),
+        indent + '  <UDN>{}</UDN>'.format(device_udn(index, embedded)),
+        indent + '  <iconList>',
+    ]
+
+    for size in (48, 120):
+        lines.extend([
+            indent + '    <icon>',
+            indent + '      <mimetype>image/png</mimetype><width>{0:d}</width><height>{0:d}</height><depth>24</depth>'.format(size),
+            indent + '      <url>/icons/{:d}.png</url>'.format(size),
+            indent + '    </icon>',
+        ])
+
+    lines.append(indent + '  </iconList>')
+    lines.append(indent + '  <serviceList>')
+
+    for service_type in service_types:
+        service = service_type.split(':')[-2]
+        lines.extend([
+            indent + '    <service>',
+            indent + '      <serviceType>{}</serviceType>'.format(service_type),
+            indent + '      <serviceId>urn:upnp-org:serviceId:{}</serviceId>'.format(service),
+            indent + '      <SCPDURL>/{}/{}.xml</SCPDURL>'.format(embedded, service),
+            indent + '      <controlURL>/{}/ctl/{}</controlURL>'.format(embedded, service),
+            indent + '      <eventSubURL>/{}/evt/{}</eventSubURL>'.format(embedded, service),
+            indent + '    </service>',
+        ])
+
+    lines.append(indent + '  </serviceList>')
+
+    if embedded_profiles:
+        lines.append(indent + '  <deviceList>')
+
+        for position, embedded_profile in enumerate(embedded_profiles):
+            lines.extend(device_element(index, embedded_profile, rng, embedded * 0x10 + position + 1, indent + '    '))
+
+        lines.append(indent + '  </deviceList>')
+
+    lines.append(indent + '  <presentationURL>/</presentationURL>')
+    lines.append(indent + '</device>')
+
+    return lines
+
+def description_document(index):
+    '''Returns the description of synthetic device number index, the same for every call'''
+    rng = random.Random(index)
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<root xmlns="urn:schemas-upnp-org:device-1-0">',
+        '  <specVersion><major>1</major><minor>0</minor></specVersion>',
+    ] + device_element(index, device_profile(index), rng) + ['</root>', '']
+
+    return '\n'.join(lines).encode('utf-8')
+
+class DescriptionServer(threading.Thread):
+    '''
+    Serves the description of synthetic device number n on
+    http://127.0.0.1:port/devices/n/description.xml.
+    '''
+    def __init__(self, address='127.0.0.1', port=0):
+        super(DescriptionServer, self).__init__(daemon=True)
+
+        self.httpd = DescriptionHTTPServer((address, port), DescriptionRequestHandler)
+        self.base_url = 'http://{}:{:d}'.format(*self.httpd.server_address[:2])
+
+    def url(self, index):
+        return '{}/devices/{:d}/description.xml'.format(self.base_url, index)
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def join(self, timeout=None):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+        super(DescriptionServer, self).join(timeout)
+
+class DescriptionHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # the listen backlog, dozens of parallel fetches connect at once
+    request_queue_size = 128
+
+class DescriptionRequestHandler(http.server.BaseHTTPRequestHandler):
+    PATH = re.compile(r'^/devices/(\d+)/description\.xml$')
+
+    def do_GET(self):
+        self.send_document(True)
+
+    def do_HEAD(self):
+        self.send_document(False)
+
+    def send_document(self, with_body):
+        match = DescriptionRequestHandler.PATH.match(self.path)
+
+        if match is None:
+            self.send_error(404)
+            return
+
+        body = description_document(int(match.group(1)))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if with_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ControlPoint:
+    '''
+    Sends M-SEARCH requests to a troll over unicast UDP at a fixed rate and
+    measures the time until the first reply to each of them.
+
+    Searches go out round robin from sockets sockets, so several can be
+    pending at once without the troll coalescing them, and a search is
+    matched to its replies by socket and ST.
+    '''
+    def __init__(self, address, sockets=32, mx=0):
+        self.address = address
+        self.mx = mx
+        self.sockets = []
+
+        for _ in range(sockets):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            self.sockets.append(sock)
+
+        self.lock = threading.Lock()
+        # (socket index, search target) -> perf_counter time the search was sent
+        self.pending = {}
+        self.latencies = []
+        self.replies = 0
+        self.sent = 0
+
+    def search(self, targets, rate, duration, linger=1.0):
+        '''Searches for targets picked at random for duration seconds, then waits linger seconds for late replies'''
+        stop_receiving = threading.Event()
+        receiver = threading.Thread(target=self.receive, args=(stop_receiving,), daemon=True)
+        receiver.start()
+
+        rng = random.Random(0)
+        started = time.perf_counter()
+        count = int(rate * duration)
+
+        for sent in range(count):
+            # paced against the start, so a slow send does not lower the rate
+            delay = started + sent / rate - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+
+            target = rng.choice(targets)
+            position = sent % len(self.sockets)
+
+            with self.lock:
+                self.pending.setdefault((position, target), time.perf_counter())
+
+            self.sockets[position].sendto(self.request(target), self.address)
+            self.sent += 1
+
+        time.sleep(linger)
+        stop_receiving.set()
+        receiver.join()
+
+    def request(self, target):
+        return (
+            'M-SEARCH * HTTP/1.1\r\n'
+            'HOST: 239.255.255.250:1900\r\n'
+            'MAN: "ssdp:discover"\r\n'
+            'MX: {:d}\r\n'
+            'ST: {}\r\n'
+            '\r\n'
+        ).format(self.mx, target).encode('utf-8')
+
+    def receive(self, stop_receiving):
+        positions = {sock: position for position, sock in enumerate(self.sockets)}
+
+        while not stop_receiving.is_set():
+            for sock in select.select(self.sockets, [], [], 0.1)[0]:
+                data = sock.recv(0x1000)
+                received = time.perf_counter()
+                target = None
+
+                for line in data.split(b'\r\n'):
+                    if line[:3].upper() == b'ST:':
+                        target = line[3:].strip().decode('utf-8', 'replace')
+                        break
+
+                with self.lock:
+                    self.replies += 1
+                    sent = self.pending.pop((positions[sock], target), None)
+
+                    if sent is None:
+                        # the replies to ssdp:all carry the targets of the devices as ST
+                        sent = self.pending.pop((positions[sock], 'ssdp:all'), None)
+
+                    if sent is not None:
+                        self.latencies.append(received - sent)
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
@@ -0,0 +1,188 @@
+'''
+Counters and histograms describing what the troll is doing, rendered in the
+Prometheus text exposition format.
+
+Updating a metric is a dict or attribute increment without locking, so they
+can stay enabled in production. Concurrent updates from several threads may
+very rarely lose an increment, which is acceptable for monitoring.
+'''
+
+import bisect
+import json
+import logging
+import threading
+import http.server
+import urllib.parse
+
+logger = logging.getLogger()
+
+class Counter:
+    def __init__(self, name, documentation, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.count = 0
+        # label value -> count, for labelled counters
+        self.values = {}
+
+    def inc(self, amount=1, label_value=None):
+        if label_value is None:
+            self.count += amount
+        else:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def value(self, label_value=None):
+        if label_value is None:
+            return self.count
+
+        return self.values.get(label_value, 0)
+
+    def samples(self):
+        if not self.label:
+            yield '{} {}'.format(self.name, self.count)
+            return
+
+        for label_value, value in sorted(dict(self.values).items()):
+            yield '{}{{{}="{}"}} {}'.format(self.name, self.label, label_value, value)
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} counter'.format(self.name)
+        yield from self.samples()
+
+class Gauge:
+    '''
+    A value read from a callback when the metrics are rendered.
+
+    metric_type can be set to counter for monotonic values that are counted
+    elsewhere, e.g. in shared memory.
+    '''
+    def __init__(self, name, documentation, callback=None, metric_type='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def render(self):
+        if self.callback is None:
+            return
+
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} {}'.format(self.name, self.metric_type)
+        yield '{} {}'.format(self.name, self.callback())
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # one count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} histogram'.format(self.name)
+
+        cumulative = 0
+
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield '{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative)
+
+        yield '{}_sum {}'.format(self.name, self.sum)
+        yield '{}_count {}'.format(self.name, cumulative)
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+datagrams_received = REGISTRY.register(Counter('ssdp_troll_datagrams_received_total', 'Datagrams received on the SSDP port'))
+datagrams_ignored = REGISTRY.register(Counter('ssdp_troll_datagrams_ignored_total', 'Datagrams ignored because they are no M-SEARCH', 'method'))
+msearch_malformed = REGISTRY.register(Counter('ssdp_troll_msearch_malformed_total', 'M-SEARCH requests without ST or MAN: "ssdp:discover"'))
+msearch_limited = REGISTRY.register(Counter('ssdp_troll_msearch_rate_limited_total', 'M-SEARCH requests dropped by the per source or the global rate limit', 'limit'))
+rate_limiter_evicted = REGISTRY.register(Counter('ssdp_troll_rate_limiter_evicted_sources_total', 'Source addresses dropped from the full rate limiter table'))
+msearch_matched = REGISTRY.register(Counter('ssdp_troll_msearch_matched_total', 'M-SEARCH requests answered by at least one device'))
+msearch_unmatched = REGISTRY.register(Counter('ssdp_troll_msearch_unmatched_total', 'M-SEARCH requests no device answers'))
+msearch_coalesced = REGISTRY.register(Counter('ssdp_troll_msearch_coalesced_total', 'Repeated M-SEARCH requests merged into a pending reply'))
+replies_sent = REGISTRY.register(Counter('ssdp_troll_replies_sent_total', 'M-SEARCH reply datagrams sent'))
+notifications_sent = REGISTRY.register(Counter('ssdp_troll_notifications_sent_total', 'NOTIFY datagrams sent', 'nts'))
+send_errors = REGISTRY.register(Counter('ssdp_troll_send_errors_total', 'Failed datagram sends'))
+alive_round_seconds = REGISTRY.register(Histogram('ssdp_troll_alive_round_seconds', 'Time taken to send one round of alive notifications'))
+response_queue_depth = REGISTRY.register(Gauge('ssdp_troll_response_queue_depth', 'Scheduled M-SEARCH replies not sent yet'))
+devices = REGISTRY.register(Gauge('ssdp_troll_devices', 'Remote devices being advertised'))
+socket_dropped = REGISTRY.register(Gauge('ssdp_troll_socket_dropped_total', 'Datagrams dropped by the kernel on the SSDP sockets, by the socket filter or for lack of buffer space', metric_type='counter'))
+bridge_relayed = REGISTRY.register(Counter('ssdp_troll_bridge_relayed_total', 'NOTIFY datagrams relayed to the bridge peer', 'nts'))
+bridge_deduplicated = REGISTRY.register(Counter('ssdp_troll_bridge_deduplicated_total', 'NOTIFY datagrams not relayed because nothing changed'))
+proxy_requests = REGISTRY.register(Counter('ssdp_troll_proxy_requests_total', 'Requests to the description proxy', 'result'))
+probes = REGISTRY.register(Counter('ssdp_troll_probes_total', 'Health probes of device description URLs', 'result'))
+probe_seconds = REGISTRY.register(Histogram('ssdp_troll_probe_seconds', 'Time taken by one health probe of a device description URL'))
+unhealthy_devices = REGISTRY.register(Gauge('ssdp_troll_unhealthy_devices', 'Remote devices not advertised because their description URL does not answer'))
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+
+        if url.path == '/metrics':
+            body = self.server.registry.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif url.path == '/registry' and self.server.notify_registry is not None:
+            # e.g. /registry?target=urn:schemas-upnp-org:device:MediaRenderer:1
+            criteria = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items() if name in ('target', 'location', 'udn')}
+            body = json.dumps(self.server.notify_registry.snapshot(**criteria), indent=2).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request from %s: ' + format, self.address_string(), *args)
+
+class MetricsServer(threading.Thread):
+    '''
+    Serves the metrics on http://address:port/metrics, and the snapshot of
+    the notify registry, if there is one, on http://address:port/registry.
+    '''
+    def __init__(self, port, address='127.0.0.1', registry=REGISTRY, notify_registry=None):
+        super(MetricsServer, self).__init__(daemon=True)
+
+        self.httpd = http.server.ThreadingHTTPServer((address, port), MetricsRequestHandler)
+        self.httpd.registry = registry
+        self.httpd.notify_registry = notify_registry
+
+    def run(self):
+        logger.info('Serving metrics on http://%s:%d/metrics', *self.httpd.server_address[:2])
+
+        self.httpd.serve_forever()
+
+    def join(self, timeout=None):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+        super(MetricsServer, self).join(timeout)
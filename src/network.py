@@ -1,71 +1,628 @@
 import socket
 import select
+import signal
 import struct
+import pickle
+import zlib
 import threading
+import multiprocessing
 import logging
+import sockfilter
 
 logger = logging.getLogger()
 
 SSDP_MCAST_ADDR = '239.255.255.250'
+SSDP_MCAST_ADDR6_LINK_LOCAL = 'ff02::c'
+SSDP_MCAST_ADDR6_SITE_LOCAL = 'ff05::c'
 SSDP_PORT = 1900
 
+# the workers inherit the handler factory and the state it closes over
+# instead of pickling them, which only the fork start method does
+if 'fork' in multiprocessing.get_all_start_methods():
+    fork_context = multiprocessing.get_context('fork')
+else:
+    fork_context = None
+
+def have_fork():
+    return fork_context is not None
+
 def pretty_sockaddr(addr):
     '''Converts a standard Python sockaddr tuple and returns it in the normal text representation'''
-    # IPv4 only?
-    assert len(addr) == 2, addr
-    return '{}:{:d}'.format(addr[0], addr[1])
+    if len(addr) == 2:
+        return '{}:{:d}'.format(addr[0], addr[1])
+
+    assert len(addr) == 4, addr
+
+    if not addr[3]:
+        return '[{}]:{:d}'.format(addr[0], addr[1])
+
+    try:
+        scope = socket.if_indextoname(addr[3])
+    except OSError:
+        scope = addr[3]
+
+    return '[{}%{}]:{:d}'.format(addr[0], scope, addr[1])
+
+def multicast_host(group=SSDP_MCAST_ADDR):
+    if ':' in group:
+        return '[{}]:{:d}'.format(group, SSDP_PORT)
+
+    return '{}:{:d}'.format(group, SSDP_PORT)
+
+def is_scoped_group(interface_address):
+    '''Tells an IPv6 group scoped to an interface, like ff02::c%eth0, from an IPv4 interface address'''
+    return '%' in interface_address
+
+def parse_scoped_group(scoped_group):
+    '''Returns the group and interface index of an IPv6 group scoped to an interface'''
+    group, _, name = scoped_group.partition('%')
+
+    return group, socket.if_nametoindex(name)
+
+def ipv6_membership(scoped_group):
+    group, index = parse_scoped_group(scoped_group)
+
+    return socket.inet_pton(socket.AF_INET6, group) + struct.pack('@I', index)
+
+def join_multicast_group(sock, interface_address):
+    '''Joins the SSDP group on an IPv4 interface address or an IPv6 group scoped to an interface
+
+    Sockets of the other address family are left alone.'''
+    if sock.family == socket.AF_INET6:
+        if is_scoped_group(interface_address):
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, ipv6_membership(interface_address))
+    elif not is_scoped_group(interface_address):
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(SSDP_MCAST_ADDR) + socket.inet_aton(interface_address))
+
+def leave_multicast_group(sock, interface_address):
+    if sock.family == socket.AF_INET6:
+        if is_scoped_group(interface_address):
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_LEAVE_GROUP, ipv6_membership(interface_address))
+    elif not is_scoped_group(interface_address):
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, socket.inet_aton(SSDP_MCAST_ADDR) + socket.inet_aton(interface_address))
+
+def multicast_socket(receive_buffer_size=None, interface_addresses=None):
+    '''Returns a UDP socket bound to the SSDP port and joined to the SSDP multicast group
+
+    The group is joined on each of the given interface addresses, or on the
+    default interface if there are none.'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    if receive_buffer_size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+    sock.bind(('', SSDP_PORT))
+    if interface_addresses is None:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(SSDP_MCAST_ADDR) + struct.pack('I', socket.INADDR_ANY))
+    else:
+        for interface_address in interface_addresses:
+            join_multicast_group(sock, interface_address)
+
+    return sock
+
+def multicast_socket6(receive_buffer_size=None, interface_addresses=()):
+    '''Returns an IPv6 only UDP socket bound to the SSDP port and joined to the given scoped groups'''
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, True)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    if receive_buffer_size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+    sock.bind(('::', SSDP_PORT))
+    for interface_address in interface_addresses:
+        join_multicast_group(sock, interface_address)
+
+    return sock
+
+def multicast_sockets(receive_buffer_size=None, interface_addresses=None, ipv6=False, socket_filter=None):
+    '''Returns the IPv4 multicast socket, plus an IPv6 one if ipv6 is set or IPv6 groups are given
 
-def multicast_host():
-    return '{}:{:d}'.format(SSDP_MCAST_ADDR, SSDP_PORT)
+    A socket filter program from the sockfilter module is attached to each of them.'''
+    if interface_addresses is not None:
+        ipv6 = ipv6 or any(is_scoped_group(interface_address) for interface_address in interface_addresses)
+        interface_addresses = list(interface_addresses)
+
+    sockets = [multicast_socket(receive_buffer_size, interface_addresses)]
+
+    if ipv6:
+        sockets.append(multicast_socket6(receive_buffer_size, interface_addresses or ()))
+
+    if socket_filter is not None:
+        for sock in sockets:
+            sockfilter.attach_filter(sock, socket_filter)
+
+    return sockets
 
 class MulticastServer(threading.Thread):
-    def __init__(self, buffer_size, handler):
+    '''
+    Receives SSDP datagrams on the multicast sockets and passes them to a
+    handler.
+
+    With a scheduler.Scheduler, the receive loop blocks in its wait() and
+    runs its due callbacks, so receiving and the scheduled work share one
+    thread. It only wakes up for datagrams, timers and join().
+
+    Each wakeup reads up to BATCH datagrams from a socket, so under load the
+    cost of waiting is shared by many datagrams while the timers still run
+    between batches.
+    '''
+
+    BATCH = 64
+    def __init__(self, buffer_size, handler, multicast_interfaces=None, socket_filter=None, scheduler=None, receive_buffer_size=None):
         super(MulticastServer, self).__init__()
 
         self.stop_listening = threading.Event()
         self.buffer_size = buffer_size
+        self.receive_buffer_size = receive_buffer_size
         self.handler = handler
+        self.multicast_interfaces = multicast_interfaces
+        self.socket_filter = socket_filter
+        self.scheduler = scheduler
+        self.sockets = []
     
     #TODO use socketserver for this
     def run(self):
         logger.info('Listening for UDP multicast search requests')
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
-        sock.bind(('', SSDP_PORT))
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(SSDP_MCAST_ADDR) + struct.pack('I', socket.INADDR_ANY))
+        if self.multicast_interfaces is None:
+            sockets = multicast_sockets(receive_buffer_size=self.receive_buffer_size, socket_filter=self.socket_filter)
+        else:
+            sockets = multicast_sockets(receive_buffer_size=self.receive_buffer_size, interface_addresses=(), ipv6=self.multicast_interfaces.ipv6, socket_filter=self.socket_filter)
+
+            for sock in sockets:
+                self.multicast_interfaces.add_listening_socket(sock)
+
+        for sock in sockets:
+            sock.setblocking(False)
+
+        self.sockets = sockets
 
         while not self.stop_listening.isSet():
-            readset = select.select([sock], [], [], 0.5)[0]
+            if self.scheduler is None:
+                readset = select.select(sockets, [], [], 0.5)[0]
+            else:
+                readset = self.scheduler.wait(sockets)
+
+            for sock in readset:
+                self.drain(sock)
+
+            if self.scheduler is not None:
+                self.scheduler.run_due()
+
+        for sock in sockets:
+            if self.multicast_interfaces is not None:
+                self.multicast_interfaces.remove_listening_socket(sock)
 
-            if sock in readset:
+            sock.close()
+
+        self.sockets = []
+
+        logger.info('Stop listening for UDP multicast search requests')
+
+    def drain(self, sock):
+        '''Handles the datagrams queued on a socket, at most BATCH of them'''
+        for i in range(MulticastServer.BATCH):
+            try:
                 # MTU should limit UDP packet sizes to well below this
                 data, source_address = sock.recvfrom(self.buffer_size)
+            except (BlockingIOError, InterruptedError):
+                break
 
-                assert len(data) < bufsize, len(source_address)
-                
-                self.handler.handle(data, source_address)
+            assert len(data) < self.buffer_size, len(data)
 
-        sock.close()
+            try:
+                self.handler.handle(data, source_address)
+            except Exception:
+                logger.exception('Failed to handle datagram from %s', pretty_sockaddr(source_address))
 
-        logger.info('Stop listening for UDP multicast search requests')
+    def dropped(self):
+        '''Returns the number of datagrams the kernel dropped on the listening sockets'''
+        return sum(sockfilter.dropped(sock) or 0 for sock in self.sockets)
 
     def join(self, timeout=None):
         self.stop_listening.set()
+
+        if self.scheduler is not None:
+            self.scheduler.wakeup()
+
         super(MulticastServer, self).join(timeout)
 
-def send_multicast_message(message):
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_LOOP, False)
-    s.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, b'\0'*4)
-    #~ s.bind(('', 0)) # to the interface on any port
-    s.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 4)
-    s.sendto(message.to_bytes(), (SSDP_MCAST_ADDR, SSDP_PORT))
-    s.close() 
+class MulticastWorker((fork_context or multiprocessing).Process):
+    '''
+    Handles the SSDP datagrams a MulticastWorkerPool passes on in a separate
+    process. They arrive on its end of a Unix socket pair and are read in
+    batches until it would block.
 
-def send_unicast_message(self, address, message):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.connect(address)
-    sock.send(message.to_bytes())
-    sock.close()
+    Always forked, whatever the default start method is. The counters are
+    kept in shared memory so the parent can read them, and the parent counts
+    the datagrams it dropped because the queue of the worker was full.
+    '''
+
+    COUNTERS = 'received', 'received_bytes', 'batches', 'dropped', 'errors'
+
+    def __init__(self, worker_id, handler_factory, queue_size=None):
+        super(MulticastWorker, self).__init__(name='ssdp-worker-{:d}'.format(worker_id), daemon=True)
+
+        self.worker_id = worker_id
+        self.handler_factory = handler_factory
+
+        self.counters = fork_context.Array('Q', len(MulticastWorker.COUNTERS), lock=False)
+        # the queue of the worker is the send buffer of the parent end
+        self.reader, self.writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+        if queue_size:
+            self.writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, queue_size)
+        self.stop_reader, self.stop_writer = fork_context.Pipe(duplex=False)
+
+    def run(self):
+        # the parent decides when the workers stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.writer.close()
+
+        logger.info('Worker %d handling SSDP datagrams', self.worker_id)
+
+        handler = self.handler_factory()
+
+        while True:
+            readset = select.select([self.reader, self.stop_reader], [], [])[0]
+
+            if self.stop_reader in readset:
+                break
+
+            self.drain(handler)
+
+        self.reader.close()
+
+        if hasattr(handler, 'close'):
+            handler.close()
+
+        logger.info('Worker %d stop handling SSDP datagrams', self.worker_id)
+
+    def drain(self, handler):
+        counters = self.counters
+        received = received_bytes = 0
+
+        while True:
+            try:
+                message = self.reader.recv(0x10000)
+            except (BlockingIOError, InterruptedError):
+                break
+
+            source_address, data = pickle.loads(message)
+            received += 1
+            received_bytes += len(data)
+
+            try:
+                handler.handle(data, source_address)
+            except Exception:
+                counters[4] += 1
+                logger.exception('Failed to handle datagram from %s', pretty_sockaddr(source_address))
+
+        counters[0] += received
+        counters[1] += received_bytes
+        counters[2] += 1
+
+    def send(self, data, source_address):
+        '''Queues a datagram for the worker, drops it if the queue is full'''
+        try:
+            self.writer.send(pickle.dumps((source_address, data)))
+        except BlockingIOError:
+            self.counters[3] += 1
+
+    def stats(self):
+        return dict(zip(MulticastWorker.COUNTERS, self.counters))
+
+    def stop(self):
+        self.stop_writer.send(None)
+
+class MulticastWorkerPool:
+    '''
+    Spreads the handling of SSDP datagrams over several worker processes.
+
+    The pool is the handler of a MulticastServer, which receives every
+    datagram once, and passes each one on to the worker its source address
+    hashes to. The receive sockets cannot be spread with SO_REUSEPORT
+    instead, the kernel delivers a multicast datagram to every socket bound
+    to the port. As all searches of a source go to the same worker, its
+    rate limit and the coalescing of its repeated searches still hold.
+
+    Start it before the server, so the workers are forked before the
+    receive loop runs.
+    '''
+    def __init__(self, workers, handler_factory, queue_size=None):
+        if not have_fork():
+            raise OSError('Worker processes need the fork start method, which is not available on this platform')
+
+        self.workers = [MulticastWorker(worker_id, handler_factory, queue_size) for worker_id in range(workers)]
+
+    def handle(self, data, source_address):
+        self.workers[zlib.crc32(source_address[0].encode()) % len(self.workers)].send(data, source_address)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+            # only the worker reads from it
+            worker.reader.close()
+
+    def join(self, timeout=None):
+        for worker in self.workers:
+            worker.stop()
+
+        for worker in self.workers:
+            worker.join(timeout)
+            worker.writer.close()
+
+        for worker in self.workers:
+            logger.info('Worker %d statistics: %r', worker.worker_id, worker.stats())
+
+    def stats(self):
+        return [worker.stats() for worker in self.workers]
+
+def send_datagrams(sock, messages):
+    '''Sends a list of (address, bytes) pairs with one sendto() each, returns the number sent
+
+    Plain sendto() beats sendmmsg() through ctypes for the batch sizes SSDP
+    sends, see "benchmark.py send".'''
+    sendto = sock.sendto
+
+    for address, data in messages:
+        sendto(data, address)
+
+    return len(messages)
+
+class SSDPSender:
+    '''
+    Owns the sockets used to send SSDP datagrams from one interface: one
+    configured multicast socket and one unconnected unicast socket.
+
+    The unicast socket is only created once something is sent on it, the
+    per interface senders of MulticastInterfaces never do.
+    '''
+    def __init__(self, interface_address='0.0.0.0', ttl=4):
+        self.interface_address = interface_address
+
+        self.multicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.multicast_sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_LOOP, False)
+        self.multicast_sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface_address))
+        self.multicast_sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, ttl)
+
+        self.lock = threading.Lock()
+        self.unicast_sock = None
+
+    def unicast_socket(self):
+        with self.lock:
+            if self.unicast_sock is None:
+                self.unicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.unicast_sock.bind((self.interface_address, 0))
+
+            return self.unicast_sock
+
+    def send_multicast(self, data, interfaces=None):
+        if interfaces is not None and self.interface_address not in interfaces:
+            return
+
+        self.multicast_sock.sendto(data, (SSDP_MCAST_ADDR, SSDP_PORT))
+
+    def send_unicast(self, address, data):
+        self.unicast_socket().sendto(data, address)
+
+    def send_multicast_batch(self, datagrams, interfaces=None):
+        '''Sends a list of datagrams to the SSDP multicast group'''
+        if interfaces is not None and self.interface_address not in interfaces:
+            return 0
+
+        address = (SSDP_MCAST_ADDR, SSDP_PORT)
+        sendto = self.multicast_sock.sendto
+
+        for data in datagrams:
+            sendto(data, address)
+
+        return len(datagrams)
+
+    def send_unicast_batch(self, messages):
+        '''Sends a list of (address, bytes) pairs'''
+        return send_datagrams(self.unicast_socket(), messages)
+
+    def close(self):
+        self.multicast_sock.close()
+
+        if self.unicast_sock is not None:
+            self.unicast_sock.close()
+
+class SSDPSender6:
+    '''
+    Owns the socket used to send SSDP datagrams to an IPv6 group on one
+    interface, given as a scoped group like ff02::c%eth0.
+
+    Has the same multicast interface as SSDPSender. The datagrams are
+    rendered once with the IPv4 HOST header, which is swapped for the one
+    of the group on the way out.
+    '''
+    def __init__(self, scoped_group, hops=4):
+        self.interface_address = scoped_group
+        self.group, self.interface_index = parse_scoped_group(scoped_group)
+        self.host_headers = ('HOST: ' + multicast_host()).encode(), ('HOST: ' + multicast_host(self.group)).encode()
+
+        self.multicast_sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.multicast_sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_LOOP, False)
+        self.multicast_sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, self.interface_index)
+        self.multicast_sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, hops)
+
+    def send_multicast(self, data, interfaces=None):
+        self.send_multicast_batch([data], interfaces)
+
+    def send_multicast_batch(self, datagrams, interfaces=None):
+        '''Sends a list of datagrams to the IPv6 SSDP group'''
+        if interfaces is not None and self.interface_address not in interfaces:
+            return 0
+
+        ipv4_host, host = self.host_headers
+        address = (self.group, SSDP_PORT, 0, self.interface_index)
+
+        sendto = self.multicast_sock.sendto
+
+        for data in datagrams:
+            sendto(data.replace(ipv4_host, host, 1), address)
+
+        return len(datagrams)
+
+    def close(self):
+        self.multicast_sock.close()
+
+class MulticastInterfaces:
+    '''
+    Sends SSDP datagrams on every multicast capable interface, with one
+    SSDPSender per interface address, and keeps the group memberships of
+    the listening sockets in sync with those interfaces.
+
+    With ipv6_groups, the IPv6 groups scoped to each interface (like
+    ff02::c%eth0) are handled the same way as the IPv4 interface addresses,
+    with an SSDPSender6 each.
+
+    Has the same send interface as SSDPSender. Unicast replies go through a
+    single unbound socket per address family and are routed by the kernel.
+    '''
+    def __init__(self, ttl=4, ipv6_groups=()):
+        self.ttl = ttl
+        self.ipv6_groups = tuple(ipv6_groups)
+        self.lock = threading.Lock()
+        # interface address or scoped IPv6 group -> SSDPSender or SSDPSender6
+        self.senders = {}
+        self.listening_sockets = []
+        self.unicast_sender = SSDPSender()
+        self.unicast_sock6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) if self.ipv6 else None
+
+    @property
+    def ipv6(self):
+        return bool(self.ipv6_groups)
+
+    @property
+    def addresses(self):
+        return sorted(self.senders)
+
+    def add_listening_socket(self, sock):
+        with self.lock:
+            self.listening_sockets.append(sock)
+
+            for address in self.senders:
+                join_multicast_group(sock, address)
+
+    def remove_listening_socket(self, sock):
+        with self.lock:
+            self.listening_sockets.remove(sock)
+
+    def update(self, addresses, before_remove=None, after_add=None):
+        '''Makes the given interface addresses the ones in use, returns the (added, removed) addresses
+
+        before_remove is called with the addresses about to go while their
+        senders still work, after_add with the new ones once they are ready.'''
+        with self.lock:
+            added = sorted(set(addresses) - set(self.senders))
+            removed = sorted(set(self.senders) - set(addresses))
+
+        if removed and before_remove is not None:
+            before_remove(removed)
+
+        with self.lock:
+            for address in removed:
+                logger.info('Multicast interface %s went down', address)
+
+                for sock in self.listening_sockets:
+                    try:
+                        leave_multicast_group(sock, address)
+                    except OSError:
+                        # the kernel already dropped the membership with the address
+                        pass
+
+                self.senders.pop(address).close()
+
+            for address in added:
+                logger.info('Multicast interface %s came up', address)
+
+                if is_scoped_group(address):
+                    self.senders[address] = SSDPSender6(address, self.ttl)
+                else:
+                    self.senders[address] = SSDPSender(address, self.ttl)
+
+                for sock in self.listening_sockets:
+                    join_multicast_group(sock, address)
+
+        if added and after_add is not None:
+            after_add(added)
+
+        return added, removed
+
+    def selected_senders(self, interfaces):
+        with self.lock:
+            return [sender for address, sender in self.senders.items() if interfaces is None or address in interfaces]
+
+    def send_multicast(self, data, interfaces=None):
+        self.send_multicast_batch([data], interfaces)
+
+    def send_multicast_batch(self, datagrams, interfaces=None):
+        '''Sends the datagrams on each (or each given) interface
+
+        A failing interface does not keep the others from being served, the
+        first error is raised after all of them were tried.'''
+        sent = 0
+        error = None
+
+        for sender in self.selected_senders(interfaces):
+            try:
+                sent += sender.send_multicast_batch(datagrams)
+            except OSError as e:
+                logger.warning('Failed to send multicast datagrams on %s: %s', sender.interface_address, e)
+                error = error or e
+
+        if error is not None:
+            raise error
+
+        return sent
+
+    def send_unicast(self, address, data):
+        self.send_unicast_batch([(address, data)])
+
+    def send_unicast_batch(self, messages):
+        if messages and len(messages[0][0]) == 4:
+            # replies to an IPv6 search, the address carries the scope of the interface
+            return send_datagrams(self.unicast_sock6, messages)
+
+        return self.unicast_sender.send_unicast_batch(messages)
+
+    def close(self):
+        self.update([])
+        self.unicast_sender.close()
+
+        if self.unicast_sock6 is not None:
+            self.unicast_sock6.close()
+
+_default_sender = None
+_default_sender_lock = threading.Lock()
+
+def default_sender():
+    '''Returns the process wide SSDPSender, creating it on first use'''
+    global _default_sender
+
+    with _default_sender_lock:
+        if _default_sender is None:
+            _default_sender = SSDPSender()
+
+        return _default_sender
+
+def set_default_sender(sender):
+    '''Replaces the process wide sender, e.g. with a stub that records datagrams'''
+    global _default_sender
+
+    with _default_sender_lock:
+        _default_sender = sender
+
+def send_multicast_message(data):
+    default_sender().send_multicast(data)
+
+def send_unicast_message(address, data):
+    default_sender().send_unicast(address, data)
+
+def send_multicast_messages(datagrams, interfaces=None):
+    default_sender().send_multicast_batch(datagrams, interfaces)
 
+def send_unicast_messages(messages):
+    default_sender().send_unicast_batch(messages)
@@ -0,0 +1,254 @@
+'''
+Serves local copies of the remote device descriptions and their service
+descriptions (SCPD documents), so control points on the local segment do not
+have to fetch them across the routed link every time they see an alive.
+'''
+
+import hashlib
+import logging
+import re
+import threading
+import http.server
+import urllib.parse
+import xml.sax.saxutils
+import metrics
+import ssdp
+
+logger = logging.getLogger()
+
+# elements holding URLs in a device description, with an optional namespace prefix
+URL_ELEMENT_PATTERN = re.compile(rb'(<(?:[\w.-]+:)?(URLBase|SCPDURL|controlURL|eventSubURL|presentationURL|url)>)([^<]*)(</)')
+
+class ProxyDocument:
+    '''
+    A service description fetched on first request and revalidated with
+    conditional requests afterwards.
+    '''
+    def __init__(self, url):
+        self.url = url
+        self.data = None
+        self.validators = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, timeout=10):
+        '''Fetches or revalidates the document, returns True if it changed'''
+        with self.lock:
+            data, validators = ssdp.conditional_get(self.url, self.validators if self.data is not None else None, timeout)
+
+            if data is None:
+                return False
+
+            changed = data != self.data
+
+            self.data = data
+            self.validators = validators
+
+            return changed
+
+class SSDPDescriptionProxy(threading.Thread):
+    '''
+    Serves the description of every added device on
+    http://host:port/<device key>/description.xml and advertises that URL as
+    the device LOCATION.
+
+    In the served description, SCPDURLs point to cached copies on this
+    server. Control, event, presentation and icon URLs are made absolute
+    against the remote URLBase, or the remote description URL if there is
+    none, so they still reach the device. The description itself is the one
+    the device keeps revalidated, the service descriptions are revalidated
+    by revalidate().
+    '''
+    def __init__(self, port, host, address='', timeout=10):
+        super(SSDPDescriptionProxy, self).__init__(daemon=True)
+
+        self.host = host
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # device key -> device
+        self.devices = {}
+        # device key -> (description_data it was rewritten from, rewritten description, document paths)
+        self.descriptions = {}
+        # local path -> ProxyDocument
+        self.documents = {}
+
+        self.httpd = http.server.ThreadingHTTPServer((address, port), ProxyRequestHandler)
+        self.httpd.proxy = self
+
+        self.base_url = 'http://{}:{:d}'.format(host if ':' not in host else '[{}]'.format(host), self.httpd.server_address[1])
+
+    @staticmethod
+    def device_key(device):
+        return hashlib.sha1(device.description_url.encode('utf-8')).hexdigest()[:16]
+
+    def add(self, device):
+        '''Serves the device description and points the device LOCATION to it'''
+        key = self.device_key(device)
+
+        with self.lock:
+            self.devices[key] = device
+
+        self.description(key)
+
+        device.location = '{}/{}/description.xml'.format(self.base_url, key)
+
+    def remove(self, device):
+        key = self.device_key(device)
+
+        with self.lock:
+            self.devices.pop(key, None)
+            entry = self.descriptions.pop(key, None)
+
+            for path in (() if entry is None else entry[2]):
+                self.documents.pop(path, None)
+
+        device.location = device.description_url
+
+    def description(self, key):
+        '''Returns the rewritten description of a device, rewriting it again if the device description changed'''
+        with self.lock:
+            device = self.devices.get(key)
+            entry = self.descriptions.get(key)
+
+        if device is None:
+            return None
+
+        description_data = device.description_data
+
+        if entry is not None and entry[0] is description_data:
+            return entry[1]
+
+        rewritten, document_urls = self.rewrite(key, device.description_url, description_data)
+
+        with self.lock:
+            paths = set(document_urls)
+
+            for path, url in document_urls.items():
+                document = self.documents.get(path)
+
+                if document is None or document.url != url:
+                    self.documents[path] = ProxyDocument(url)
+
+            if entry is not None:
+                for path in entry[2] - paths:
+                    self.documents.pop(path, None)
+
+            self.descriptions[key] = (description_data, rewritten, paths)
+
+        return rewritten
+
+    def rewrite(self, key, description_url, data):
+        '''Returns the description with its URLs rewritten and the {local path: remote URL} of its service descriptions'''
+        url_base = description_url
+
+        for match in URL_ELEMENT_PATTERN.finditer(data):
+            if match.group(2) == b'URLBase':
+                url_base = urllib.parse.urljoin(description_url, self.element_text(match))
+                break
+
+        document_urls = {}
+
+        def rewrite_url(match):
+            name = match.group(2)
+            text = self.element_text(match)
+
+            if name == b'URLBase' or not text.strip():
+                return match.group(0)
+
+            url = urllib.parse.urljoin(url_base, text.strip())
+
+            if name == b'SCPDURL':
+                path = '/{}/{}.xml'.format(key, hashlib.sha1(url.encode('utf-8')).hexdigest()[:16])
+                document_urls[path] = url
+                url = self.base_url + path
+
+            return match.group(1) + xml.sax.saxutils.escape(url).encode('utf-8') + match.group(4)
+
+        return URL_ELEMENT_PATTERN.sub(rewrite_url, data), document_urls
+
+    @staticmethod
+    def element_text(match):
+        return xml.sax.saxutils.unescape(match.group(3).decode('utf-8', 'replace'))
+
+    def document(self, path):
+        '''Returns the served document for a request path, or None if there is none'''
+        path = urllib.parse.urlsplit(path).path
+        key, _, name = path.lstrip('/').partition('/')
+
+        if name == 'description.xml':
+            data = self.description(key)
+            metrics.proxy_requests.inc(label_value='hit' if data is not None else 'not_found')
+            return data
+
+        with self.lock:
+            document = self.documents.get(path)
+
+        if document is None:
+            metrics.proxy_requests.inc(label_value='not_found')
+            return None
+
+        if document.data is None:
+            metrics.proxy_requests.inc(label_value='miss')
+            document.fetch(self.timeout)
+        else:
+            metrics.proxy_requests.inc(label_value='hit')
+
+        return document.data
+
+    def revalidate(self):
+        '''Brings the rewritten descriptions and cached service descriptions up to date'''
+        with self.lock:
+            keys = list(self.devices)
+
+        for key in keys:
+            self.description(key)
+
+        with self.lock:
+            documents = [document for document in self.documents.values() if document.data is not None]
+
+        for document in documents:
+            try:
+                if document.fetch(self.timeout):
+                    logger.info('Service description %s changed', document.url)
+            except OSError as e:
+                logger.warning('Failed to revalidate service description %s: %s', document.url, e)
+
+    def run(self):
+        logger.info('Serving device descriptions on %s', self.base_url)
+
+        self.httpd.serve_forever()
+
+    def join(self, timeout=None):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+        super(SSDPDescriptionProxy, self).join(timeout)
+
+class ProxyRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_document(True)
+
+    def do_HEAD(self):
+        self.send_document(False)
+
+    def send_document(self, with_body):
+        try:
+            body = self.server.proxy.document(self.path)
+        except OSError as e:
+            logger.warning('Failed to fetch %s for %s: %s', self.path, self.address_string(), e)
+            self.send_error(502)
+            return
+
+        if body is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if with_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Description request from %s: ' + format, self.address_string(), *args)
@@ -0,0 +1,84 @@
+import collections
+import time
+import metrics
+
+class TokenBucket:
+    '''
+    Allows rate events per second on average, with bursts of up to burst events.
+    '''
+
+    __slots__ = 'rate', 'burst', 'tokens', 'updated'
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def consume(self, now, tokens=1):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < tokens:
+            return False
+
+        self.tokens -= tokens
+        return True
+
+class SSDPRateLimiter:
+    '''
+    Limits incoming M-SEARCH requests per source address and globally.
+
+    The per-source buckets are kept in an LRU table of at most max_sources
+    entries, so a flood from many spoofed addresses cannot grow it without
+    bound. A source is checked before the global bucket, so a single
+    misbehaving client cannot use up the budget of the well-behaved ones.
+
+    The counters are also exported as metrics, the dropped requests labelled
+    by the limit that dropped them.
+    '''
+
+    COUNTERS = 'allowed', 'limited_source', 'limited_global', 'evicted_sources'
+
+    def __init__(self, source_rate=5.0, source_burst=20, global_rate=200.0, global_burst=400, max_sources=4096):
+        self.source_rate = source_rate
+        self.source_burst = source_burst
+        self.max_sources = max_sources
+
+        self.sources = collections.OrderedDict()
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+
+        self.allowed = 0
+        self.limited_source = 0
+        self.limited_global = 0
+        self.evicted_sources = 0
+
+    def allow(self, source):
+        now = time.monotonic()
+        bucket = self.sources.get(source)
+
+        if bucket is None:
+            bucket = self.sources[source] = TokenBucket(self.source_rate, self.source_burst, now)
+
+            if len(self.sources) > self.max_sources:
+                self.sources.popitem(last=False)
+                self.evicted_sources += 1
+                metrics.rate_limiter_evicted.inc()
+        else:
+            self.sources.move_to_end(source)
+
+        if not bucket.consume(now):
+            self.limited_source += 1
+            metrics.msearch_limited.inc(label_value='source')
+            return False
+
+        if not self.global_bucket.consume(now):
+            self.limited_global += 1
+            metrics.msearch_limited.inc(label_value='global')
+            return False
+
+        self.allowed += 1
+        return True
+
+    def stats(self):
+        return {name: getattr(self, name) for name in SSDPRateLimiter.COUNTERS}
@@ -0,0 +1,230 @@
+'''
+A passive control point: remembers what the devices on the segment announce
+in their NOTIFYs, without sending any searches.
+'''
+
+import heapq
+import itertools
+import json
+import threading
+import time
+import ssdp
+
+class SSDPRegistryEntry:
+    '''
+    What the last alive NOTIFY for one USN said.
+    '''
+
+    __slots__ = 'usn', 'nt', 'location', 'server', 'max_age', 'expires', 'relayed'
+
+    def __init__(self, usn, nt, location, server, max_age, expires):
+        self.usn = usn
+        self.nt = nt
+        self.location = location
+        self.server = server
+        self.max_age = max_age
+        self.expires = expires
+        # monotonic time the entry was last relayed to a bridge peer
+        self.relayed = None
+
+    def to_dict(self, now):
+        return {
+            'usn': self.usn,
+            'nt': self.nt,
+            'location': self.location,
+            'server': self.server,
+            'max_age': self.max_age,
+            'expires_in': round(max(self.expires - now, 0), 1),
+        }
+
+class SSDPNotifyRegistry:
+    '''
+    Remembers the devices announced on a segment, keyed by USN, until they
+    say byebye or their CACHE-CONTROL max-age runs out.
+
+    Expiry is driven by a heap of (expiry time, USN). Refreshing an entry
+    pushes a new heap item and leaves the old one behind, which is skipped
+    when it comes up, so updates and expiry checks cost O(log n) instead
+    of a periodic scan over all entries. Once started on a scheduler, one
+    timer fires at the earliest expiry time, otherwise entries are expired
+    when the next NOTIFY comes in.
+
+    Has the handle() interface of a notify listener. on_notify is called
+    with (data, notify, entry, state) for each alive or byebye, where state
+    is NEW, CHANGED or REFRESHED for an alive, REMOVED for a byebye of a
+    known USN and None for a byebye of an unknown one.
+    '''
+
+    NEW = 'new'
+    CHANGED = 'changed'
+    REFRESHED = 'refreshed'
+    REMOVED = 'removed'
+
+    def __init__(self, default_max_age=1800, on_notify=None):
+        self.default_max_age = default_max_age
+        self.on_notify = on_notify
+        self.lock = threading.Lock()
+        # usn -> SSDPRegistryEntry
+        self.entries = {}
+        # (expires, sequence, usn), possibly stale
+        self.expiry_heap = []
+        self.sequence = itertools.count()
+        self.scheduler = None
+        # the timer for the top of the heap and the time it fires at
+        self.expiry_timer = None
+        self.expiry_time = None
+
+    def start(self, scheduler):
+        '''Expires the entries with a timer on a scheduler.Scheduler or an asyncio event loop
+
+        The scheduler must be the one running the thread handle() is called
+        from, an event loop is not thread safe.'''
+        with self.lock:
+            self.scheduler = scheduler
+            self.schedule_expiry()
+
+    def handle(self, data, source_address):
+        notify = ssdp.SSDPNotify.from_bytes(data)
+
+        if notify is None or notify.usn is None:
+            return
+
+        if self.scheduler is None:
+            # only looks at the top of the heap unless something is due
+            self.expire()
+
+        if notify.is_alive():
+            entry, state = self.alive(notify)
+        elif notify.is_byebye():
+            entry = self.byebye(notify.usn)
+            state = None if entry is None else SSDPNotifyRegistry.REMOVED
+        else:
+            return
+
+        if self.on_notify is not None:
+            self.on_notify(data, notify, entry, state)
+
+    def alive(self, notify, now=None):
+        '''Records an alive NOTIFY, returns the entry and whether it is NEW, CHANGED or just REFRESHED'''
+        now = time.monotonic() if now is None else now
+        max_age = self.default_max_age if notify.max_age is None else notify.max_age
+
+        with self.lock:
+            entry = self.entries.get(notify.usn)
+
+            if entry is None:
+                self.entries[notify.usn] = entry = SSDPRegistryEntry(notify.usn, notify.nt, notify.location, notify.server, max_age, now + max_age)
+                state = SSDPNotifyRegistry.NEW
+            else:
+                state = SSDPNotifyRegistry.REFRESHED
+
+                if (entry.nt, entry.location, entry.server) != (notify.nt, notify.location, notify.server):
+                    entry.nt = notify.nt
+                    entry.location = notify.location
+                    entry.server = notify.server
+                    state = SSDPNotifyRegistry.CHANGED
+
+                entry.max_age = max_age
+                entry.expires = now + max_age
+
+            heapq.heappush(self.expiry_heap, (entry.expires, next(self.sequence), entry.usn))
+            self.schedule_expiry()
+
+        return entry, state
+
+    def byebye(self, usn):
+        '''Forgets a USN, returns its entry or None if it was not known'''
+        with self.lock:
+            return self.entries.pop(usn, None)
+
+    def expire(self, now=None):
+        '''Forgets the entries whose max-age ran out and returns them'''
+        now = time.monotonic() if now is None else now
+        expired = []
+
+        with self.lock:
+            heap = self.expiry_heap
+
+            while heap and heap[0][0] <= now:
+                expires, sequence, usn = heapq.heappop(heap)
+                entry = self.entries.get(usn)
+
+                # skip items left behind by refreshes and byebyes
+                if entry is not None and entry.expires == expires:
+                    del self.entries[usn]
+                    expired.append(entry)
+
+            if len(heap) > 2 * len(self.entries) + 64:
+                # mostly stale items, rebuild from the live entries
+                self.expiry_heap = [(entry.expires, next(self.sequence), entry.usn) for entry in self.entries.values()]
+                heapq.heapify(self.expiry_heap)
+
+            self.schedule_expiry()
+
+        return expired
+
+    def schedule_expiry(self):
+        '''Moves the expiry timer to the top of the heap if that is earlier, with the lock held'''
+        if self.scheduler is None or not self.expiry_heap:
+            return
+
+        expires = self.expiry_heap[0][0]
+
+        if self.expiry_timer is not None:
+            if self.expiry_time <= expires:
+                return
+
+            self.expiry_timer.cancel()
+
+        self.expiry_time = expires
+        self.expiry_timer = self.scheduler.call_later(max(expires - time.monotonic(), 0), self.expiry_due)
+
+    def expiry_due(self):
+        with self.lock:
+            self.expiry_timer = None
+
+        self.expire()
+
+    def next_expiry(self):
+        '''Returns the monotonic time the next entry may expire, or None if there are none'''
+        with self.lock:
+            return self.expiry_heap[0][0] if self.expiry_heap else None
+
+    def query(self, target=None, location=None, udn=None):
+        '''Returns the live entries announcing a search target, at a location or of a device UDN
+
+        Without any criteria, or with ssdp:all as target, every entry matches.'''
+        now = time.monotonic()
+
+        with self.lock:
+            # entries that ran out but were not expired yet are left for expire()
+            entries = [entry for entry in self.entries.values() if entry.expires > now]
+
+        if target is not None and target != 'ssdp:all':
+            entries = [entry for entry in entries if entry.nt == target]
+        if location is not None:
+            entries = [entry for entry in entries if entry.location == location]
+        if udn is not None:
+            entries = [entry for entry in entries if entry.usn == udn or entry.usn.startswith(udn + '::')]
+
+        return sorted(entries, key=lambda entry: entry.usn)
+
+    def locations(self):
+        with self.lock:
+            return {entry.location for entry in self.entries.values()}
+
+    def snapshot(self, **criteria):
+        '''Returns the entries matching the query criteria as a list of dicts'''
+        now = time.monotonic()
+
+        return [entry.to_dict(now) for entry in self.query(**criteria)]
+
+    def dump(self, f, **criteria):
+        '''Writes the snapshot as JSON to a file object'''
+        json.dump(self.snapshot(**criteria), f, indent=2)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.query())
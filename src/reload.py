@@ -0,0 +1,90 @@
+'''
+Reloads the list of remote devices while the troll keeps running.
+'''
+
+import collections
+import concurrent.futures
+import logging
+import threading
+import xml.etree.ElementTree as ET
+import discovery
+
+logger = logging.getLogger()
+
+# removed and added devices, and (device, target USNs before) of the devices whose targets changed
+SSDPReloadPlan = collections.namedtuple('SSDPReloadPlan', 'removed added changed')
+
+def read_device_list(path):
+    '''Reads description URLs from a file, one per line, skipping blank lines and # comments'''
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+class SSDPDeviceReloader:
+    '''
+    Works out how the devices of a troll change when the device list is read
+    again: the description URLs given on the command line plus the ones in
+    the devices file.
+
+    Devices no longer listed are removed and new ones are fetched. Devices
+    that stay are revalidated, and the ones whose targets changed are
+    reported with their previous targets, so only the difference needs to
+    be announced. Devices in the index that were never listed, like the ones
+    relayed by a bridge peer, are left alone.
+    '''
+    def __init__(self, description_urls, devices_file=None, description_cache=None, timeout=10, max_workers=8):
+        self.static_urls = list(description_urls)
+        self.devices_file = devices_file
+        self.description_cache = description_cache
+        self.timeout = timeout
+        self.max_workers = max_workers
+        # only one reload at a time
+        self.lock = threading.Lock()
+
+        self.description_urls = self.read_description_urls()
+
+    def read_description_urls(self):
+        urls = list(self.static_urls)
+
+        if self.devices_file is not None:
+            urls.extend(url for url in read_device_list(self.devices_file) if url not in urls)
+
+        return urls
+
+    def plan(self, devices):
+        '''Reads the device list again, fetches what is new and returns an SSDPReloadPlan for the known devices'''
+        with self.lock:
+            urls = self.read_description_urls()
+            listed = set(self.description_urls)
+            indexed = {device.description_url: device for device in devices}
+
+            removed = [indexed[url] for url in self.description_urls if url not in urls and url in indexed]
+            kept = [indexed[url] for url in urls if url in indexed and url in listed]
+            # listed devices that failed before are tried again
+            added_urls = [url for url in urls if url not in indexed]
+
+            added = []
+
+            if added_urls:
+                discovery.SSDPDeviceDiscovery(added_urls, self.description_cache, self.timeout, self.max_workers, on_device=added.append).run()
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                changed = [entry for entry in executor.map(self.revalidate, kept) if entry is not None]
+
+            self.description_urls = urls
+
+        return SSDPReloadPlan(removed, added, changed)
+
+    def revalidate(self, device):
+        '''Returns (device, target USNs before) if the targets of the device changed, None otherwise'''
+        target_usns = list(device.target_usns)
+
+        try:
+            device.revalidate()
+        except (OSError, ET.ParseError) as e:
+            logger.warning('Failed to revalidate description of %s: %s', device, e)
+            return None
+
+        if device.target_usns == target_usns:
+            return None
+
+        return device, target_usns
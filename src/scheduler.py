@@ -0,0 +1,356 @@
+'''
+A timing wheel scheduler on the monotonic clock, shared by the advertiser,
+the delayed M-SEARCH replies and the receive loop.
+'''
+
+import logging
+import math
+import select
+import socket
+import threading
+import time
+
+logger = logging.getLogger()
+
+class TimerHandle:
+    '''
+    A scheduled callback, returned by Scheduler.call_later() and call_at().
+    '''
+
+    __slots__ = 'scheduler', 'when', 'callback', 'args', 'expires', 'slot', 'wakes', 'cancelled'
+
+    def __init__(self, scheduler, when, callback, args):
+        self.scheduler = scheduler
+        self.when = when
+        self.callback = callback
+        self.args = args
+        # tick the callback fires in, the wheel slot holding it and the tick
+        # that slot fires or is cascaded in
+        self.expires = None
+        self.slot = None
+        self.wakes = None
+        self.cancelled = False
+
+    def cancel(self):
+        '''Keeps the callback from running, does nothing if it already ran'''
+        self.scheduler.cancel(self)
+
+class TimingWheel:
+    '''
+    A hierarchical timing wheel: LEVELS wheels of 2 ** SLOT_BITS slots each,
+    where a slot of level n spans 2 ** (SLOT_BITS * n) ticks.
+
+    Inserting and removing an entry is a dict operation on its slot. When
+    the lowest wheel wraps, the next slot of the level above is cascaded
+    down, so an entry is moved at most LEVELS - 1 times. Entries further
+    away than the top level can hold wait in its last slot and are
+    cascaded again until they fit.
+
+    Times are in seconds and rounded up to whole ticks, so entries never
+    fire early. Not thread safe, Scheduler does the locking.
+
+    next_tick() is asked for on every turn of a receive loop, so its result
+    is kept until an entry is processed or the entry it came from is
+    removed. Inserting an entry can only make it earlier.
+    '''
+
+    LEVELS = 5
+    SLOT_BITS = 6
+    SLOTS = 1 << SLOT_BITS
+    SLOT_MASK = SLOTS - 1
+
+    def __init__(self, tick=0.01, now=0.0):
+        self.tick = tick
+        # the next tick to process, everything before it fired
+        self.base = math.floor(now / tick) + 1
+        self.levels = [[{} for _ in range(TimingWheel.SLOTS)] for _ in range(TimingWheel.LEVELS)]
+        self.count = 0
+        # what next_tick() returns, None while it has to be looked up again
+        self.known_next_tick = None
+
+    def insert(self, handle):
+        handle.expires = max(math.ceil(handle.when / self.tick), self.base)
+
+        self.place(handle)
+        self.count += 1
+
+        if self.count == 1:
+            self.known_next_tick = handle.wakes
+        elif self.known_next_tick is not None and handle.wakes is not None:
+            self.known_next_tick = min(self.known_next_tick, handle.wakes)
+        else:
+            self.known_next_tick = None
+
+    def place(self, handle):
+        distance = handle.expires - self.base
+
+        for level in range(TimingWheel.LEVELS):
+            shift = TimingWheel.SLOT_BITS * level
+
+            if distance < 1 << (shift + TimingWheel.SLOT_BITS):
+                index = (handle.expires >> shift) & TimingWheel.SLOT_MASK
+                # the start of the span of the slot, when it reaches the level below
+                handle.wakes = handle.expires >> shift << shift
+                break
+        else:
+            # cascaded again from the slot the top level reaches last
+            index = ((self.base >> shift) - 1) & TimingWheel.SLOT_MASK
+            handle.wakes = None
+
+        slot = self.levels[level][index]
+        slot[handle] = None
+        handle.slot = slot
+
+    def remove(self, handle):
+        if handle.slot is None:
+            return
+
+        del handle.slot[handle]
+        handle.slot = None
+        self.count -= 1
+
+        if handle.wakes is None or handle.wakes == self.known_next_tick:
+            self.known_next_tick = None
+
+    def cascade(self, level, index):
+        '''Moves the entries of a slot to the levels below, returns the slot index'''
+        slot = self.levels[level][index]
+
+        if slot:
+            self.levels[level][index] = {}
+
+            for handle in slot:
+                self.place(handle)
+
+        return index
+
+    def process(self, tick):
+        '''Cascades what reaches the lowest level at a tick and returns the entries firing in it'''
+        self.base = tick
+        self.known_next_tick = None
+        index = tick & TimingWheel.SLOT_MASK
+
+        if index == 0:
+            for level in range(1, TimingWheel.LEVELS):
+                if self.cascade(level, (tick >> (TimingWheel.SLOT_BITS * level)) & TimingWheel.SLOT_MASK) != 0:
+                    break
+
+        slot = self.levels[0][index]
+        self.levels[0][index] = {}
+        self.base = tick + 1
+
+        for handle in slot:
+            handle.slot = None
+
+        self.count -= len(slot)
+
+        return list(slot)
+
+    def next_tick(self):
+        '''Returns the next tick anything fires or cascades in, or None if the wheel is empty
+
+        Entries on the higher levels make this the tick their slot is
+        cascaded in, which is no later than the tick they fire in.'''
+        if not self.count:
+            return None
+
+        if self.known_next_tick is None:
+            self.known_next_tick = self.find_next_tick()
+
+        return self.known_next_tick
+
+    def find_next_tick(self):
+        '''Looks up next_tick() in the slots of every level'''
+        base = self.base
+        lowest = self.levels[0]
+        offset = base & TimingWheel.SLOT_MASK
+
+        # this turn of the lowest level, then the entries that wrapped around
+        candidates = [base - offset + index for index in range(offset, TimingWheel.SLOTS) if lowest[index]][:1]
+
+        if candidates and offset:
+            # nothing is cascaded before the lowest level wraps
+            return candidates[0]
+
+        candidates.extend([base - offset + TimingWheel.SLOTS + index for index in range(offset) if lowest[index]][:1])
+
+        for level in range(1, TimingWheel.LEVELS):
+            shift = TimingWheel.SLOT_BITS * level
+            slots = self.levels[level]
+            # the current slot of a level was cascaded already unless the ticks below it start over now
+            first = 0 if base & ((1 << shift) - 1) == 0 else 1
+
+            for distance in range(first, TimingWheel.SLOTS + 1):
+                position = (base >> shift) + distance
+
+                if slots[position & TimingWheel.SLOT_MASK]:
+                    candidates.append(position << shift)
+                    break
+
+        return min(candidates)
+
+    def advance(self, now):
+        '''Processes every tick up to now and returns the entries that fired, in tick order'''
+        # next_time() of a tick divided by the tick again can fall just short of it
+        target = math.floor(now / self.tick + 1e-6)
+        fired = []
+
+        while self.base <= target:
+            tick = self.next_tick()
+
+            if tick is None or tick > target:
+                # nothing fires or cascades before target
+                self.base = target + 1
+                break
+
+            fired.extend(self.process(max(tick, self.base)))
+
+        return fired
+
+    def __len__(self):
+        return self.count
+
+class Scheduler(threading.Thread):
+    '''
+    Runs callbacks at monotonic times from a timing wheel.
+
+    call_later() and call_at() return TimerHandles that can be cancelled,
+    from any thread. Everything due when run_due() is called fires as one
+    batch, outside the lock.
+
+    wait() is the one place to block: it returns when the next entry is
+    due, an earlier entry was added, one of the given readable objects
+    (e.g. sockets) can be read, or the timeout passed. A receive loop can
+    drive the scheduler that way, or start() runs it on its own thread.
+    Only one thread may wait at a time.
+    '''
+    def __init__(self, tick=0.01, clock=time.monotonic):
+        super(Scheduler, self).__init__(daemon=True)
+
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.wheel = TimingWheel(tick, clock())
+        # the time the waiting thread wakes up at, None if no thread waits
+        self.waiting_until = None
+        self.running = True
+
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def time(self):
+        return self.clock()
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        handle = TimerHandle(self, when, callback, args)
+
+        with self.lock:
+            self.wheel.insert(handle)
+            wake = self.waiting_until is not None and when < self.waiting_until
+
+        if wake:
+            self.wakeup()
+
+        return handle
+
+    def cancel(self, handle):
+        with self.lock:
+            handle.cancelled = True
+            self.wheel.remove(handle)
+
+    def next_time(self):
+        '''Returns the monotonic time of the next tick anything happens in, or None'''
+        with self.lock:
+            tick = self.wheel.next_tick()
+
+        return None if tick is None else tick * self.wheel.tick
+
+    def timeout(self):
+        '''Returns the seconds until the next tick anything happens in, or None'''
+        next_time = self.next_time()
+
+        return None if next_time is None else max(next_time - self.clock(), 0)
+
+    def run_due(self):
+        '''Runs the callbacks that are due, returns how many ran'''
+        known_next_tick = self.wheel.known_next_tick
+
+        # the receive loop calls this after every wakeup, mostly with nothing
+        # due yet; an entry added meanwhile runs after the next wait()
+        if known_next_tick is not None and self.clock() < (known_next_tick - 1e-6) * self.wheel.tick:
+            return 0
+
+        with self.lock:
+            due = self.wheel.advance(self.clock())
+
+        for handle in due:
+            if handle.cancelled:
+                # by a callback earlier in the batch
+                continue
+
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logger.exception('Scheduled callback %r failed', handle.callback)
+
+        return len(due)
+
+    def wait(self, readables=(), timeout=None):
+        '''Blocks until something is due or readable, returns the readable objects'''
+        with self.lock:
+            tick = self.wheel.next_tick()
+            now = self.clock()
+            deadline = None if tick is None else tick * self.wheel.tick
+
+            if timeout is not None and (deadline is None or now + timeout < deadline):
+                deadline = now + timeout
+
+            self.waiting_until = math.inf if deadline is None else deadline
+
+        try:
+            readable = select.select([*readables, self.wakeup_reader], [], [], None if deadline is None else max(deadline - now, 0))[0]
+        finally:
+            # a call_at() that still sees the old value only wakes up the next wait()
+            self.waiting_until = None
+
+        if self.wakeup_reader in readable:
+            self.drain_wakeups()
+            readable.remove(self.wakeup_reader)
+
+        return readable
+
+    def wakeup(self):
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            # the waiting thread has enough to wake up from
+            pass
+
+    def drain_wakeups(self):
+        try:
+            while self.wakeup_reader.recv(0x100):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        while self.running:
+            self.run_due()
+            self.wait()
+
+    def join(self, timeout=None):
+        self.running = False
+        self.wakeup()
+
+        if self.is_alive():
+            super(Scheduler, self).join(timeout)
+
+    def close(self):
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+    def __len__(self):
+        return len(self.wheel)
@@ -0,0 +1,129 @@
+'''
+Classic BPF socket filters (SO_ATTACH_FILTER) that let the Linux kernel drop
+the datagrams the troll is not interested in, mostly the NOTIFYs of other
+devices, before they wake up the receiving thread.
+
+The kernel runs a UDP socket filter on the datagram starting at the UDP
+header, so the payload starts at offset 8.
+'''
+
+from ctypes import (
+    Structure, POINTER,
+    c_ushort, c_ubyte, c_uint32,
+    cast
+)
+import socket
+import struct
+import sys
+
+# asm-generic/socket.h
+SO_ATTACH_FILTER = getattr(socket, 'SO_ATTACH_FILTER', 26)
+SO_DETACH_FILTER = getattr(socket, 'SO_DETACH_FILTER', 27)
+SO_MEMINFO = getattr(socket, 'SO_MEMINFO', 55)
+
+# linux/sock_diag.h, SK_MEMINFO_DROPS is the last of the SK_MEMINFO_VARS values
+SK_MEMINFO_VARS = 9
+SK_MEMINFO_DROPS = 8
+
+# linux/bpf_common.h
+BPF_LD = 0x00
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_ABS = 0x20
+BPF_JEQ = 0x10
+BPF_K = 0x00
+
+BPF_LOAD_SIZES = {4: BPF_W, 2: BPF_H, 1: BPF_B}
+
+UDP_HEADER_SIZE = 8
+
+ACCEPT = 0xffffffff
+REJECT = 0
+
+# linux/filter.h
+class struct_sock_filter(Structure):
+    _fields_ = [
+        ('code', c_ushort),
+        ('jt', c_ubyte),
+        ('jf', c_ubyte),
+        ('k', c_uint32),]
+
+class struct_sock_fprog(Structure):
+    _fields_ = [
+        ('len', c_ushort),
+        ('filter', POINTER(struct_sock_filter)),]
+
+def have_socket_filter():
+    return sys.platform.startswith('linux')
+
+def prefix_loads(prefix, offset):
+    '''Splits a prefix into (load size, expected value, offset) comparisons'''
+    loads = []
+
+    while prefix:
+        size = 4 if len(prefix) >= 4 else 2 if len(prefix) >= 2 else 1
+        loads.append((size, int.from_bytes(prefix[:size], 'big'), offset))
+
+        prefix = prefix[size:]
+        offset += size
+
+    return loads
+
+def prefix_filter(prefixes, offset=UDP_HEADER_SIZE):
+    '''Returns a program of (code, jt, jf, k) instructions accepting the packets whose payload starts with any of the prefixes
+
+    Every prefix is a block of load and compare pairs, a mismatch jumps to
+    the next block and the last one falls through to the reject.'''
+    blocks = [prefix_loads(prefix, offset) for prefix in prefixes]
+    reject = sum(2 * len(loads) for loads in blocks)
+    accept = reject + 1
+
+    program = []
+
+    for loads in blocks:
+        block_end = len(program) + 2 * len(loads)
+
+        for position, (size, value, load_offset) in enumerate(loads):
+            program.append((BPF_LD | BPF_LOAD_SIZES[size] | BPF_ABS, 0, 0, load_offset))
+
+            # jump offsets count from the instruction after the jump
+            pc = len(program)
+            jt = accept - pc - 1 if position == len(loads) - 1 else 0
+            program.append((BPF_JMP | BPF_JEQ | BPF_K, jt, block_end - pc - 1, value))
+
+    program.append((BPF_RET | BPF_K, 0, 0, REJECT))
+    program.append((BPF_RET | BPF_K, 0, 0, ACCEPT))
+
+    return program
+
+def ssdp_filter(accept_notify=False):
+    '''Returns a program accepting M-SEARCH requests, and NOTIFYs if accept_notify is set'''
+    return prefix_filter([b'M-SEARCH '] + ([b'NOTIFY '] if accept_notify else []))
+
+def attach_filter(sock, program):
+    instructions = (struct_sock_filter * len(program))(*[struct_sock_filter(*instruction) for instruction in program])
+    fprog = struct_sock_fprog(len(program), cast(instructions, POINTER(struct_sock_filter)))
+
+    # the kernel copies the program, instructions only has to outlive the call
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(fprog))
+
+def detach_filter(sock):
+    sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+
+def dropped(sock):
+    '''Returns the number of datagrams the kernel dropped on a socket, None where unknown
+
+    This counts both the datagrams rejected by the socket filter and the
+    ones dropped for lack of receive buffer space.'''
+    try:
+        meminfo = sock.getsockopt(socket.SOL_SOCKET, SO_MEMINFO, SK_MEMINFO_VARS * 4)
+    except OSError:
+        return None
+
+    if len(meminfo) < SK_MEMINFO_VARS * 4:
+        return None
+
+    return struct.unpack('={:d}I'.format(SK_MEMINFO_VARS), meminfo[:SK_MEMINFO_VARS * 4])[SK_MEMINFO_DROPS]
@@ -1,92 +1,557 @@
+import os
+import json
 import signal
+import hashlib
+import io
 import logging
-import heapq
+import itertools
 import threading
 import time
 import random
+import re
+import urllib.error
 import urllib.request
+import bootstate
+import interfaces
 import network
+import metrics
+import scheduler
+import sockfilter
 import xml.etree.ElementTree as ET
 from http2 import HTTPMessage, HTTPRequest, HTTPResponse
 
 logger = logging.getLogger()
 
+DEVICE_NAMESPACE = 'urn:schemas-upnp-org:device-1-0'
+
+def local_name(tag):
+    '''Returns the tag without the UPnP device namespace, or None for tags in other namespaces'''
+    if tag.startswith('{'):
+        namespace, _, name = tag[1:].partition('}')
+
+        return name if namespace == DEVICE_NAMESPACE else None
+
+    return tag
+
+def parse_device_description(data):
+    '''Returns (udn, device type, service types) of the root device and every embedded device, root first
+
+    The description is read in a single pass and every element is dropped
+    from the tree once it has been looked at, so large vendor descriptions
+    do not stay in memory.'''
+    devices = []
+    # entries of the devices whose element is open, innermost last
+    open_devices = []
+    # open elements, innermost last
+    elements = []
+
+    for event, element in ET.iterparse(io.BytesIO(data), events=('start', 'end')):
+        if event == 'start':
+            if local_name(element.tag) == 'device':
+                device = [None, None, []]
+                devices.append(device)
+                open_devices.append(device)
+
+            elements.append(element)
+            continue
+
+        elements.pop()
+        name = local_name(element.tag)
+        parent_name = local_name(elements[-1].tag) if elements else None
+
+        if name == 'device':
+            open_devices.pop()
+        elif open_devices and parent_name == 'device':
+            if name == 'UDN':
+                open_devices[-1][0] = (element.text or '').strip()
+            elif name == 'deviceType':
+                open_devices[-1][1] = (element.text or '').strip()
+        elif open_devices and parent_name == 'service' and name == 'serviceType':
+            open_devices[-1][2].append((element.text or '').strip())
+
+        if elements:
+            elements[-1].remove(element)
+
+    for udn, device_type, service_types in devices:
+        if not udn or not device_type:
+            raise ET.ParseError('device without UDN or deviceType in description')
+
+    if not devices:
+        raise ET.ParseError('no device in description')
+
+    return [tuple(device) for device in devices]
+
+def device_target_usns(devices):
+    '''Returns the (target, USN) pairs advertised for a root device and its embedded devices'''
+    root_udn = devices[0][0]
+    target_usns = [('upnp:rootdevice', root_udn + '::upnp:rootdevice')]
+
+    for udn, device_type, service_types in devices:
+        target_usns.append((udn, udn))
+
+        for target in [device_type] + service_types:
+            entry = (target, udn + '::' + target)
+
+            # a device may list a service type more than once
+            if entry not in target_usns:
+                target_usns.append(entry)
+
+    return target_usns
+
+def conditional_get(url, validators=None, timeout=10):
+    '''Fetches a document, sending the given validators so an unchanged one is not transferred again
+
+    Returns (data, validators), with data None if the server reported the
+    document as unchanged.'''
+    request = urllib.request.Request(url)
+
+    if validators:
+        if 'etag' in validators:
+            request.add_header('If-None-Match', validators['etag'])
+        if 'last_modified' in validators:
+            request.add_header('If-Modified-Since', validators['last_modified'])
+
+    try:
+        http_response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, validators
+        raise
+
+    with http_response:
+        data = http_response.read()
+        validators = {
+            name: value for name, value in [
+                ('etag', http_response.headers.get('ETag')),
+                ('last_modified', http_response.headers.get('Last-Modified'))
+            ] if value
+        }
+
+    return data, validators
+
+class SSDPDescriptionCache:
+    '''
+    Persists fetched device descriptions on disk, keyed by description URL.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url, extension):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + extension)
+
+    def load(self, url):
+        '''Returns the cached description data and HTTP validators, or (None, {})'''
+        try:
+            with open(self.path(url, '.xml'), 'rb') as f:
+                data = f.read()
+            with open(self.path(url, '.json'), 'r') as f:
+                validators = json.load(f)
+        except (OSError, ValueError):
+            return None, {}
+
+        return data, validators
+
+    def store(self, url, data, validators):
+        for extension, content, mode in [('.xml', data, 'wb'), ('.json', json.dumps(validators), 'w')]:
+            path = self.path(url, extension)
+
+            # replace atomically so a crash never leaves a truncated description behind
+            with open(path + '.tmp', mode) as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)
+
 class SSDPRemoteDevice:
     '''
     Represents a SSDP device in a remote subnet.
+
+    With a description cache the device is set up from the cached description
+    without contacting the server; revalidate() brings it up to date. Passing
+    description_data sets the device up from that document instead.
     '''
 
-    def __init__(self, description_url):
+    def __init__(self, description_url, description_cache=None, timeout=10, description_data=None):
         self.description_url = description_url
+        # advertised as LOCATION, the description proxy points it to its copy
+        self.location = description_url
+        self.description_cache = description_cache
+        self.timeout = timeout
         self.description_data = None
+        self.validators = {}
+        # seconds spent on the last fetch and parse of the description
+        self.fetch_latency = None
+        self.parse_latency = None
 
         self.udn = None
-        self.targets = ['upnp:rootdevice']
+        # CONFIGID.UPNP.ORG, follows the description
+        self.config_id = None
+        # (search target, USN) pairs of the root device and its embedded devices
+        self.target_usns = []
+
+        if description_data is not None:
+            self.update_description(description_data)
+        elif not self.load_from_cache():
+            self.get_data_from_server()
+
+    @property
+    def targets(self):
+        return [target for target, usn in self.target_usns]
+
+    def load_from_cache(self):
+        if self.description_cache is None:
+            return False
+
+        data, validators = self.description_cache.load(self.description_url)
+
+        if data is None:
+            return False
+
+        try:
+            self.update_description(data)
+        except ET.ParseError as e:
+            logger.warning('Ignoring unusable cached description for %s: %s', self.description_url, e)
+            return False
 
-        self.get_data_from_server()
+        self.validators = validators
+
+        logger.info('Loaded description for %s from cache', self.description_url)
+
+        return True
 
     def get_data_from_server(self):
-        description_root = self.retrieve_device_description()
+        self.revalidate()
+
+    def revalidate(self):
+        '''Fetches the description unless the server reports it as unchanged.
+
+        Returns True if the device data changed.'''
+        fetch_started = time.monotonic()
+
+        data, validators = conditional_get(self.description_url, self.validators if self.description_data is not None else None, self.timeout)
+
+        self.fetch_latency = time.monotonic() - fetch_started
+
+        if data is None:
+            return False
+
+        changed = data != self.description_data
 
-        self.extract_device_data(description_root)
+        if changed:
+            self.update_description(data)
 
-    def retrieve_device_description(self):
-        def remove_namespace(doc, namespace):
-            ns = u'{{{}}}'.format(namespace)
-            nsl = len(ns)
-            for elem in doc.getiterator():
-                if elem.tag.startswith(ns):
-                    elem.tag = elem.tag[nsl:]
+        self.validators = validators
 
-        http_response = urllib.request.urlopen(self.description_url)
-        self.description_data = http_response.read()
-        description_root = ET.fromstring(self.description_data)
+        if self.description_cache is not None:
+            self.description_cache.store(self.description_url, self.description_data, validators)
 
-        # without this we would have to specify the namespace on all
-        # elements we want to search
-        remove_namespace(description_root, 'urn:schemas-upnp-org:device-1-0')
+        return changed
 
-        return description_root
+    def update_description(self, data):
+        parse_started = time.monotonic()
 
-    def extract_device_data(self, description_root):
-        device = description_root.find('device')
-        udn = device.find('UDN')
-        device_type = device.find('deviceType')
-        service_list = device.find('serviceList')
+        devices = parse_device_description(data)
 
-        self.udn = udn.text
-        
-        self.targets.append(device_type.text)
+        self.udn = devices[0][0]
+        self.target_usns = device_target_usns(devices)
+        self.config_id = bootstate.config_id(data)
 
-        for service_type in service_list.iter('serviceType'):
-            self.targets.append(service_type.text)
+        self.parse_latency = time.monotonic() - parse_started
+
+        # assigned last, SSDPMessage uses it to detect stale datagrams
+        self.description_data = data
 
     def __str__(self):
         return '<SSDPRemoteDevice url={}, udn={}>'.format(self.description_url, self.udn)
 
+def revalidate_devices(target_index, on_device_changed):
+    '''Revalidates the description of every indexed device and calls on_device_changed with the ones that changed'''
+    for device in target_index:
+        try:
+            changed = device.revalidate()
+        except (OSError, ET.ParseError) as e:
+            logger.warning('Failed to revalidate description of %s: %s', device, e)
+            continue
+
+        if changed:
+            logger.info('Description of %s changed, updating targets', device)
+
+            on_device_changed(device)
+
+class SSDPSearchRequest:
+    '''
+    The fields of an M-SEARCH request the troll needs, parsed straight from
+    the datagram bytes.
+    '''
+
+    __slots__ = 'st', 'mx', 'man'
+
+    REQUEST_LINE = b'M-SEARCH * HTTP/1.1'
+    HEADER_PATTERN = re.compile(rb'^(ST|MX|MAN)[ \t]*:[ \t]*(.*?)[ \t]*\r?$', re.IGNORECASE | re.MULTILINE)
+
+    def __init__(self, st=None, mx=None, man=None):
+        self.st = st
+        self.mx = mx
+        self.man = man
+
+    @classmethod
+    def is_search(cls, data):
+        '''Checks the request line of a datagram without allocating'''
+        if isinstance(data, memoryview):
+            return data[:len(cls.REQUEST_LINE)] == cls.REQUEST_LINE
+
+        return data.startswith(cls.REQUEST_LINE)
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''Returns the parsed request, or None if data is not an M-SEARCH.
+
+        Accepts bytes or a memoryview. Anything else is rejected from the
+        request line without allocating.'''
+        if not cls.is_search(data):
+            return None
+
+        request = cls()
+
+        for match in cls.HEADER_PATTERN.finditer(data, len(cls.REQUEST_LINE)):
+            name = match.group(1).upper()
+
+            if name == b'ST':
+                request.st = match.group(2).decode('utf-8', 'replace')
+            elif name == b'MX':
+                request.mx = match.group(2)
+            else:
+                request.man = match.group(2)
+
+        return request
+
+    def is_discover(self):
+        return self.man is not None and b'ssdp:discover' in self.man
+
+class SSDPNotify:
+    '''
+    The fields of a NOTIFY request the bridge needs, parsed straight from
+    the datagram bytes.
+    '''
+
+    __slots__ = 'nt', 'nts', 'usn', 'location', 'max_age', 'server'
+
+    REQUEST_LINE = b'NOTIFY * HTTP/1.1'
+    HEADER_PATTERN = re.compile(rb'^(NT|NTS|USN|LOCATION|CACHE-CONTROL|SERVER)[ \t]*:[ \t]*(.*?)[ \t]*\r?$', re.IGNORECASE | re.MULTILINE)
+    MAX_AGE_PATTERN = re.compile(rb'max-age[ \t]*=[ \t]*"?(\d+)', re.IGNORECASE)
+
+    def __init__(self, nt=None, nts=None, usn=None, location=None, max_age=None, server=None):
+        self.nt = nt
+        self.nts = nts
+        self.usn = usn
+        self.location = location
+        self.max_age = max_age
+        self.server = server
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''Returns the parsed request, or None if data is not a NOTIFY'''
+        if data[:len(cls.REQUEST_LINE)] != cls.REQUEST_LINE:
+            return None
+
+        notify = cls()
+
+        for match in cls.HEADER_PATTERN.finditer(data, len(cls.REQUEST_LINE)):
+            name = match.group(1).upper()
+            value = match.group(2)
+
+            if name == b'CACHE-CONTROL':
+                max_age = cls.MAX_AGE_PATTERN.search(value)
+
+                if max_age is not None:
+                    notify.max_age = int(max_age.group(1))
+            else:
+                setattr(notify, name.decode('ascii').lower(), value.decode('utf-8', 'replace'))
+
+        return notify
+
+    def is_alive(self):
+        return self.nts == 'ssdp:alive'
+
+    def is_byebye(self):
+        return self.nts == 'ssdp:byebye'
+
+class SSDPTargetIndex:
+    '''
+    Maps search targets to the SSDP devices and USNs answering them.
+
+    Changes are copy-on-write, so lookups from other threads never see a
+    partially updated index.
+    '''
+
+    def __init__(self, devices=()):
+        self.lock = threading.Lock()
+        self.devices = []
+        self.targets = {}
+        # device -> the (target, USN) pairs it was indexed under
+        self.device_targets = {}
+
+        for device in devices:
+            self.add(device)
+
+    def index_device(self, targets, device):
+        for target, usn in device.target_usns:
+            targets[target] = targets.get(target, ()) + ((device, usn),)
+
+        self.device_targets[device] = tuple(device.target_usns)
+
+    def unindex_device(self, targets, device):
+        for target in {target for target, usn in self.device_targets.pop(device, ())}:
+            entries = tuple(entry for entry in targets.get(target, ()) if entry[0] is not device)
+
+            if entries:
+                targets[target] = entries
+            else:
+                targets.pop(target, None)
+
+    def add(self, device):
+        with self.lock:
+            targets = dict(self.targets)
+            self.index_device(targets, device)
+
+            self.targets = targets
+            self.devices = self.devices + [device]
+
+    def remove(self, device):
+        with self.lock:
+            targets = dict(self.targets)
+            self.unindex_device(targets, device)
+
+            self.targets = targets
+            self.devices = [d for d in self.devices if d is not device]
+
+    def update(self, device):
+        '''Reindexes a device after its targets changed, returns the (target, USN) pairs it was indexed under'''
+        with self.lock:
+            previous_target_usns = self.device_targets.get(device, ())
+            targets = dict(self.targets)
+            self.unindex_device(targets, device)
+            self.index_device(targets, device)
+
+            self.targets = targets
+
+        return previous_target_usns
+
+    def lookup(self, target):
+        '''Returns a list of (target, device, usn) tuples answering the given search target'''
+        if target == 'ssdp:all':
+            return [(t, device, usn) for t, entries in self.targets.items() for device, usn in entries]
+
+        return [(target, device, usn) for device, usn in self.targets.get(target, ())]
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def announces(self, usn):
+        '''Returns whether an indexed device announces the USN'''
+        # every UDN is a target of its own, so only the devices with that UDN are looked at
+        for device, _ in self.targets.get(usn.split('::', 1)[0], ()):
+            if any(device_usn == usn for target, device_usn in device.target_usns):
+                return True
+
+        return False
+
+    def __contains__(self, device):
+        return device in self.device_targets
+
 class SSDPMessage:
     '''
-    Creates messages for a specific SSDP device.
+    Creates messages for SSDP devices.
+
+    The datagrams for each (device, target, USN) are rendered once and cached until
+    the device description, the notification interval or the boot id changes.
+    Search responses only get the current DATE patched in.
+
+    With a boot state the messages carry the UPnP 1.1 BOOTID.UPNP.ORG and
+    CONFIGID.UPNP.ORG headers.
     '''
 
     EXPIRY_FUDGE = 5
     SERVER_INFORMATION = 'Linux/2.6.15.2 UPnP/1.1 UPNPSPOOF/1.0'
+    DATE_PLACEHOLDER = '\0DATE\0'
+
+    def __init__(self, boot_state=None):
+        self.boot_state = boot_state
+        # device -> (description_data, notification_interval, boot_id, {(target, usn): datagrams})
+        self.datagram_cache = {}
+        self.date_cache = (None, b'')
+
+    def invalidate(self, device=None):
+        if device is None:
+            self.datagram_cache.clear()
+        else:
+            self.datagram_cache.pop(device, None)
+
+    def current_date(self):
+        '''Returns the current rfc1123 date as bytes, recomputed at most once per second'''
+        now = int(time.time())
+
+        if self.date_cache[0] != now:
+            self.date_cache = (now, HTTPMessage.current_date().encode('ascii'))
+
+        return self.date_cache[1]
+
+    def datagrams(self, device, target, usn, notification_interval):
+        '''Returns the pre-rendered (alive, byebye, response prefix, response suffix) datagrams'''
+        entry = self.datagram_cache.get(device)
+        boot_id = None if self.boot_state is None else self.boot_state.boot_id
+
+        if entry is None or entry[0] is not device.description_data or entry[1] != notification_interval or entry[2] != boot_id:
+            entry = (device.description_data, notification_interval, boot_id, {})
+            self.datagram_cache[device] = entry
+
+        rendered = entry[3].get((target, usn))
+
+        if rendered is None:
+            response = self.msearch_response(device, target, usn, notification_interval, date=SSDPMessage.DATE_PLACEHOLDER).to_bytes()
+            response_prefix, response_suffix = response.split(SSDPMessage.DATE_PLACEHOLDER.encode('ascii'))
+
+            rendered = (
+                self.alive_request(device, target, usn, notification_interval).to_bytes(),
+                self.byebye_request(device, target, usn).to_bytes(),
+                response_prefix,
+                response_suffix
+            )
+            entry[3][(target, usn)] = rendered
 
-    def __init__(self, device):
-        self.ssdp_device = device
+        return rendered
 
-    def usn_for_target(self, target):
-        usn = self.ssdp_device.udn
+    def alive_datagram(self, device, target, usn, notification_interval):
+        return self.datagrams(device, target, usn, notification_interval)[0]
 
-        if target != usn:
-            usn = usn + '::' + target
+    def byebye_datagram(self, device, target, usn, notification_interval):
+        return self.datagrams(device, target, usn, notification_interval)[1]
 
-        return usn
+    def msearch_response_datagram(self, device, target, usn, notification_interval):
+        rendered = self.datagrams(device, target, usn, notification_interval)
+
+        return rendered[2] + self.current_date() + rendered[3]
+
+    def update_datagram(self, device, target, usn):
+        return self.update_request(device, target, usn).to_bytes()
 
     def calculate_max_age(self, notification_interval):
         return notification_interval * 2 + SSDPMessage.EXPIRY_FUDGE
 
-    def alive_request(self, target, notification_interval):
+    def upnp_headers(self, device):
+        if self.boot_state is None:
+            return []
+
+        return [
+            ('BOOTID.UPNP.ORG', str(self.boot_state.boot_id)),
+            ('CONFIGID.UPNP.ORG', str(device.config_id))
+        ]
+
+    def alive_request(self, device, target, usn, notification_interval):
         max_age = self.calculate_max_age(notification_interval)
 
         headers = [
@@ -94,175 +559,571 @@ class SSDPMessage:
             ('NTS', 'ssdp:alive'),
             ('NT', target),
             ('CACHE-CONTROL', HTTPMessage.max_age(max_age)),
-            ('LOCATION', self.ssdp_device.description_url),
+            ('LOCATION', device.location),
             ('SERVER', SSDPMessage.SERVER_INFORMATION),
-            ('USN', self.usn_for_target(target))
-        ]
+            ('USN', usn)
+        ] + self.upnp_headers(device)
 
         return HTTPRequest('NOTIFY', '*', headers)
 
-    def byebye_request(self, target):
+    def byebye_request(self, device, target, usn):
         headers = [
             ('HOST', network.multicast_host()),
             ('NTS', 'ssdp:byebye'),
             ('NT', target),
-            ('USN', self.usn_for_target(target))
+            ('USN', usn)
+        ] + self.upnp_headers(device)
+
+        return HTTPRequest('NOTIFY', '*', headers)
+
+    def update_request(self, device, target, usn):
+        '''Announces that the boot id goes up to NEXTBOOTID.UPNP.ORG while the device stays available'''
+        headers = [
+            ('HOST', network.multicast_host()),
+            ('LOCATION', device.location),
+            ('NT', target),
+            ('NTS', 'ssdp:update'),
+            ('USN', usn)
+        ] + self.upnp_headers(device) + [
+            ('NEXTBOOTID.UPNP.ORG', str(self.boot_state.next_boot_id))
         ]
 
         return HTTPRequest('NOTIFY', '*', headers)
 
-    def msearch_response(self, target, notification_interval):
+    def msearch_response(self, device, target, usn, notification_interval, date=None):
         max_age = self.calculate_max_age(notification_interval)
 
         headers = [
             ('ST', target),
             ('CACHE-CONTROL', HTTPMessage.max_age(max_age)),
-            ('DATE', HTTPMessage.current_date()),
+            ('DATE', date or HTTPMessage.current_date()),
             ('EXT', ''),
-            ('LOCATION', self.ssdp_device.description_url),
-            ('SERVER', SERVER_INFORMATION),
-            ('USN', self.usn_for_target(target))
-        ]
+            ('LOCATION', device.location),
+            ('SERVER', SSDPMessage.SERVER_INFORMATION),
+            ('USN', usn)
+        ] + self.upnp_headers(device)
 
         return HTTPResponse(headers, code=200)
 
+def ignored_method(data):
+    '''Classifies a datagram that is no M-SEARCH for the metrics'''
+    if isinstance(data, memoryview):
+        data = bytes(data[:6])
+
+    if data.startswith(b'NOTIFY'):
+        return 'NOTIFY'
+    if data.startswith(b'HTTP/'):
+        return 'response'
+    return 'other'
+
 class SSDPSearchRequestHandler:
     '''
-    Handles SSDP search requests targeted to a specific SSDP device.
+    Handles SSDP search requests targeted to the indexed SSDP devices.
+
+    With a response queue, each device's replies are sent at a random time
+    between 0 and MX seconds (capped to max_response_delay), and repeated
+    searches from the same source for the same target are coalesced into
+    the reply that is already pending. The response queue is anything with
+    the call_later() interface of scheduler.Scheduler.
+
+    With a rate limiter, searches over the per-source or global limits are
+    dropped right after the request line was checked.
+
+    NOTIFY requests are passed to the notify listener if there is one.
     '''
-    def __init__(self, device, notification_interval=1800):
-        self.ssdp_device = device
-        self.ssdp_message = SSDPMessage(device)
+    def __init__(self, target_index, notification_interval=1800, response_queue=None, max_response_delay=5, rate_limiter=None, notify_listener=None, boot_state=None):
+        self.target_index = target_index
+        self.notify_listener = notify_listener
+        self.ssdp_message = SSDPMessage(boot_state)
         self.notification_interval = notification_interval
+        self.response_queue = response_queue
+        self.max_response_delay = max_response_delay
+        self.rate_limiter = rate_limiter
+
+        # (source_address, search_target) -> number of device replies still pending
+        self.pending_replies = {}
+
+    def response_delay(self, request):
+        try:
+            mx = int(request.mx)
+        except (TypeError, ValueError):
+            mx = 1
+
+        return min(max(mx, 0), self.max_response_delay)
 
     def handle(self, data, source_address):
-        request = HTTPRequest.from_bytes(data)
+        metrics.datagrams_received.inc()
+
+        if not SSDPSearchRequest.is_search(data):
+            method = ignored_method(data)
+
+            if method == 'NOTIFY' and self.notify_listener is not None:
+                self.notify_listener.handle(data, source_address)
+                return
+
+            metrics.datagrams_ignored.inc(label_value=method)
+            logger.debug('Ignoring non M-SEARCH datagram from %s', source_address)
+            return
+
+        if self.rate_limiter is not None and not self.rate_limiter.allow(source_address[0]):
+            logger.debug('Rate limited M-SEARCH from %s', source_address)
+            return
+
+        request = SSDPSearchRequest.from_bytes(data)
+
+        if request.st is None or not request.is_discover():
+            metrics.msearch_malformed.inc()
+            logger.debug('Ignoring malformed M-SEARCH from %s', source_address)
+            return
+
+        search_target = request.st
+        matches = self.target_index.lookup(search_target)
 
-        if request.method != 'M-SEARCH':
-            logger.info('Ignoring %r request from %s', request.method, source_address)
+        if not matches:
+            metrics.msearch_unmatched.inc()
+            logger.debug('Ignoring M-SEARCH for %r from %s', search_target, source_address)
             return
 
-        search_target = request['st']
+        metrics.msearch_matched.inc()
 
-        if search_target in self.ssdp_device.targets:
-            search_targets = [search_target]
-        elif search_target == 'ssdp:all':
-            search_targets = self.ssdp_device.targets
+        if self.response_queue is None:
+            responses = [self.ssdp_message.msearch_response_datagram(device, target, usn, self.notification_interval) for target, device, usn in matches]
+
+            self.send_msearch_reply(source_address, responses)
+            return
+
+        pending_key = (source_address, search_target)
+
+        if pending_key in self.pending_replies:
+            metrics.msearch_coalesced.inc()
+            logger.debug('Coalesced repeated M-SEARCH for %r from %s', search_target, source_address)
+            return
+
+        device_matches = {}
+
+        for target, device, usn in matches:
+            device_matches.setdefault(device, []).append((target, usn))
+
+        self.pending_replies[pending_key] = len(device_matches)
+        mx = self.response_delay(request)
+
+        for device, target_usns in device_matches.items():
+            # respond at a random time between 0 and MX seconds from now
+            self.response_queue.call_later(random.uniform(0, mx), self.send_delayed_msearch_reply, pending_key, device, target_usns)
+
+    def send_delayed_msearch_reply(self, pending_key, device, target_usns):
+        remaining = self.pending_replies.get(pending_key, 1) - 1
+
+        if remaining > 0:
+            self.pending_replies[pending_key] = remaining
         else:
-            logger.info('Ignoring M-SEARCH for %r from %s', st, source_address)
-            sts = []
+            self.pending_replies.pop(pending_key, None)
+
+        # rendered at send time so the DATE header is current
+        responses = [self.ssdp_message.msearch_response_datagram(device, target, usn, self.notification_interval) for target, usn in target_usns]
+
+        self.send_msearch_reply(pending_key[0], responses)
 
-        for target in search_targets:
-            # respond at a random time between 1 and MX seconds from now
-            response = self.ssdp_message.msearch_response(target, self.notification_interval)
-            
-            send_msearch_reply(source_address, response)
+    def pending(self):
+        '''Returns the number of device replies not sent yet'''
+        return sum(dict(self.pending_replies).values())
 
-    def send_msearch_reply(self, source_address, response):
-        # TODO this should be posted to the outgoing network queue with delay=random.uniform(1, float(request['MX'])
-        network.send_unicast_message(source_address, response)
+    def close(self):
+        if self.response_queue is not None:
+            self.response_queue.join()
 
-        logger.info('Responded to M-SEARCH from %s: %r', network.pretty_sockaddr(source_address), response)
+    def send_msearch_reply(self, source_address, responses):
+        try:
+            network.send_unicast_messages([(source_address, response) for response in responses])
+        except OSError as e:
+            metrics.send_errors.inc()
+            logger.warning('Failed to respond to M-SEARCH from %s: %s', network.pretty_sockaddr(source_address), e)
+            return
+
+        metrics.replies_sent.inc(len(responses))
 
-class SSDPAdvertiser(threading.Thread):
+        logger.debug('Responded to M-SEARCH from %s: %r', network.pretty_sockaddr(source_address), responses)
+
+class SSDPAliveSchedule:
     '''
-    Produces SSDP advertising events for a SSDP device at regular intervals.
+    Decides when each device sends its alive notifications.
+
+    Every device has its own round every notification_interval seconds.
+    The first one falls at a random point of the spread seconds after the
+    device was added, and every round after that is jittered by up to spread
+    seconds again, so devices neither announce themselves all at once nor
+    stay in step. A round sends the notifications repeat times,
+    repeat_spacing seconds apart, as UPnP recommends since any single copy
+    may be lost.
+
+    Every device has one timer on the scheduler at a time, for its next
+    copy, so adding it again or removing it just cancels that timer. The
+    scheduler is a scheduler.Scheduler or an asyncio event loop; send is
+    called with the list of devices to announce.
     '''
-    def __init__(self, device, notification_interval=1800):
-        super(SSDPAdvertiser, self).__init__()
-
-        self.ssdp_device = device
-        self.ssdp_message = SSDPMessage(device)
+    def __init__(self, scheduler, send, notification_interval=1800, repeat=2, spread=10, repeat_spacing=0.2):
+        self.scheduler = scheduler
+        self.send = send
         self.notification_interval = notification_interval
+        self.repeat = max(repeat, 1)
+        # a late round must still come before the max-age of the previous one runs out
+        self.spread = min(spread, notification_interval)
+        self.repeat_spacing = repeat_spacing
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        # device -> (chain, handle of its next copy), the chain tells a cancelled timer that fired anyway
+        self.timers = {}
+
+    def add(self, device, delay=None):
+        '''Schedules the rounds of a device, the first one after delay seconds or within the spread'''
+        delay = random.uniform(0, self.spread) if delay is None else delay
+
+        with self.lock:
+            self.cancel(device)
+            self.schedule(device, next(self.sequence), delay, 0, self.scheduler.time())
+
+    def remove(self, device):
+        with self.lock:
+            self.cancel(device)
+
+    def clear(self):
+        with self.lock:
+            for device in list(self.timers):
+                self.cancel(device)
+
+    def cancel(self, device):
+        timer = self.timers.pop(device, None)
+
+        if timer is not None:
+            timer[1].cancel()
+
+    def schedule(self, device, chain, delay, copy, nominal):
+        self.timers[device] = (chain, self.scheduler.call_later(delay, self.fire, device, chain, copy, nominal))
+
+    def fire(self, device, chain, copy, nominal):
+        with self.lock:
+            timer = self.timers.get(device)
+
+            if timer is None or timer[0] != chain:
+                return
+
+            if copy + 1 < self.repeat:
+                self.schedule(device, chain, self.repeat_spacing, copy + 1, nominal)
+            else:
+                nominal += self.notification_interval
+                self.schedule(device, chain, max(nominal + random.uniform(0, self.spread) - self.scheduler.time(), 0), 0, nominal)
 
-        self.stop_advertising = threading.Event()
+        self.send([device])
 
-    def run(self):
-        while not self.stop_advertising.isSet():
-            self.send_notify_alive_message()
+    def __contains__(self, device):
+        return device in self.timers
 
-            logger.info('Sending next SSDP alive notifications in %r seconds', self.notification_interval)
+    def __len__(self):
+        return len(self.timers)
 
-            self.stop_advertising.wait(self.notification_interval)
+class SSDPNotifier:
+    '''
+    Sends SSDP alive and byebye notifications for the indexed SSDP devices.
+    '''
+    def __init__(self, target_index, notification_interval=1800, boot_state=None):
+        self.target_index = target_index
+        self.boot_state = boot_state
+        self.ssdp_message = SSDPMessage(boot_state)
+        self.notification_interval = notification_interval
 
-        self.send_notify_byebye_message()
+    def send_notify_alive_message(self, devices=None, interfaces=None):
+        logger.info('Sending SSDP alive notifications')
 
-    def join(self, timeout=None):
-        logger.info('Stopping SSDP alive notifications')
+        self.send_alive_datagrams(self.target_index if devices is None else devices, interfaces)
 
-        self.stop_advertising.set()
+        logger.info('Sent SSDP alive notifications')
 
-        super(SSDPAdvertiser, self).join(timeout)
+    def send_alive_datagrams(self, devices, interfaces=None):
+        round_started = time.monotonic()
+        datagrams = []
 
-    def send_notify_alive_message(self):
-        logger.info('Sending SSDP alive notifications')
+        for device in devices:
+            for target, usn in device.target_usns:
+                logger.debug('Sending SSDP alive notification for %s', usn)
 
-        for target in self.ssdp_device.targets:
-            request = self.ssdp_message.alive_request(target, self.notification_interval)
+                datagrams.append(self.ssdp_message.alive_datagram(device, target, usn, self.notification_interval))
 
-            logger.info('Sending SSDP alive notification for %s', target)
+        self.send_notifications('ssdp:alive', datagrams, interfaces)
 
-            # TODO this should be posted to the outgoing network queue with delay=random.uniform(0, 0.1)
-            network.send_multicast_message(request)
+        metrics.alive_round_seconds.observe(time.monotonic() - round_started)
 
-        logger.info('Sent SSDP alive notifications')
+    def send_target_changes(self, device, previous_target_usns):
+        '''Says byebye for the targets a device no longer has and announces its new ones right away'''
+        target_usns = set(device.target_usns)
+        previous = set(previous_target_usns)
 
-    def send_notify_byebye_message(self):
+        byebyes = [self.ssdp_message.byebye_datagram(device, target, usn, self.notification_interval) for target, usn in previous_target_usns if (target, usn) not in target_usns]
+        alives = [self.ssdp_message.alive_datagram(device, target, usn, self.notification_interval) for target, usn in device.target_usns if (target, usn) not in previous]
+
+        logger.info('Targets of %s changed: %d gone, %d new', device, len(byebyes), len(alives))
+
+        if byebyes:
+            self.send_notifications('ssdp:byebye', byebyes)
+        if alives:
+            self.send_notifications('ssdp:alive', alives)
+
+    def send_notify_byebye_message(self, devices=None, interfaces=None):
         logger.info('Sending SSDP byebye notifications')
 
-        for target in self.ssdp_device.targets:
-            request = self.ssdp_message.byebye_request(target)
+        datagrams = []
+
+        for device in (self.target_index if devices is None else devices):
+            for target, usn in device.target_usns:
+                logger.debug('Sending SSDP byebye notification for %s', usn)
 
-            logger.info('Sending SSDP byebye notification for %s', target)
-            # TODO this should be posted to the outgoing network queue with delay=random.uniform(0, 0.1)
-            network.send_multicast_message(request)
+                datagrams.append(self.ssdp_message.byebye_datagram(device, target, usn, self.notification_interval))
+
+        # TODO this should be posted to the outgoing network queue with delay=random.uniform(0, 0.1)
+        self.send_notifications('ssdp:byebye', datagrams, interfaces)
 
         logger.info('Sent SSDP byebye notifications')
 
-class SSDPDelayedResponseQueue(threading.Thread):
+    def send_notify_update_message(self, interfaces=None):
+        '''Tells the control points that the boot id goes up and moves on to the next one'''
+        if self.boot_state is None:
+            return
+
+        logger.info('Sending SSDP update notifications')
+
+        datagrams = [self.ssdp_message.update_datagram(device, target, usn) for device in self.target_index for target, usn in device.target_usns]
+
+        if datagrams:
+            self.send_notifications('ssdp:update', datagrams, interfaces)
+
+        self.boot_state.advance()
+
+    def send_notifications(self, nts, datagrams, interfaces=None):
+        try:
+            network.send_multicast_messages(datagrams, interfaces)
+        except OSError as e:
+            metrics.send_errors.inc()
+            logger.warning('Failed to send SSDP %s notifications: %s', nts, e)
+            return
+
+        metrics.notifications_sent.inc(len(datagrams), nts)
+
+def update_interfaces(multicast_interfaces, notifier):
+    '''
+    Brings the multicast interfaces in line with the ones the system reports.
+
+    The devices say byebye on interfaces going away and are announced right
+    away on new ones instead of at the next notification interval. Before
+    that, the interfaces that were there already get an ssdp:update for the
+    boot id that comes with the new interfaces.
+    '''
+    def after_add(added):
+        notifier.send_notify_update_message(interfaces=[address for address in multicast_interfaces.addresses if address not in added])
+        notifier.send_notify_alive_message(interfaces=added)
+
+    multicast_interfaces.update(
+        interfaces.multicast_addresses(multicast_interfaces.ipv6_groups),
+        before_remove=lambda removed: notifier.send_notify_byebye_message(interfaces=removed),
+        after_add=after_add)
+
+class SSDPAdvertiser(SSDPNotifier):
+    '''
+    Produces SSDP advertising events for the indexed SSDP devices at regular
+    intervals, as timers on a scheduler.Scheduler or an asyncio event loop.
+    '''
+    def __init__(self, scheduler, target_index, notification_interval=1800, alive_repeat=2, alive_spread=10, boot_state=None):
+        super(SSDPAdvertiser, self).__init__(target_index, notification_interval, boot_state)
+
+        self.alive_schedule = SSDPAliveSchedule(scheduler, self.send_alive_datagrams, notification_interval, alive_repeat, alive_spread)
+
+    def start(self):
+        logger.info('Sending SSDP alive notifications every %r seconds, spread over %r seconds', self.notification_interval, self.alive_schedule.spread)
+
+        for device in self.target_index:
+            if device not in self.alive_schedule:
+                self.alive_schedule.add(device)
+
+    def add_device(self, device, immediate=False):
+        '''Schedules the alive rounds of a device, the first one within the spread or right away if immediate'''
+        self.alive_schedule.add(device, delay=0 if immediate else None)
+
+    def remove_device(self, device):
+        self.alive_schedule.remove(device)
+
+        self.send_notify_byebye_message([device])
+
+    def stop(self):
+        logger.info('Stopping SSDP alive notifications')
+
+        self.alive_schedule.clear()
+
+        self.send_notify_byebye_message()
+
+class SSDPDescriptionRevalidator(threading.Thread):
     '''
-    Sends delayed SSDP messages in a linear fashion.
+    Revalidates the descriptions of the indexed SSDP devices at regular
+    intervals, and the documents of the description proxy if there is one.
+    on_device_changed is called with every device whose description changed.
     '''
+    def __init__(self, target_index, on_device_changed, revalidate_interval=300, description_proxy=None):
+        super(SSDPDescriptionRevalidator, self).__init__(daemon=True)
+
+        self.target_index = target_index
+        self.on_device_changed = on_device_changed
+        self.revalidate_interval = revalidate_interval
+        self.description_proxy = description_proxy
 
-    def __init__(self):
-        self.events = []
-        self.execute_callbacks = True
+        self.stop_revalidating = threading.Event()
 
     def run(self):
-        while self.execute_callbacks:
-            timeout = self.poll()
-            logger.debug('Next scheduled SSDP response in %r', timeout)
-            time.sleep(timeout)
-
-    def halt(self):
-        self.execute_callbacks = False
-
-    def add(self, callback, args=None, delay=None):
-        heapq.heappush(self.events, (time.time() + delay, callback, args))
-
-    def poll(self):
-        '''Execute any callbacks that are due, and return the time in seconds until the next event
-        will be ready, or None if there are none pending.'''
-        while True:
-            if self.events:
-                timeout = self.events[0][0] - time.time()
-                if timeout >= 0:
-                    # event not ready, so return the timeout
-                    return timeout
-                # event ready, execute it
-                callback, args = heapq.heappop(self.events)[1:]
-                callback(*([] if args is None else args))
-            else:
-                # no events pending, so there is no timeout
-                return None
+        while not self.stop_revalidating.wait(self.revalidate_interval):
+            revalidate_devices(self.target_index, self.on_device_changed)
+
+            if self.description_proxy is not None:
+                self.description_proxy.revalidate()
 
-class SSDPTroll(threading.Thread):
-    def __init__(self, ssdp_device):
+    def join(self, timeout=None):
+        self.stop_revalidating.set()
+
+        super(SSDPDescriptionRevalidator, self).join(timeout)
+
+class SSDPDeviceManager:
+    '''
+    Brings the devices of a troll online and offline, shared by SSDPTroll
+    and aio.AsyncSSDPTroll.
+
+    Expects target_index, advertiser, search_handler, health_checker and
+    description_proxy attributes. Every change of the targets of a device,
+    found by discovery, revalidation or a reload, goes through
+    device_changed(), so the targets it lost get their byebye.
+    '''
+    def add_device(self, device, immediate=False):
+        '''Adds a device, brings it online and watches its health
+
+        Devices arriving from discovery or the bridge peer are announced
+        within the alive spread, so a burst of them does not flood the
+        network, reloaded ones right away.'''
+        if self.description_proxy is not None:
+            self.description_proxy.add(device)
+
+        self.bring_online(device, immediate)
+
+        if self.health_checker is not None:
+            self.health_checker.add(device)
+
+    def remove_device(self, device):
+        '''Removes a device, taking it offline unless the health checker did already'''
+        if self.health_checker is not None:
+            self.health_checker.remove(device)
+
+        if device in self.target_index:
+            self.take_offline(device)
+
+        if self.description_proxy is not None:
+            self.description_proxy.remove(device)
+
+    def bring_online(self, device, immediate=True):
+        '''Indexes a device and announces it, right away unless immediate is false'''
+        self.target_index.add(device)
+
+        self.advertiser.add_device(device, immediate)
+
+    def take_offline(self, device):
+        '''Says byebye for a device and stops answering searches for it'''
+        self.advertiser.remove_device(device)
+
+        self.target_index.remove(device)
+
+        # the datagrams are rendered again if it comes back online
+        self.advertiser.ssdp_message.invalidate(device)
+        if self.search_handler is not None:
+            self.search_handler.ssdp_message.invalidate(device)
+
+    def known_devices(self):
+        '''Returns the indexed devices and the ones the health checker took offline'''
+        return list(self.target_index) + ([] if self.health_checker is None else self.health_checker.unhealthy())
+
+    def device_changed(self, device):
+        '''Reindexes a device whose description changed and announces the difference in its targets'''
+        if device not in self.target_index:
+            # offline until the health checker sees it answer again, announced then
+            return
+
+        previous_target_usns = self.target_index.update(device)
+
+        if set(previous_target_usns) != set(device.target_usns):
+            self.advertiser.send_target_changes(device, previous_target_usns)
+
+    def apply_reload(self, plan):
+        for device in plan.removed:
+            self.remove_device(device)
+
+        for device, _ in plan.changed:
+            self.device_changed(device)
+
+        for device in plan.added:
+            self.add_device(device, immediate=True)
+
+        logger.info('Reloaded the device list: %d removed, %d added, %d changed', len(plan.removed), len(plan.added), len(plan.changed))
+
+class SSDPTroll(SSDPDeviceManager, threading.Thread):
+    '''
+    Advertises any number of remote SSDP devices and answers searches for them
+    from a single multicast listener.
+    '''
+    def __init__(self, ssdp_devices, notification_interval=1800, max_response_delay=5, workers=0, receive_buffer_size=None, revalidate_interval=300, discovery=None, rate_limiter_factory=None, metrics_port=None, multicast_interfaces=None, description_proxy=None, notify_listener_factory=None, bridge_peer=None, alive_repeat=2, alive_spread=10, reloader=None, socket_filter=False, boot_state=None, health_checker=None):
         super(SSDPTroll, self).__init__()
 
-        self.advertiser = SSDPAdvertiser(ssdp_device, 1800)
-        self.search_handler = SSDPSearchRequestHandler(ssdp_device, 1800)
-        self.mcast_server = network.MulticastServer(0x1000, self.search_handler)
+        self.discovery = discovery
+        self.reloader = reloader
+        self.health_checker = health_checker
+        self.bridge_peer = bridge_peer
+        self.notify_listener_factory = notify_listener_factory
+        self.description_proxy = description_proxy
+        self.rate_limiter_factory = rate_limiter_factory
+        self.multicast_interfaces = multicast_interfaces
+        self.interface_monitor = None
+
+        if multicast_interfaces is not None:
+            multicast_interfaces.update(interfaces.multicast_addresses(multicast_interfaces.ipv6_groups))
+
+            if interfaces.have_netlink():
+                self.interface_monitor = interfaces.InterfaceMonitorThread(self.update_interfaces)
+
+        if description_proxy is not None:
+            for device in ssdp_devices:
+                description_proxy.add(device)
+
+        self.target_index = SSDPTargetIndex(ssdp_devices)
+        self.notification_interval = notification_interval
+        self.max_response_delay = max_response_delay
+        self.boot_state = bootstate.SSDPBootState() if boot_state is None else boot_state
+        # the alive rounds and the delayed replies, run by the receive loop or its own thread
+        self.scheduler = scheduler.Scheduler()
+        self.advertiser = SSDPAdvertiser(self.scheduler, self.target_index, notification_interval, alive_repeat, alive_spread, self.boot_state)
+        self.revalidator = SSDPDescriptionRevalidator(self.target_index, self.device_changed, revalidate_interval, description_proxy)
+
+        # the kernel only passes on the M-SEARCHs, and the NOTIFYs if something listens to them
+        filter_program = sockfilter.ssdp_filter(accept_notify=notify_listener_factory is not None) if socket_filter else None
+
+        if workers:
+            # every worker process answers searches with its own response queue
+            self.response_queue = None
+            # every worker process has its own
+            self.notify_listener = None
+            self.search_handler = None
+            self.worker_pool = network.MulticastWorkerPool(workers, self.create_search_handler, receive_buffer_size)
+            handler = self.worker_pool
+        else:
+            self.response_queue = self.scheduler
+            self.notify_listener = self.create_notify_listener(self.scheduler)
+            self.search_handler = SSDPSearchRequestHandler(self.target_index, notification_interval, self.response_queue, max_response_delay, self.create_rate_limiter(), self.notify_listener, self.boot_state)
+            self.worker_pool = None
+            handler = self.search_handler
+
+        self.mcast_server = network.MulticastServer(0x1000, handler, multicast_interfaces, filter_program, self.scheduler, receive_buffer_size)
+
+        self.metrics_server = None if metrics_port is None else metrics.MetricsServer(metrics_port, notify_registry=self.notify_listener)
+        self.register_metrics()
 
         self.stop_troll = threading.Event()
 
@@ -272,11 +1133,126 @@ class SSDPTroll(threading.Thread):
 
         signal.signal(signal.SIGINT, sigint)
 
+        if self.reloader is not None:
+            # the descriptions are fetched outside the signal handler
+            signal.signal(signal.SIGHUP, lambda signalnum, handler: threading.Thread(target=self.reload, daemon=True).start())
+
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.description_proxy is not None:
+            self.description_proxy.start()
+
+        if self.health_checker is not None:
+            if self.response_queue is None:
+                logger.warning('Devices taken offline by the health checker are still answered by worker processes')
+
+            self.health_checker.on_unhealthy = self.take_offline
+            self.health_checker.on_healthy = self.bring_online
+
+            for device in self.target_index:
+                self.health_checker.add(device)
+
+            self.health_checker.start()
+
+        if self.discovery is not None:
+            self.discovery.on_device = self.add_device
+            self.discovery.on_device_changed = self.device_changed
+            self.discovery.start()
+
+            if self.response_queue is None:
+                # worker processes only see the devices indexed before they fork
+                self.discovery.join()
+
+        if self.bridge_peer is not None:
+            if self.response_queue is None:
+                logger.warning('Devices relayed by the bridge peer are not answered by worker processes')
+
+            self.bridge_peer.on_device = self.add_device
+            self.bridge_peer.on_device_removed = self.remove_device
+            self.bridge_peer.start()
+
+        if self.worker_pool is not None:
+            # forked before the receive loop starts
+            self.worker_pool.start()
         self.mcast_server.start()
         self.advertiser.start()
+        self.revalidator.start()
+        if self.interface_monitor is not None:
+            self.interface_monitor.start()
 
         while not self.stop_troll.isSet():
             self.stop_troll.wait(1.0)
 
-        self.advertiser.join()
+        if self.interface_monitor is not None:
+            self.interface_monitor.join()
+        if self.bridge_peer is not None:
+            self.bridge_peer.join()
+        if self.health_checker is not None:
+            self.health_checker.join()
+        self.revalidator.join()
+        self.advertiser.stop()
         self.mcast_server.join()
+        if self.worker_pool is not None:
+            self.worker_pool.join()
+        self.scheduler.join()
+        self.scheduler.close()
+        if self.description_proxy is not None:
+            self.description_proxy.join()
+        if self.metrics_server is not None:
+            self.metrics_server.join()
+
+    def reload(self):
+        '''Reads the device list again and brings only the devices that changed offline or online'''
+        if self.discovery is not None and self.discovery.is_alive():
+            logger.warning('Not reloading the device list while the device discovery is running')
+            return
+
+        logger.info('Reloading the device list')
+
+        try:
+            plan = self.reloader.plan(self.known_devices())
+        except Exception:
+            logger.exception('Failed to reload the device list')
+            return
+
+        if self.response_queue is None:
+            logger.warning('Reloaded devices are not answered by worker processes')
+
+        self.apply_reload(plan)
+
+    def update_interfaces(self):
+        update_interfaces(self.multicast_interfaces, self.advertiser)
+
+    def register_metrics(self):
+        metrics.devices.callback = lambda: len(self.target_index)
+
+        metrics.socket_dropped.callback = self.mcast_server.dropped
+
+        if self.response_queue is not None:
+            metrics.response_queue_depth.callback = self.search_handler.pending
+        else:
+            # the handler metrics are counted inside the worker processes, export what they share
+            for position, name in enumerate(network.MulticastWorker.COUNTERS):
+                metrics.REGISTRY.register(metrics.Gauge(
+                    'ssdp_troll_worker_{}_total'.format(name),
+                    'Worker {} summed over all worker processes'.format(name.replace('_', ' ')),
+                    lambda position=position: sum(worker.counters[position] for worker in self.worker_pool.workers),
+                    metric_type='counter'))
+
+    def create_search_handler(self):
+        response_queue = scheduler.Scheduler()
+        response_queue.start()
+
+        return SSDPSearchRequestHandler(self.target_index, self.notification_interval, response_queue, self.max_response_delay, self.create_rate_limiter(), self.create_notify_listener(response_queue), self.boot_state)
+
+    def create_rate_limiter(self):
+        return None if self.rate_limiter_factory is None else self.rate_limiter_factory()
+
+    def create_notify_listener(self, scheduler):
+        if self.notify_listener_factory is None:
+            return None
+
+        notify_listener = self.notify_listener_factory(self.target_index)
+        notify_listener.start(scheduler)
+
+        return notify_listener
@@ -0,0 +1,100 @@
+import threading
+import unittest
+import bridge
+import loadtest
+import ssdp
+
+def notify_datagram(nts, nt, usn, location=None, server=None, max_age=1800):
+    lines = ['NOTIFY * HTTP/1.1', 'HOST: 239.255.255.250:1900', 'NT: ' + nt, 'NTS: ' + nts, 'USN: ' + usn]
+
+    if location is not None:
+        lines += ['LOCATION: ' + location, 'CACHE-CONTROL: max-age={:d}'.format(max_age)]
+    if server is not None:
+        lines.append('SERVER: ' + server)
+
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+
+class BridgeLoopbackTest(unittest.TestCase):
+    '''
+    Relays the NOTIFYs a troll hears to a bridge peer over loopback.
+    '''
+    def setUp(self):
+        self.description_server = loadtest.DescriptionServer()
+        self.description_server.start()
+
+        # the device the troll advertises itself, and one that only another device announces
+        self.own_device = ssdp.SSDPRemoteDevice(self.description_server.url(0))
+        self.foreign_location = self.description_server.url(1)
+        self.foreign_udn = loadtest.device_udn(1)
+
+        self.online = threading.Event()
+        self.offline = threading.Event()
+        self.relayed = []
+
+        self.peer = bridge.SSDPBridgePeer(0, address='127.0.0.1', on_device=lambda device: self.online.set(), on_device_removed=lambda device: self.offline.set())
+        self.peer.handle = lambda data, handle=self.peer.handle: (self.relayed.append(data), handle(data))
+        self.peer.start()
+
+        self.registry = bridge.create_notify_registry(self.peer.sock.getsockname(), ssdp.SSDPTargetIndex([self.own_device]))
+
+    def tearDown(self):
+        self.peer.join(5)
+        self.description_server.join(5)
+
+    def notify(self, *args, **kwargs):
+        self.registry.handle(notify_datagram(*args, **kwargs), ('127.0.0.1', 1900))
+
+    def relayed_usns(self):
+        return [ssdp.SSDPNotify.from_bytes(data).usn for data in self.relayed]
+
+    def test_relays_foreign_devices(self):
+        usn = self.foreign_udn + '::upnp:rootdevice'
+
+        self.notify('ssdp:alive', 'upnp:rootdevice', usn, self.foreign_location, 'Linux/5.10 UPnP/1.0 Foreign/1.0')
+        self.assertTrue(self.online.wait(5))
+
+        self.notify('ssdp:byebye', 'upnp:rootdevice', usn)
+        self.assertTrue(self.offline.wait(5))
+
+        self.assertEqual(self.relayed_usns(), [usn, usn])
+
+    def test_expires_relayed_devices(self):
+        usn = self.foreign_udn + '::upnp:rootdevice'
+
+        # no more traffic after the alive, the peer has to wake up for the expiry itself
+        self.notify('ssdp:alive', 'upnp:rootdevice', usn, self.foreign_location, 'Linux/5.10 UPnP/1.0 Foreign/1.0', max_age=1)
+        self.assertTrue(self.online.wait(5))
+        self.assertTrue(self.offline.wait(5))
+
+        self.assertEqual(self.relayed_usns(), [usn])
+
+    def test_skips_own_notifications(self):
+        own_usn = self.own_device.udn + '::upnp:rootdevice'
+        foreign_usn = self.foreign_udn + '::upnp:rootdevice'
+
+        # the byebye of a troll carries no SERVER header
+        self.notify('ssdp:alive', 'upnp:rootdevice', own_usn, self.own_device.description_url, 'Linux/5.10 UPnP/1.0 Own/1.0')
+        self.notify('ssdp:byebye', 'upnp:rootdevice', own_usn)
+        self.notify('ssdp:alive', 'upnp:rootdevice', foreign_usn, self.foreign_location, 'Linux/5.10 UPnP/1.0 Foreign/1.0')
+        self.assertTrue(self.online.wait(5))
+
+        self.assertEqual(self.relayed_usns(), [foreign_usn])
+
+    def test_skips_byebye_after_removal(self):
+        own_usn = self.own_device.udn + '::upnp:rootdevice'
+        target_index = ssdp.SSDPTargetIndex([self.own_device])
+        relay = bridge.SSDPBridgeRelay(self.peer.sock.getsockname(), target_index=target_index)
+
+        alive = ssdp.SSDPNotify.from_bytes(notify_datagram('ssdp:alive', 'upnp:rootdevice', own_usn, self.own_device.description_url))
+        byebye = ssdp.SSDPNotify.from_bytes(notify_datagram('ssdp:byebye', 'upnp:rootdevice', own_usn))
+
+        self.assertTrue(relay.is_own(alive))
+
+        # the troll sends the byebye before the device leaves the index, it may be heard after
+        target_index.remove(self.own_device)
+
+        self.assertTrue(relay.is_own(byebye))
+        self.assertFalse(relay.is_own(byebye))
+
+if __name__ == '__main__':
+    unittest.main()
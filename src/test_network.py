@@ -0,0 +1,101 @@
+import select
+import socket
+import time
+import unittest
+import network
+import scheduler
+import ssdp
+
+DESCRIPTION = b'''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType>urn:schemas-upnp-org:device:MediaServer:1</deviceType>
+    <UDN>uuid:worker-test</UDN>
+  </device>
+</root>
+'''
+
+SEARCH = (
+    'M-SEARCH * HTTP/1.1\r\n'
+    'HOST: 239.255.255.250:1900\r\n'
+    'MAN: "ssdp:discover"\r\n'
+    'MX: 1\r\n'
+    'ST: upnp:rootdevice\r\n'
+    '\r\n').encode('ascii')
+
+def search_handler(target_index):
+    response_queue = scheduler.Scheduler()
+    response_queue.start()
+
+    return ssdp.SSDPSearchRequestHandler(target_index, response_queue=response_queue, max_response_delay=1)
+
+@unittest.skipUnless(network.have_fork(), 'needs the fork start method')
+class MulticastWorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.ssdp_port = network.SSDP_PORT
+        network.SSDP_PORT = 19023
+        # the workers inherit it, the replies have to go out for real
+        self.sender = network.SSDPSender()
+        network.set_default_sender(self.sender)
+
+        self.multicast_interfaces = network.MulticastInterfaces()
+        self.multicast_interfaces.update(['127.0.0.1'])
+
+        target_index = ssdp.SSDPTargetIndex([ssdp.SSDPRemoteDevice('http://127.0.0.1:8200/rootDesc.xml', description_data=DESCRIPTION)])
+        self.pool = network.MulticastWorkerPool(3, lambda: search_handler(target_index))
+        self.server = network.MulticastServer(0x1000, self.pool, self.multicast_interfaces)
+
+        self.pool.start()
+        self.server.start()
+
+        while self.server.is_alive() and not self.server.sockets:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.server.join(5)
+        self.pool.join(5)
+        self.multicast_interfaces.close()
+        network.set_default_sender(None)
+        self.sender.close()
+        network.SSDP_PORT = self.ssdp_port
+
+    def control_point(self, source):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton('127.0.0.1'))
+        sock.bind((source, 0))
+
+        return sock
+
+    def replies(self, control_points, timeout):
+        '''Counts the datagrams each control point receives until the timeout'''
+        replies = dict.fromkeys(control_points, 0)
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            for sock in select.select(control_points, [], [], max(deadline - time.monotonic(), 0))[0]:
+                sock.recv(0x1000)
+                replies[sock] += 1
+
+        return [replies[sock] for sock in control_points]
+
+    def test_one_reply_per_search(self):
+        control_points = [self.control_point('127.0.0.{:d}'.format(host)) for host in range(2, 14)]
+
+        try:
+            for sock in control_points:
+                sock.sendto(SEARCH, (network.SSDP_MCAST_ADDR, network.SSDP_PORT))
+
+            # one device, searched once by each control point, answered within MX
+            self.assertEqual(self.replies(control_points, 2), [1] * len(control_points))
+        finally:
+            for sock in control_points:
+                sock.close()
+
+        received = [stats['received'] for stats in self.pool.stats()]
+
+        self.assertEqual(sum(received), len(control_points))
+        self.assertGreater(sum(1 for count in received if count), 1, received)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+import random
+import socket
+import threading
+import unittest
+import scheduler
+
+class SimulatedClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class TimingWheelTest(unittest.TestCase):
+    def handle(self, when):
+        return scheduler.TimerHandle(None, when, None, ())
+
+    def test_insert_rounds_up_to_ticks(self):
+        wheel = scheduler.TimingWheel(tick=0.01)
+        handle = self.handle(0.015)
+        wheel.insert(handle)
+
+        self.assertEqual(handle.expires, 2)
+        self.assertEqual(wheel.next_tick(), 2)
+        self.assertEqual(wheel.advance(0.019), [])
+        self.assertEqual(wheel.advance(0.02), [handle])
+        self.assertEqual(len(wheel), 0)
+
+    def test_past_entries_fire_in_the_next_tick(self):
+        wheel = scheduler.TimingWheel(tick=0.01, now=1.0)
+        handle = self.handle(0.5)
+        wheel.insert(handle)
+
+        self.assertEqual(handle.expires, wheel.base)
+        self.assertEqual(wheel.advance(1.01), [handle])
+
+    def test_remove(self):
+        wheel = scheduler.TimingWheel(tick=0.01)
+        kept, removed = self.handle(0.05), self.handle(0.05)
+        wheel.insert(kept)
+        wheel.insert(removed)
+        wheel.remove(removed)
+        # removing twice, or after firing, does nothing
+        wheel.remove(removed)
+
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(1), [kept])
+        wheel.remove(kept)
+        self.assertEqual(len(wheel), 0)
+        self.assertIsNone(wheel.next_tick())
+
+    def test_levels(self):
+        wheel = scheduler.TimingWheel(tick=1)
+
+        # the last tick of each level and the first of the next one
+        for distance, expected_level in [(63, 0), (64, 1), (4095, 1), (4096, 2), (64 ** 4 - 1, 3), (64 ** 4, 4), (64 ** 5 + 1, 4)]:
+            handle = self.handle(wheel.base + distance)
+            wheel.insert(handle)
+            level = next(level for level, slots in enumerate(wheel.levels) if handle.slot in slots)
+            self.assertEqual(level, expected_level, distance)
+            wheel.remove(handle)
+
+    def test_cascade_fires_in_order(self):
+        wheel = scheduler.TimingWheel(tick=1)
+        times = [1, 63, 64, 65, 127, 128, 4095, 4096, 4097, 70000, 64 ** 4 + 3, 64 ** 5 + 10]
+        handles = [self.handle(when) for when in times]
+
+        for handle in reversed(handles):
+            wheel.insert(handle)
+
+        fired = []
+
+        while len(wheel):
+            tick = wheel.next_tick()
+            entries = wheel.advance(tick)
+
+            for handle in entries:
+                # never early, and exactly in the tick it was due
+                self.assertEqual(tick, handle.when)
+
+            fired.extend(entries)
+
+        self.assertEqual([handle.when for handle in fired], times)
+
+    def test_next_tick_boundaries(self):
+        wheel = scheduler.TimingWheel(tick=1)
+
+        # less than a turn away but wrapped around the lowest level
+        wheel.advance(60)
+        handle = self.handle(66)
+        wheel.insert(handle)
+        self.assertEqual(wheel.next_tick(), 66)
+        self.assertEqual(wheel.advance(65), [])
+
+        # an entry on a higher level wakes up for its cascade, not earlier
+        far = self.handle(64 * 5 + 7)
+        wheel.insert(far)
+        self.assertEqual(wheel.advance(66), [handle])
+        self.assertEqual(wheel.next_tick(), 64 * 5)
+        self.assertEqual(wheel.advance(64 * 5), [])
+        self.assertEqual(wheel.next_tick(), 64 * 5 + 7)
+        self.assertEqual(wheel.advance(64 * 5 + 7), [far])
+
+    def test_known_next_tick(self):
+        rng = random.Random(0)
+        wheel = scheduler.TimingWheel(tick=1)
+        handles = []
+
+        for step in range(2000):
+            operation = rng.random()
+
+            if operation < 0.5:
+                handle = self.handle(wheel.base + rng.choice([rng.randrange(64), rng.randrange(5000), rng.randrange(64 ** 5 * 2)]))
+                wheel.insert(handle)
+                handles.append(handle)
+            elif operation < 0.7 and handles:
+                wheel.remove(handles.pop(rng.randrange(len(handles))))
+            else:
+                fired = wheel.advance(wheel.base + rng.choice([0, 1, 63, 700, rng.randrange(64 ** 4)]))
+                handles = [handle for handle in handles if handle not in fired]
+
+            # what insert, remove and advance kept is what a look at every slot finds
+            if len(wheel):
+                self.assertEqual(wheel.next_tick(), wheel.find_next_tick(), step)
+
+    def test_advance_float_ticks(self):
+        wheel = scheduler.TimingWheel(tick=0.01)
+        handle = self.handle(0.07)
+        wheel.insert(handle)
+
+        # 0.07 / 0.01 is 7.000000000000001, the tick time itself must fire it
+        self.assertEqual(wheel.advance(wheel.next_tick() * wheel.tick), [handle])
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = SimulatedClock()
+        self.scheduler = scheduler.Scheduler(clock=self.clock)
+        self.fired = []
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def run_until(self, now):
+        while self.scheduler.next_time() is not None and self.scheduler.next_time() <= now:
+            self.clock.now = self.scheduler.next_time()
+            self.scheduler.run_due()
+
+        self.clock.now = now
+        self.scheduler.run_due()
+
+    def test_call_later_and_cancel(self):
+        self.scheduler.call_later(0.3, self.fired.append, 'c')
+        self.scheduler.call_later(0.1, self.fired.append, 'a')
+        cancelled = self.scheduler.call_later(0.2, self.fired.append, 'b')
+        cancelled.cancel()
+
+        self.assertEqual(len(self.scheduler), 2)
+
+        self.run_until(1)
+
+        self.assertEqual(self.fired, ['a', 'c'])
+        # cancelling after it fired does nothing
+        cancelled.cancel()
+
+    def test_cancel_from_callback_in_same_batch(self):
+        later = []
+        self.scheduler.call_at(0.1, lambda: later[0].cancel())
+        later.append(self.scheduler.call_at(0.1, self.fired.append, 'cancelled'))
+
+        self.run_until(0.1)
+
+        self.assertEqual(self.fired, [])
+
+    def test_failing_callback_does_not_stop_the_batch(self):
+        self.scheduler.call_at(0.1, lambda: 1 / 0)
+        self.scheduler.call_at(0.1, self.fired.append, 'ran')
+
+        with self.assertLogs(level='ERROR'):
+            self.run_until(0.1)
+
+        self.assertEqual(self.fired, ['ran'])
+
+    def test_timeout(self):
+        self.assertIsNone(self.scheduler.timeout())
+
+        self.scheduler.call_later(0.5, int)
+        self.clock.now = 0.2
+
+        self.assertAlmostEqual(self.scheduler.timeout(), 0.3)
+
+    def test_wait_returns_readable(self):
+        reader, writer = socket.socketpair()
+
+        try:
+            writer.send(b'x')
+            self.assertEqual(self.scheduler.wait([reader]), [reader])
+        finally:
+            reader.close()
+            writer.close()
+
+    def test_wait_wakes_up_for_earlier_entry(self):
+        # without a timer the wait would block for good
+        threading.Timer(0.05, self.scheduler.call_at, (0, int)).start()
+
+        self.assertEqual(self.scheduler.wait(), [])
+
+    def test_thread(self):
+        timers = scheduler.Scheduler()
+        done = threading.Event()
+        timers.start()
+
+        try:
+            timers.call_later(0.02, done.set)
+            self.assertTrue(done.wait(5))
+        finally:
+            timers.join(5)
+            timers.close()
+
+        self.assertFalse(timers.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
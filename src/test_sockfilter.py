@@ -0,0 +1,109 @@
+import socket
+import unittest
+import sockfilter
+
+def run_filter(program, payload):
+    '''Runs a program of load, jump-if-equal and return instructions on a UDP datagram like the kernel does'''
+    packet = b'\0' * sockfilter.UDP_HEADER_SIZE + payload
+    accumulator = 0
+    pc = 0
+
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+
+        if code & 0x07 == sockfilter.BPF_RET:
+            return k
+        elif code & 0x07 == sockfilter.BPF_LD:
+            size = {sockfilter.BPF_W: 4, sockfilter.BPF_H: 2, sockfilter.BPF_B: 1}[code & 0x18]
+
+            if k + size > len(packet):
+                # the kernel rejects a packet a load runs past the end of
+                return 0
+
+            accumulator = int.from_bytes(packet[k:k + size], 'big')
+        elif code == sockfilter.BPF_JMP | sockfilter.BPF_JEQ | sockfilter.BPF_K:
+            pc += jt if accumulator == k else jf
+        else:
+            raise ValueError('unexpected instruction {:#x}'.format(code))
+
+class PrefixFilterTest(unittest.TestCase):
+    def assertAccepts(self, program, payload):
+        self.assertEqual(run_filter(program, payload), sockfilter.ACCEPT, payload)
+
+    def assertRejects(self, program, payload):
+        self.assertEqual(run_filter(program, payload), sockfilter.REJECT, payload)
+
+    def test_prefix_loads(self):
+        self.assertEqual(sockfilter.prefix_loads(b'M-SEARCH ', 8), [
+            (4, int.from_bytes(b'M-SE', 'big'), 8),
+            (4, int.from_bytes(b'ARCH', 'big'), 12),
+            (1, ord(' '), 16),
+        ])
+        self.assertEqual([size for size, value, offset in sockfilter.prefix_loads(b'NOTIFY ', 8)], [4, 2, 1])
+
+    def test_msearch_only(self):
+        program = sockfilter.ssdp_filter()
+
+        self.assertAccepts(program, b'M-SEARCH * HTTP/1.1\r\nST: ssdp:all\r\n\r\n')
+        self.assertRejects(program, b'NOTIFY * HTTP/1.1\r\nNTS: ssdp:alive\r\n\r\n')
+        self.assertRejects(program, b'HTTP/1.1 200 OK\r\n\r\n')
+        # differs in the last byte of the prefix only
+        self.assertRejects(program, b'M-SEARCHX* HTTP/1.1\r\n\r\n')
+        self.assertRejects(program, b'm-search * HTTP/1.1\r\n\r\n')
+        # shorter than the prefix
+        self.assertRejects(program, b'M-SEARCH')
+        self.assertRejects(program, b'')
+
+    def test_with_notify(self):
+        program = sockfilter.ssdp_filter(accept_notify=True)
+
+        self.assertAccepts(program, b'M-SEARCH * HTTP/1.1\r\n\r\n')
+        self.assertAccepts(program, b'NOTIFY * HTTP/1.1\r\n\r\n')
+        self.assertRejects(program, b'NOTIFY! * HTTP/1.1\r\n\r\n')
+        self.assertRejects(program, b'HTTP/1.1 200 OK\r\n\r\n')
+
+    def test_odd_prefix_lengths(self):
+        program = sockfilter.prefix_filter([b'A', b'BC', b'DEF', b'GHIJK'])
+
+        for payload in [b'A', b'BCx', b'DEF', b'GHIJKLM']:
+            self.assertAccepts(program, payload)
+
+        for payload in [b'B', b'DE', b'GHIJ', b'xA']:
+            self.assertRejects(program, payload)
+
+    def test_jump_offsets_stay_in_range(self):
+        program = sockfilter.ssdp_filter(accept_notify=True)
+
+        for pc, (code, jt, jf, k) in enumerate(program):
+            if code & 0x07 == sockfilter.BPF_JMP:
+                self.assertLess(pc + 1 + max(jt, jf), len(program))
+                self.assertLessEqual(max(jt, jf), 0xff)
+
+@unittest.skipUnless(sockfilter.have_socket_filter(), 'socket filters are Linux only')
+class AttachFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(1)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_kernel_drops_rejected_datagrams(self):
+        sockfilter.attach_filter(self.receiver, sockfilter.ssdp_filter())
+
+        for payload in [b'NOTIFY * HTTP/1.1\r\n\r\n', b'M-SEARCH * HTTP/1.1\r\n\r\n']:
+            self.sender.sendto(payload, self.receiver.getsockname())
+
+        self.assertEqual(self.receiver.recv(0x1000), b'M-SEARCH * HTTP/1.1\r\n\r\n')
+
+        sockfilter.detach_filter(self.receiver)
+        self.sender.sendto(b'NOTIFY * HTTP/1.1\r\n\r\n', self.receiver.getsockname())
+
+        self.assertEqual(self.receiver.recv(0x1000), b'NOTIFY * HTTP/1.1\r\n\r\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+import xml.etree.ElementTree as ET
+import loadtest
+import ssdp
+
+DESCRIPTION = b'''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0" xmlns:dlna="urn:schemas-dlna-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType> urn:schemas-upnp-org:device:InternetGatewayDevice:1 </deviceType>
+    <dlna:X_DLNADOC>DMS-1.50</dlna:X_DLNADOC>
+    <UDN>uuid:root</UDN>
+    <serviceList>
+      <service><serviceType>urn:schemas-upnp-org:service:Layer3Forwarding:1</serviceType></service>
+    </serviceList>
+    <deviceList>
+      <device>
+        <deviceType>urn:schemas-upnp-org:device:WANDevice:1</deviceType>
+        <serviceList>
+          <service><serviceType>urn:schemas-upnp-org:service:WANCommonInterfaceConfig:1</serviceType></service>
+        </serviceList>
+        <deviceList>
+          <device>
+            <UDN>uuid:connection</UDN>
+            <deviceType>urn:schemas-upnp-org:device:WANConnectionDevice:1</deviceType>
+            <serviceList>
+              <service><serviceType>urn:schemas-upnp-org:service:WANIPConnection:1</serviceType></service>
+              <service><serviceType>urn:schemas-upnp-org:service:WANIPConnection:1</serviceType></service>
+            </serviceList>
+          </device>
+        </deviceList>
+        <UDN>uuid:wan</UDN>
+      </device>
+    </deviceList>
+  </device>
+</root>
+'''
+
+class SearchRequestTest(unittest.TestCase):
+    def test_parse(self):
+        request = ssdp.SSDPSearchRequest.from_bytes(
+            b'M-SEARCH * HTTP/1.1\r\n'
+            b'HOST: 239.255.255.250:1900\r\n'
+            b'man:"ssdp:discover"\r\n'
+            b'Mx: 3 \r\n'
+            b'ST:\t urn:schemas-upnp-org:device:MediaServer:1\r\n'
+            b'\r\n')
+
+        self.assertEqual(request.st, 'urn:schemas-upnp-org:device:MediaServer:1')
+        self.assertEqual(request.mx, b'3')
+        self.assertTrue(request.is_discover())
+
+    def test_bare_newlines_and_memoryview(self):
+        request = ssdp.SSDPSearchRequest.from_bytes(memoryview(b'M-SEARCH * HTTP/1.1\nST: ssdp:all\nMAN: "ssdp:discover"\n\n'))
+
+        self.assertEqual(request.st, 'ssdp:all')
+        self.assertTrue(request.is_discover())
+
+    def test_missing_headers(self):
+        request = ssdp.SSDPSearchRequest.from_bytes(b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nX-ST: ssdp:all\r\n\r\n')
+
+        self.assertIsNone(request.st)
+        self.assertIsNone(request.mx)
+        self.assertFalse(request.is_discover())
+
+    def test_not_a_search(self):
+        for data in [b'NOTIFY * HTTP/1.1\r\nST: ssdp:all\r\n\r\n', b'HTTP/1.1 200 OK\r\n\r\n', b'M-SEARCH', b'']:
+            self.assertIsNone(ssdp.SSDPSearchRequest.from_bytes(data), data)
+            self.assertIsNone(ssdp.SSDPSearchRequest.from_bytes(memoryview(data)), data)
+
+    def test_header_only_at_line_start(self):
+        request = ssdp.SSDPSearchRequest.from_bytes(b'M-SEARCH * HTTP/1.1\r\nX-Comment: ST: upnp:rootdevice\r\nST: ssdp:all\r\n\r\n')
+
+        self.assertEqual(request.st, 'ssdp:all')
+
+class DeviceDescriptionTest(unittest.TestCase):
+    def test_embedded_devices(self):
+        self.assertEqual(ssdp.parse_device_description(DESCRIPTION), [
+            ('uuid:root', 'urn:schemas-upnp-org:device:InternetGatewayDevice:1', ['urn:schemas-upnp-org:service:Layer3Forwarding:1']),
+            # the UDN after the nested device list still belongs to the WAN device
+            ('uuid:wan', 'urn:schemas-upnp-org:device:WANDevice:1', ['urn:schemas-upnp-org:service:WANCommonInterfaceConfig:1']),
+            ('uuid:connection', 'urn:schemas-upnp-org:device:WANConnectionDevice:1', ['urn:schemas-upnp-org:service:WANIPConnection:1'] * 2),
+        ])
+
+    def test_target_usns(self):
+        target_usns = ssdp.device_target_usns(ssdp.parse_device_description(DESCRIPTION))
+
+        self.assertEqual(target_usns[:2], [('upnp:rootdevice', 'uuid:root::upnp:rootdevice'), ('uuid:root', 'uuid:root')])
+        # the service listed twice is advertised once
+        self.assertEqual(target_usns.count(('urn:schemas-upnp-org:service:WANIPConnection:1', 'uuid:connection::urn:schemas-upnp-org:service:WANIPConnection:1')), 1)
+        self.assertEqual(len(target_usns), 10)
+
+    def test_without_namespace(self):
+        devices = ssdp.parse_device_description(b'<root><device><deviceType>urn:x:device:Y:1</deviceType><UDN>uuid:y</UDN></device></root>')
+
+        self.assertEqual(devices, [('uuid:y', 'urn:x:device:Y:1', [])])
+
+    def test_foreign_namespace_ignored(self):
+        data = (b'<root xmlns="urn:schemas-upnp-org:device-1-0" xmlns:x="urn:example">'
+            b'<device><deviceType>urn:x:device:Y:1</deviceType><x:UDN>uuid:wrong</x:UDN><UDN>uuid:y</UDN></device></root>')
+
+        self.assertEqual(ssdp.parse_device_description(data)[0][0], 'uuid:y')
+
+    def test_invalid(self):
+        for data in [
+            b'<root xmlns="urn:schemas-upnp-org:device-1-0"></root>',
+            b'<root xmlns="urn:schemas-upnp-org:device-1-0"><device><deviceType>urn:x:device:Y:1</deviceType></device></root>',
+            b'<root><device><UDN>uuid:y</UDN>',
+            b'not xml',
+        ]:
+            with self.assertRaises(ET.ParseError, msg=data):
+                ssdp.parse_device_description(data)
+
+    def test_synthetic_profiles(self):
+        for index in range(len(loadtest.DEVICE_PROFILES)):
+            devices = ssdp.parse_device_description(loadtest.description_document(index))
+
+            self.assertEqual(devices[0][0], loadtest.device_udn(index))
+            self.assertEqual(devices[0][1], loadtest.device_profile(index)[0])
+            self.assertEqual(len(set(udn for udn, device_type, service_types in devices)), len(devices))
+
+if __name__ == '__main__':
+    unittest.main()
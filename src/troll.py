@@ -1,6 +1,19 @@
+import os
+import functools
 import logging
 import argparse
+import bootstate
 import ssdp
+import network
+import interfaces
+import aio
+import discovery
+import ratelimit
+import proxy
+import bridge
+import health
+import reload
+import sockfilter
 
 def init_logging():
     formatter = logging.Formatter('%(asctime)s.%(msecs)03d;%(levelname)s;%(name)s;%(message)s',datefmt='%H:%M:%S')
@@ -14,14 +27,117 @@ def init_logging():
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument("server", help="Full HTTP url to the description.xml", default='http://x.x.x.x:8889/description.xml')
-    return parser.parse_args()
+    parser.add_argument("server", nargs='*', help="Full HTTP url to the description.xml of each remote device", default=[])
+    parser.add_argument("--devices-file", default=None, help="File with more description urls, one per line, read again on SIGHUP")
+    parser.add_argument("--engine", choices=['asyncio', 'threads'], default='asyncio', help="Runtime used to receive, advertise and respond")
+    parser.add_argument("--max-response-delay", type=int, default=5, help="Upper bound in seconds for the MX delay of search responses")
+    parser.add_argument("--workers", type=int, default=0, help="Answer searches in this many worker processes, each source address always in the same one (threads engine only)")
+    parser.add_argument("--receive-buffer-size", type=int, default=None, help="SO_RCVBUF for the multicast sockets, and the queue size of each worker process, in bytes")
+    parser.add_argument("--cache-dir", default=os.path.expanduser('~/.cache/ssdp-troll'), help="Directory for cached device descriptions, empty to disable")
+    parser.add_argument("--boot-id-file", default=None, help="File keeping the UPnP BOOTID across restarts, defaults to boot-id in the cache directory")
+    parser.add_argument("--revalidate-interval", type=int, default=300, help="Seconds between conditional refreshes of the device descriptions")
+    parser.add_argument("--health-interval", type=float, default=60, help="Seconds between health probes of each description url, 0 to advertise devices without probing")
+    parser.add_argument("--health-timeout", type=float, default=5, help="Timeout in seconds for one health probe")
+    parser.add_argument("--health-failures", type=int, default=3, help="Failed health probes in a row after which a device says byebye until it answers again")
+    parser.add_argument("--health-max-backoff", type=float, default=600, help="Upper bound in seconds for the backoff between probes of a failing device")
+    parser.add_argument("--fetch-timeout", type=float, default=10, help="Timeout in seconds for fetching a device description")
+    parser.add_argument("--fetch-concurrency", type=int, default=8, help="Number of device descriptions fetched in parallel at startup")
+    parser.add_argument("--source-rate-limit", type=float, default=5, help="M-SEARCH requests per second allowed from one source address, 0 to disable rate limiting")
+    parser.add_argument("--source-rate-burst", type=int, default=20, help="M-SEARCH burst allowed from one source address")
+    parser.add_argument("--global-rate-limit", type=float, default=200, help="M-SEARCH requests per second answered in total")
+    parser.add_argument("--global-rate-burst", type=int, default=400, help="M-SEARCH burst answered in total")
+    parser.add_argument("--alive-repeat", type=int, default=2, help="Copies of the alive notifications sent in every round of a device")
+    parser.add_argument("--alive-spread", type=float, default=10, help="Window in seconds over which the alive rounds of the devices are spread")
+    parser.add_argument("--default-interface-only", action='store_true', help="Advertise and listen on the default interface only instead of on every multicast capable interface")
+    parser.add_argument("--ipv6", action='store_true', help="Also advertise and listen on the link-local IPv6 SSDP group ff02::c of every interface")
+    parser.add_argument("--ipv6-site-local", action='store_true', help="With --ipv6, also use the site-local IPv6 SSDP group ff05::c")
+    parser.add_argument("--proxy-port", type=int, default=None, help="Serve cached copies of the device and service descriptions on this port and advertise them as LOCATION")
+    parser.add_argument("--proxy-host", default=None, help="Host name or address the proxied LOCATION URLs point to, defaults to the address of the first multicast interface")
+    parser.add_argument("--registry", action='store_true', help="Record the devices announced on the segment, served as JSON on /registry of the metrics port")
+    parser.add_argument("--bridge-to", default=None, help="Relay the NOTIFYs heard on this segment to the bridge peer at host:port")
+    parser.add_argument("--bridge-listen", type=int, default=None, help="Receive relayed NOTIFYs on this UDP port and re-advertise their devices")
+    parser.add_argument("--bridge-peer", default=None, help="Only accept relayed NOTIFYs from this host")
+    parser.add_argument("--socket-filter", action='store_true', help="Let the kernel drop datagrams that are no M-SEARCH (or NOTIFY, where needed) with a BPF socket filter, Linux only")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve Prometheus metrics on this local port")
+    args = parser.parse_args()
+
+    if args.workers and args.engine != 'threads':
+        parser.error('--workers requires --engine threads')
+    if args.workers and not network.have_fork():
+        parser.error('--workers requires the fork start method, which is not available on this platform')
+    if args.ipv6 and args.default_interface_only:
+        # the IPv6 groups are joined per interface, which needs the interface list
+        parser.error('--ipv6 cannot be combined with --default-interface-only')
+    if args.ipv6 and not interfaces.have_getifaddrs():
+        parser.error('--ipv6 requires getifaddrs, which is not available on this platform')
+    if args.ipv6_site_local and not args.ipv6:
+        parser.error('--ipv6-site-local requires --ipv6')
+
+    return args
 
 if __name__ == "__main__":
     init_logging()
 
     args = parse_arguments()
 
-    remote_device = ssdp.SSDPRemoteDevice(args.server)
-    troll = ssdp.SSDPTroll(remote_device)
+    description_cache = ssdp.SSDPDescriptionCache(args.cache_dir) if args.cache_dir else None
+    boot_id_file = args.boot_id_file or (os.path.join(args.cache_dir, 'boot-id') if args.cache_dir else None)
+    boot_state = bootstate.SSDPBootState(boot_id_file)
+    reloader = reload.SSDPDeviceReloader(args.server, args.devices_file, description_cache, args.fetch_timeout, args.fetch_concurrency)
+    device_discovery = discovery.SSDPDeviceDiscovery(reloader.description_urls, description_cache, args.fetch_timeout, args.fetch_concurrency)
+
+    if args.source_rate_limit:
+        # every worker process has its own rate limiter and its share of the global limit
+        shares = max(args.workers, 1)
+        rate_limiter_factory = functools.partial(ratelimit.SSDPRateLimiter, args.source_rate_limit, args.source_rate_burst, args.global_rate_limit / shares, max(args.global_rate_burst // shares, 1))
+    else:
+        rate_limiter_factory = None
+
+    if args.default_interface_only or not interfaces.have_getifaddrs():
+        multicast_interfaces = None
+    else:
+        ipv6_groups = []
+
+        if args.ipv6:
+            ipv6_groups.append(network.SSDP_MCAST_ADDR6_LINK_LOCAL)
+
+            if args.ipv6_site_local:
+                ipv6_groups.append(network.SSDP_MCAST_ADDR6_SITE_LOCAL)
+
+        multicast_interfaces = network.MulticastInterfaces(ipv6_groups=ipv6_groups)
+        network.set_default_sender(multicast_interfaces)
+
+    if args.proxy_port is None:
+        description_proxy = None
+    else:
+        addresses = interfaces.multicast_addresses() if interfaces.have_getifaddrs() else []
+        proxy_host = args.proxy_host or (addresses + ['127.0.0.1'])[0]
+        description_proxy = proxy.SSDPDescriptionProxy(args.proxy_port, proxy_host, timeout=args.fetch_timeout)
+
+    if args.bridge_to is not None:
+        notify_listener_factory = functools.partial(bridge.create_notify_registry, bridge.parse_peer_address(args.bridge_to))
+    elif args.registry:
+        notify_listener_factory = functools.partial(bridge.create_notify_registry, None)
+    else:
+        notify_listener_factory = None
+
+    if args.socket_filter and not sockfilter.have_socket_filter():
+        logging.getLogger().warning('Socket filters are not supported on this platform, receiving all datagrams')
+        args.socket_filter = False
+
+    if args.health_interval:
+        health_checker = health.SSDPHealthChecker(args.health_interval, args.health_timeout, args.health_failures, max_backoff=args.health_max_backoff)
+    else:
+        health_checker = None
+
+    if args.bridge_listen is None:
+        bridge_peer = None
+    else:
+        bridge_peer = bridge.SSDPBridgePeer(args.bridge_listen, args.bridge_peer, description_cache=description_cache, timeout=args.fetch_timeout)
+
+    if args.engine == 'threads':
+        troll = ssdp.SSDPTroll([], max_response_delay=args.max_response_delay, workers=args.workers, receive_buffer_size=args.receive_buffer_size, revalidate_interval=args.revalidate_interval, discovery=device_discovery, rate_limiter_factory=rate_limiter_factory, metrics_port=args.metrics_port, multicast_interfaces=multicast_interfaces, description_proxy=description_proxy, notify_listener_factory=notify_listener_factory, bridge_peer=bridge_peer, alive_repeat=args.alive_repeat, alive_spread=args.alive_spread, reloader=reloader, socket_filter=args.socket_filter, boot_state=boot_state, health_checker=health_checker)
+    else:
+        troll = aio.AsyncSSDPTroll([], max_response_delay=args.max_response_delay, revalidate_interval=args.revalidate_interval, discovery=device_discovery, rate_limiter_factory=rate_limiter_factory, metrics_port=args.metrics_port, multicast_interfaces=multicast_interfaces, description_proxy=description_proxy, notify_listener_factory=notify_listener_factory, bridge_peer=bridge_peer, alive_repeat=args.alive_repeat, alive_spread=args.alive_spread, reloader=reloader, socket_filter=args.socket_filter, boot_state=boot_state, health_checker=health_checker)
+
     troll.run()